@@ -0,0 +1,14 @@
+"""
+ASGI config for the app.
+
+Run with an ASGI server, e.g.
+``gunicorn -k uvicorn.workers.UvicornWorker app.asgi:application``.
+Downloads and previews are streamed from the event loop (see core.streams).
+"""
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'app.settings')
+
+application = get_asgi_application()
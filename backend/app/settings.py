@@ -23,6 +23,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -36,28 +37,65 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'app.urls'
 
+WSGI_APPLICATION = 'app.wsgi.application'
+ASGI_APPLICATION = 'app.asgi.application'
+
 AUTH_USER_MODEL = 'core.User'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'core.authentication.CachedJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
     ),
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10,
+    # Token buckets shared by the workers on a host (core.throttling)
     'DEFAULT_THROTTLE_CLASSES': [
-        'rest_framework.throttling.AnonRateThrottle',
-        'rest_framework.throttling.UserRateThrottle'
+        'core.throttling.AnonThrottle',
+        'core.throttling.UserThrottle'
     ],
     'DEFAULT_THROTTLE_RATES': {
         'anon': '100/day',
         'user': '1000/day',
         'file_upload': '50/day',
+        'chunk_upload': '10000/day',
+        'link_download': '200/hour',
+        # Bandwidth per user (or client address for public links)
+        'upload_bytes': os.environ.get('UPLOAD_BYTES_RATE', '5G/day'),
+        'download_bytes': os.environ.get('DOWNLOAD_BYTES_RATE', '20G/day'),
     }
 }
 
+# Where the rate limit buckets live: 'sqlite' (shared by all processes on
+# the host) or 'memory' (per process)
+RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE', 'sqlite')
+RATE_LIMIT_DB = os.environ.get('RATE_LIMIT_DB', os.path.join(BASE_DIR, 'ratelimit.sqlite3'))
+# Seconds a check waits for the database's write lock; then it lets the request through
+RATE_LIMIT_DB_TIMEOUT = float(os.environ.get('RATE_LIMIT_DB_TIMEOUT', 5))
+RATE_LIMIT_ENABLED = bool(int(os.environ.get('RATE_LIMIT_ENABLED', 1)))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': int(os.environ.get('CACHE_MAX_ENTRIES', 10000))},
+    },
+    # Shared by all processes on the host; point it at memcached or Redis
+    # when running on several hosts
+    'auth': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('AUTH_CACHE_DIR', os.path.join(BASE_DIR, 'authcache')),
+        'OPTIONS': {'MAX_ENTRIES': int(os.environ.get('CACHE_MAX_ENTRIES', 10000))},
+    },
+}
+
+# Authenticated users are cached (core.authentication) in this cache for
+# AUTH_USER_CACHE_TTL seconds. It must be shared by every process serving
+# the API; with a per-process cache users aren't cached at all
+AUTH_USER_CACHE = os.environ.get('AUTH_USER_CACHE', 'auth')
+AUTH_USER_CACHE_TTL = int(os.environ.get('AUTH_USER_CACHE_TTL', 300))
+
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=60),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
@@ -84,17 +122,194 @@ CORS_ALLOWED_ORIGINS = [
 
 CORS_ALLOW_CREDENTIALS = True
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# Database profile, selected with DATABASE_PROFILE:
+#   sqlite     - plain SQLite for development (default)
+#   sqlite-wal - SQLite tuned for concurrent writers: WAL journal,
+#                synchronous=NORMAL, busy timeout, mmap and persistent connections
+#   postgres   - PostgreSQL with persistent, health-checked connections; set
+#                POSTGRES_PGBOUNCER=1 when connecting through PgBouncer
+DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE', 'sqlite')
+
+if DATABASE_PROFILE == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'secureshare'),
+            'USER': os.environ.get('POSTGRES_USER', 'secureshare'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 600)),
+            'CONN_HEALTH_CHECKS': True,
+            # Transaction pooling can't keep server-side cursors open
+            'DISABLE_SERVER_SIDE_CURSORS': bool(int(os.environ.get('POSTGRES_PGBOUNCER', 0))),
+            'OPTIONS': {
+                'connect_timeout': 5,
+            },
+        }
     }
-}
+elif DATABASE_PROFILE in ('sqlite', 'sqlite-wal'):
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+            # A file rather than memory, so tests can write from several
+            # threads at once the way the servers do
+            'TEST': {'NAME': os.environ.get('SQLITE_TEST_PATH', BASE_DIR / 'test_db.sqlite3')},
+        }
+    }
+    if DATABASE_PROFILE == 'sqlite-wal':
+        DATABASES['default'].update({
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 600)),
+            'OPTIONS': {
+                # Seconds to wait on a locked database (sets busy_timeout)
+                'timeout': float(os.environ.get('SQLITE_BUSY_TIMEOUT', 20)),
+            },
+        })
+        # Applied to every new connection by core.db
+        SQLITE_PRAGMAS = {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+            'temp_store': 'MEMORY',
+            'foreign_keys': 'ON',
+        }
+else:
+    raise ValueError(f"Unknown DATABASE_PROFILE {DATABASE_PROFILE!r}")
 
 # File upload settings
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Encrypted blob storage: 'local' (under MEDIA_ROOT) or 's3' (any
+# S3-compatible store; credentials come from the usual AWS_* variables)
+BLOB_STORE = os.environ.get('BLOB_STORE', 'local')
+BLOB_STORE_S3_BUCKET = os.environ.get('BLOB_STORE_S3_BUCKET')
+BLOB_STORE_S3_PREFIX = os.environ.get('BLOB_STORE_S3_PREFIX', '')
+# e.g. http://localhost:9000 for MinIO
+BLOB_STORE_S3_ENDPOINT_URL = os.environ.get('BLOB_STORE_S3_ENDPOINT_URL')
+BLOB_STORE_S3_REGION = os.environ.get('BLOB_STORE_S3_REGION')
+BLOB_STORE_S3_PART_SIZE = int(os.environ.get('BLOB_STORE_S3_PART_SIZE', 8 * 1024 * 1024))
+
+# Encryption settings
+# Plaintext bytes per independently authenticated segment of a stored blob
+ENCRYPTION_SEGMENT_SIZE = int(os.environ.get('ENCRYPTION_SEGMENT_SIZE', 64 * 1024))
+# Master keys wrapping the per-file data keys (envelope encryption).
+# MASTER_KEYS takes "version:key" pairs, e.g. "1:<key>,2:<key>", where each
+# key is 32 urlsafe-base64 bytes (Fernet.generate_key()). A JSON keyfile
+# {"keys": {"1": "<key>"}} can be used instead via MASTER_KEY_FILE.
+MASTER_KEYS = dict(
+    pair.split(':', 1) for pair in os.environ.get('MASTER_KEYS', '').split(',') if pair
+)
+MASTER_KEY_FILE = os.environ.get('MASTER_KEY_FILE')
+# Version used to wrap new keys; defaults to the highest configured
+MASTER_KEY_VERSION = os.environ.get('MASTER_KEY_VERSION')
+DATA_KEY_CACHE_SIZE = int(os.environ.get('DATA_KEY_CACHE_SIZE', 1024))
+DATA_KEY_CACHE_TTL = int(os.environ.get('DATA_KEY_CACHE_TTL', 300))
+# Worker pool for segment crypto; None means one worker per CPU
+ENCRYPTION_WORKERS = int(os.environ['ENCRYPTION_WORKERS']) if os.environ.get('ENCRYPTION_WORKERS') else None
+# Segments in flight at once (defaults to twice the worker count)
+ENCRYPTION_WINDOW = int(os.environ['ENCRYPTION_WINDOW']) if os.environ.get('ENCRYPTION_WINDOW') else None
+# 'thread' or 'process'
+ENCRYPTION_WORKER_BACKEND = os.environ.get('ENCRYPTION_WORKER_BACKEND', 'thread')
+# Threads running blob reads and decryption for downloads streamed under ASGI
+ASYNC_STREAM_WORKERS = int(os.environ.get('ASYNC_STREAM_WORKERS', 32))
+# Chunk size for resumable uploads; rounded down to a whole number of segments
+UPLOAD_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', 4 * 1024 * 1024))
+# Largest file a resumable upload session may declare
+UPLOAD_SESSION_MAX_SIZE = int(os.environ.get('UPLOAD_SESSION_MAX_SIZE', 2 * 1024 ** 3))
+# Per user: declared bytes and number of sessions open at once
+UPLOAD_SESSION_QUOTA = int(os.environ.get('UPLOAD_SESSION_QUOTA', 4 * 1024 ** 3))
+UPLOAD_SESSIONS_MAX_OPEN = int(os.environ.get('UPLOAD_SESSIONS_MAX_OPEN', 10))
+# Leading bytes of a direct upload sniffed for its type while it is encrypted
+UPLOAD_SNIFF_BYTES = int(os.environ.get('UPLOAD_SNIFF_BYTES', 64 * 1024))
+# Most items (files, or file x user pairs for sharing) in one batch request
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 100))
+# Most files in one streamed ZIP download
+ARCHIVE_MAX_FILES = int(os.environ.get('ARCHIVE_MAX_FILES', 1000))
+
+# Blob compression (core.compression), applied before encryption
+# 'auto' (by content type and a compressibility probe), 'always' or 'off'
+BLOB_COMPRESSION = os.environ.get('BLOB_COMPRESSION', 'auto')
+# 'zstd' or 'zlib'
+BLOB_COMPRESSION_CODEC = os.environ.get('BLOB_COMPRESSION_CODEC', 'zstd')
+BLOB_COMPRESSION_LEVEL = int(os.environ.get('BLOB_COMPRESSION_LEVEL', 3))
+COMPRESSION_PROBE_BYTES = int(os.environ.get('COMPRESSION_PROBE_BYTES', 64 * 1024))
+# Only compress when the probe shrinks by at least this fraction
+COMPRESSION_MIN_SAVING = float(os.environ.get('COMPRESSION_MIN_SAVING', 0.1))
+
+# Preview cache settings
+# Rendered previews are cached encrypted on disk, least recently used first out
+PREVIEW_CACHE_MAX_BYTES = int(os.environ.get('PREVIEW_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+# Render the default preview in the background right after upload
+PREVIEW_PRERENDER = bool(int(os.environ.get('PREVIEW_PRERENDER', 1)))
+
+# Background jobs (core.jobs)
+# 'thread' (a pool in each web process), 'worker' (manage.py run_jobs) or 'inline'
+JOBS_MODE = os.environ.get('JOBS_MODE', 'thread')
+# In 'thread' mode, start the pool and its maintenance loop when the app
+# is loaded rather than with the first job. Set by the server entrypoint
+# (Dockerfile, docker-compose), not for management commands or tests.
+JOBS_AUTOSTART = bool(int(os.environ.get('JOBS_AUTOSTART', 0)))
+JOBS_THREADS = int(os.environ.get('JOBS_THREADS', 2))
+JOBS_POLL_INTERVAL = float(os.environ.get('JOBS_POLL_INTERVAL', 1.0))
+JOBS_MAX_ATTEMPTS = int(os.environ.get('JOBS_MAX_ATTEMPTS', 5))
+# Retries wait base * 2^(attempt - 1) seconds, up to the maximum
+JOBS_RETRY_BASE_DELAY = float(os.environ.get('JOBS_RETRY_BASE_DELAY', 5))
+JOBS_RETRY_MAX_DELAY = float(os.environ.get('JOBS_RETRY_MAX_DELAY', 3600))
+# Workers refresh the lock of a running job this often, in seconds
+JOBS_HEARTBEAT_INTERVAL = float(os.environ.get('JOBS_HEARTBEAT_INTERVAL', 30))
+# Running jobs whose lock wasn't refreshed for this long are assumed
+# abandoned and requeued
+JOBS_LOCK_TIMEOUT = int(os.environ.get('JOBS_LOCK_TIMEOUT', 120))
+# Finished jobs (and their idempotency keys) are kept this many seconds
+JOBS_RETENTION = int(os.environ.get('JOBS_RETENTION', 7 * 24 * 3600))
+# How often stale jobs are requeued and old ones pruned, in seconds
+JOBS_MAINTENANCE_INTERVAL = int(os.environ.get('JOBS_MAINTENANCE_INTERVAL', 60))
+
+# Garbage collection (core.garbage), run as a job every GC_INTERVAL
+# seconds (0 disables) or with 'manage.py collect_garbage'
+GC_INTERVAL = int(os.environ.get('GC_INTERVAL', 3600))
+GC_BATCH_SIZE = int(os.environ.get('GC_BATCH_SIZE', 500))
+# Expired links are kept this long so their recipients see them expire
+GC_LINK_RETENTION = int(os.environ.get('GC_LINK_RETENTION', 24 * 3600))
+# Blobs younger than this are never treated as orphans
+GC_GRACE_PERIOD = int(os.environ.get('GC_GRACE_PERIOD', 24 * 3600))
+# Delete (rather than only report) files whose blob is missing
+GC_DELETE_ORPHAN_ROWS = bool(int(os.environ.get('GC_DELETE_ORPHAN_ROWS', 0)))
+# Upload sessions and partial blobs idle for this long are discarded
+UPLOAD_SESSION_TTL = int(os.environ.get('UPLOAD_SESSION_TTL', 24 * 3600))
+
+# Shareable link access counting: 'atomic' (one conditional UPDATE per
+# download) or 'buffered' (hot links reserve accesses in leases)
+LINK_COUNTER_MODE = os.environ.get('LINK_COUNTER_MODE', 'atomic')
+LINK_COUNTER_HOT_THRESHOLD = int(os.environ.get('LINK_COUNTER_HOT_THRESHOLD', 10))
+LINK_COUNTER_LEASE_SIZE = int(os.environ.get('LINK_COUNTER_LEASE_SIZE', 16))
+LINK_COUNTER_FLUSH_INTERVAL = float(os.environ.get('LINK_COUNTER_FLUSH_INTERVAL', 5.0))
+# Ranged requests continuing a counted link download are free for this long
+LINK_RANGE_TOKEN_TTL = int(os.environ.get('LINK_RANGE_TOKEN_TTL', 600))
+
+# Audit log settings
+# Events are queued in-process and written in batches by a background thread
+AUDIT_LOG_ASYNC = bool(int(os.environ.get('AUDIT_LOG_ASYNC', 1)))
+AUDIT_LOG_QUEUE_SIZE = int(os.environ.get('AUDIT_LOG_QUEUE_SIZE', 10000))
+AUDIT_LOG_BATCH_SIZE = int(os.environ.get('AUDIT_LOG_BATCH_SIZE', 100))
+AUDIT_LOG_FLUSH_INTERVAL = float(os.environ.get('AUDIT_LOG_FLUSH_INTERVAL', 1.0))
+# What to do when the queue is full: 'block', 'drop' or 'spill'
+AUDIT_LOG_OVERFLOW = os.environ.get('AUDIT_LOG_OVERFLOW', 'spill')
+AUDIT_LOG_BLOCK_TIMEOUT = float(os.environ.get('AUDIT_LOG_BLOCK_TIMEOUT', 5.0))
+AUDIT_LOG_SPILL_PATH = os.path.join(BASE_DIR, 'logs', 'audit-spill.jsonl')
+
+# Request instrumentation (core.metrics)
+# Per-request phase timings in a Server-Timing header; on with DEBUG by default
+SERVER_TIMING = bool(int(os.environ.get('SERVER_TIMING', int(DEBUG))))
+# Aggregated histograms served at /metrics in Prometheus text format
+METRICS_ENABLED = bool(int(os.environ.get('METRICS_ENABLED', 1)))
+# Scrapers must send "Authorization: Bearer <token>" when this is set;
+# otherwise /metrics is only served to METRICS_ALLOWED_IPS
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_ALLOWED_IPS = os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+
 # Security settings
 SECURE_SSL_REDIRECT = not DEBUG
 SESSION_COOKIE_SECURE = not DEBUG
@@ -6,13 +6,15 @@ from rest_framework.routers import DefaultRouter
 from rest_framework_simplejwt.views import TokenRefreshView
 from core.views import (
     UserViewSet, EncryptedFileViewSet,
-    FileShareViewSet, ShareableLinkViewSet
+    FileShareViewSet, ShareableLinkViewSet, UploadSessionViewSet,
+    metrics_view
 )
 
 router = DefaultRouter()
 router.register(r'files', EncryptedFileViewSet, basename='file')
 router.register(r'shares', FileShareViewSet, basename='share')
 router.register(r'links', ShareableLinkViewSet, basename='link')
+router.register(r'uploads', UploadSessionViewSet, basename='upload')
 
 # Create a router specifically for auth endpoints
 auth_router = DefaultRouter()
@@ -23,6 +25,7 @@ urlpatterns = [
     path('api/', include(router.urls)),
     path('api/', include(auth_router.urls)),
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('metrics', metrics_view, name='metrics'),
 ]
 
 # Serve media files in development
@@ -0,0 +1,72 @@
+"""
+Request-scoped resolution of file access.
+
+Instead of every permission class, serializer field and view running its
+own ``file.shares.filter(shared_with=user)`` query, an AccessResolver
+loads all of the user's shares in a single query the first time it is
+asked and answers every later check from memory. Ownership needs no query
+at all since it only compares ``owner_id``.
+"""
+from .models import FileShare
+
+ADMIN = 'admin'
+OWNER = 'owner'
+
+
+class AccessResolver:
+    def __init__(self, user):
+        self.user = user
+        self._shares = None
+
+    @property
+    def shares(self):
+        """Map of file id -> share permission for files shared with the user."""
+        if self._shares is None:
+            if not self.user.is_authenticated:
+                self._shares = {}
+            else:
+                self._shares = dict(
+                    FileShare.objects.filter(shared_with=self.user)
+                    .values_list('file_id', 'permission')
+                )
+        return self._shares
+
+    def permission(self, file):
+        """'owner', 'admin', the share permission ('view'/'download') or None."""
+        if not self.user.is_authenticated:
+            return None
+        if file.owner_id == self.user.pk:
+            return OWNER
+        if self.user.role == 'admin':
+            return ADMIN
+        return self.shares.get(file.pk)
+
+    def share_permission(self, file):
+        """The permission of the share between the user and a file, if any."""
+        if not self.user.is_authenticated:
+            return None
+        return self.shares.get(file.pk)
+
+    def can_view(self, file):
+        return self.permission(file) is not None
+
+    def can_download(self, file):
+        return self.permission(file) in (ADMIN, OWNER, 'download')
+
+    def shared_file_ids(self):
+        return set(self.shares)
+
+    def invalidate(self):
+        self._shares = None
+
+
+def get_access_resolver(request):
+    """Return the resolver memoized for this request (and its user)."""
+    request = getattr(request, '_request', request)
+    resolver = getattr(request, '_access_resolver', None)
+    if resolver is None or resolver.user is not request.user:
+        resolver = AccessResolver(request.user)
+        request._access_resolver = resolver
+        # Lets User.has_file_access reuse it for the rest of the request
+        request.user._access_resolver = resolver
+    return resolver
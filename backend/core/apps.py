@@ -0,0 +1,14 @@
+from django.apps import AppConfig
+
+
+class CoreConfig(AppConfig):
+    name = 'core'
+
+    def ready(self):
+        # Connect signal receivers and register the job handlers
+        from . import db, etags, tasks  # noqa: F401
+        from .jobs import runner
+
+        # Periodic jobs and stale job recovery must not wait for a first job;
+        # only server entrypoints opt in (JOBS_AUTOSTART)
+        runner.autostart()
@@ -0,0 +1,319 @@
+"""
+Batched, asynchronous audit log writer.
+
+Requests only put an event on a bounded in-process queue; a background
+thread drains it and writes rows with ``bulk_create`` whenever a batch
+fills up or the flush interval passes. When the queue is full the
+configured overflow policy decides what happens:
+
+* ``block`` - wait up to ``AUDIT_LOG_BLOCK_TIMEOUT`` seconds, then drop
+* ``drop``  - drop the event immediately
+* ``spill`` - append the event to a local JSON-lines file that is replayed
+  once the queue has room again
+
+Every process of a server appends to the same spill file, so appending
+and taking the file over for a replay hold an exclusive ``flock`` on
+``<spill path>.lock``; whichever writer thread replays it gets all the
+events spilled so far, by any process.
+"""
+import atexit
+import fcntl
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ('block', 'drop', 'spill')
+
+_STOP = object()
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class AuditLogWriter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self.counters = {
+            'enqueued': 0,
+            'written': 0,
+            'dropped': 0,
+            'spilled': 0,
+            'replayed': 0,
+            'failed_batches': 0,
+        }
+
+    # Configuration is read lazily so settings overrides apply
+    @property
+    def batch_size(self):
+        return _setting('AUDIT_LOG_BATCH_SIZE', 100)
+
+    @property
+    def flush_interval(self):
+        return _setting('AUDIT_LOG_FLUSH_INTERVAL', 1.0)
+
+    @property
+    def overflow(self):
+        policy = _setting('AUDIT_LOG_OVERFLOW', 'spill')
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown audit log overflow policy {policy!r}")
+        return policy
+
+    @property
+    def spill_path(self):
+        return _setting(
+            'AUDIT_LOG_SPILL_PATH',
+            os.path.join(settings.BASE_DIR, 'logs', 'audit-spill.jsonl')
+        )
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def stats(self):
+        """Return queue depth and event counters."""
+        with self._lock:
+            stats = dict(self.counters)
+        stats['queue_depth'] = self._queue.qsize() if self._queue else 0
+        return stats
+
+    def _ensure_started(self):
+        # Start lazily, and restart after a fork (e.g. preloading servers)
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=_setting('AUDIT_LOG_QUEUE_SIZE', 10000))
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name='audit-log-writer', daemon=True
+            )
+            self._thread.start()
+
+    def enqueue(self, **event):
+        """Queue one audit event (AuditLog field values) for writing."""
+        self.enqueue_many([event])
+
+    def enqueue_many(self, events):
+        """Queue several audit events; they are written in the same batch when possible."""
+        event_time = timezone.now()
+        for event in events:
+            event.setdefault('timestamp', event_time)
+
+        if not _setting('AUDIT_LOG_ASYNC', True):
+            self._count('enqueued', len(events))
+            self._write(list(events))
+            return
+
+        self._ensure_started()
+        overflow = self.overflow
+        for event in events:
+            try:
+                if overflow == 'block':
+                    self._queue.put(event, timeout=_setting('AUDIT_LOG_BLOCK_TIMEOUT', 5.0))
+                else:
+                    self._queue.put_nowait(event)
+            except queue.Full:
+                if overflow == 'spill':
+                    self._spill([event])
+                else:
+                    self._count('dropped')
+                continue
+            self._count('enqueued')
+
+    def _spill_locked(self):
+        """Open and exclusively lock the spill file's lock file; closing it unlocks."""
+        os.makedirs(os.path.dirname(self.spill_path), exist_ok=True)
+        lock = open(f'{self.spill_path}.lock', 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        except BaseException:
+            lock.close()
+            raise
+        return lock
+
+    def _spill(self, events):
+        try:
+            with self._spill_locked():
+                with open(self.spill_path, 'a') as f:
+                    for event in events:
+                        f.write(json.dumps(event, default=str) + '\n')
+            self._count('spilled', len(events))
+        except OSError:
+            logger.exception("Could not spill audit events")
+            self._count('dropped', len(events))
+
+    def _replay_spill(self):
+        """Write back events that overflowed to the spill file."""
+        if not os.path.exists(self.spill_path):
+            return
+        replaying = f'{self.spill_path}.{uuid.uuid4().hex}'
+        with self._spill_locked():
+            try:
+                os.replace(self.spill_path, replaying)
+            except FileNotFoundError:
+                return
+
+        batch = []
+        with open(replaying) as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                event['timestamp'] = parse_datetime(event['timestamp'])
+                batch.append(event)
+                if len(batch) >= self.batch_size:
+                    self._write(batch)
+                    self._count('replayed', len(batch))
+                    batch = []
+        if batch:
+            self._write(batch)
+            self._count('replayed', len(batch))
+        os.remove(replaying)
+
+    def _write(self, events):
+        from .models import AuditLog, EncryptedFile
+
+        try:
+            # Files can be gone by the time we flush (e.g. a DELETE request);
+            # mirror the SET_NULL behaviour instead of failing the whole batch.
+            file_ids = {event['file_id'] for event in events if event.get('file_id')}
+            if file_ids:
+                existing = {
+                    str(pk) for pk in EncryptedFile.objects.filter(
+                        id__in=file_ids
+                    ).values_list('id', flat=True)
+                }
+                for event in events:
+                    if event.get('file_id') and str(event['file_id']) not in existing:
+                        event['file_id'] = None
+
+            rows = [AuditLog(**event) for event in events]
+            try:
+                # A savepoint, so a failed insert leaves an enclosing
+                # transaction (synchronous mode) usable
+                with transaction.atomic():
+                    AuditLog.objects.bulk_create(rows)
+                written = len(rows)
+            except IntegrityError:
+                # One bad row shouldn't cost the rest of the batch
+                self._count('failed_batches')
+                written = self._write_rows(rows)
+        except Exception:
+            logger.exception("Error writing %d audit events", len(events))
+            self._count('failed_batches')
+            self._count('dropped', len(events))
+            return
+        self._count('written', written)
+        if written < len(events):
+            self._count('dropped', len(events) - written)
+
+    def _write_rows(self, rows):
+        from .models import AuditLog
+
+        written = 0
+        for row in rows:
+            try:
+                with transaction.atomic():
+                    AuditLog.objects.bulk_create([row])
+            except IntegrityError:
+                logger.exception("Dropping audit event %r", row.action)
+                continue
+            written += 1
+        return written
+
+    def _drain(self, block):
+        """Take up to one batch off the queue; also reports a stop request."""
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        stop = False
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if block and timeout > 0:
+                    event = self._queue.get(timeout=timeout)
+                else:
+                    event = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if event is _STOP:
+                self._queue.task_done()
+                stop = True
+                break
+            batch.append(event)
+        return batch, stop
+
+    def _flush_batch(self, batch):
+        close_old_connections()
+        try:
+            self._write(batch)
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, stop = self._drain(block=True)
+            if batch:
+                self._flush_batch(batch)
+            elif self._queue.qsize() == 0 and os.path.exists(self.spill_path):
+                close_old_connections()
+                self._replay_spill()
+        # Drain whatever is left before exiting
+        while True:
+            batch, _ = self._drain(block=False)
+            if not batch:
+                break
+            self._flush_batch(batch)
+        self._replay_spill()
+        connection.close()
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far has been written."""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        deadline = time.monotonic() + (timeout or 30)
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def shutdown(self, timeout=10):
+        """Drain the queue and stop the writer thread."""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+
+def record_events(request, events):
+    """
+    Have ``AuditLogMiddleware`` log ``events`` for this request.
+
+    Batch endpoints use this to log one event per item instead of the
+    single default event; each is a dict with ``action`` and optionally
+    ``file_id`` and ``details``.
+    """
+    # Views get a DRF request; the middleware sees the Django one
+    request = getattr(request, '_request', request)
+    request.audit_events = list(events)
+
+
+audit_writer = AuditLogWriter()
+atexit.register(audit_writer.shutdown)
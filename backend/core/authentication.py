@@ -0,0 +1,117 @@
+"""
+JWT authentication backed by a cache of users.
+
+Tokens carry the user's ``token_version`` (the ``ver`` claim).
+:class:`CachedJWTAuthentication` looks the user up in the cache under
+``(user id, version)`` and only falls back to the database on a miss, so an
+authenticated request doesn't query the user table at all while its entry
+is fresh. Entries expire after ``AUTH_USER_CACHE_TTL`` seconds and live in
+the ``AUTH_USER_CACHE`` cache, which bounds their number.
+
+Every entry is stamped with the user's current cache stamp, a random value
+kept under its own key. Any save or delete of a user (password, activation,
+role, MFA state, ...) drops the stamp, and a hit only counts while the
+entry's stamp is still the current one, the user is active and their
+``token_version`` is the token's. The stamp is read before the user is
+loaded, so a copy loaded just before a change is never served after it.
+
+Changing a user's password or deactivating them also bumps
+``token_version``, which revokes every token issued before: they miss the
+cache and then fail the version check against the row.
+
+All of this only holds if every process serving the API sees the same
+cache. A process-local cache (``LocMemCache``) can't be invalidated from
+other workers, so with one the users are loaded from the database on every
+request instead.
+"""
+import secrets
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+TOKEN_VERSION_CLAIM = 'ver'
+
+
+def _cache():
+    """The shared user cache; None if the configured cache is per process."""
+    cache = caches[getattr(settings, 'AUTH_USER_CACHE', 'default')]
+    if isinstance(cache, (LocMemCache, DummyCache)):
+        return None
+    return cache
+
+
+def _ttl():
+    return getattr(settings, 'AUTH_USER_CACHE_TTL', 300)
+
+
+def _cache_key(user_id, version):
+    return f'auth-user:{user_id}:{version}'
+
+
+def _stamp_key(user_id):
+    return f'auth-user-stamp:{user_id}'
+
+
+def current_stamp(cache, user_id):
+    """The user's cache stamp, created if they don't have one."""
+    key = _stamp_key(user_id)
+    stamp = cache.get(key)
+    if stamp is None:
+        stamp = secrets.token_hex(8)
+        if not cache.add(key, stamp, _ttl()):
+            # Another process created it first
+            stamp = cache.get(key)
+    return stamp
+
+
+def forget_user(user_id, *versions):
+    """Invalidate every cached copy of ``user_id``."""
+    cache = _cache()
+    if cache is None:
+        return
+    cache.delete_many([_stamp_key(user_id), *(_cache_key(user_id, version) for version in versions)])
+
+
+class VersionedRefreshToken(RefreshToken):
+    """Refresh token stamped with the user's token version; access tokens inherit it."""
+
+    @classmethod
+    def for_user(cls, user):
+        token = super().for_user(user)
+        token[TOKEN_VERSION_CLAIM] = user.token_version
+        return token
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        # Tokens issued before versioning count as version 0
+        version = validated_token.get(TOKEN_VERSION_CLAIM, 0)
+        cache = _cache()
+        if cache is None or user_id is None:
+            return self._load_user(validated_token, version)
+
+        key, stamp_key = _cache_key(user_id, version), _stamp_key(user_id)
+        found = cache.get_many([key, stamp_key])
+        entry, stamp = found.get(key), found.get(stamp_key)
+        if entry is not None and stamp is not None:
+            entry_stamp, user = entry
+            if entry_stamp == stamp and user.is_active and user.token_version == version:
+                return user
+
+        stamp = stamp or current_stamp(cache, user_id)
+        user = self._load_user(validated_token, version)
+        cache.set(key, (stamp, user), _ttl())
+        return user
+
+    def _load_user(self, validated_token, version):
+        user = super().get_user(validated_token)
+        if user.token_version != version:
+            raise AuthenticationFailed("Token has been revoked", code='token_revoked')
+        return user
@@ -0,0 +1,179 @@
+"""
+Batch operations behind the multi-file upload, bulk share and bulk delete
+endpoints.
+
+Every operation returns one result per requested item, in request order,
+with an HTTP-style ``status`` and either the affected object or an
+``error``, so one bad item doesn't fail the rest. The rows for all good
+items are written in a single transaction (one ``bulk_create`` or one
+``DELETE``), and deleted blobs are reclaimed by a background job queued
+in that same transaction.
+"""
+import logging
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+
+from .blobstore import get_blob_store
+from .etags import bump
+from .jobs import enqueue
+from .models import EncryptedFile, FileShare, User
+from .serializers import MAX_UPLOAD_SIZE
+from .utils import stage_encrypted_upload
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_MAX_ITEMS = 100
+
+
+class BatchError(ValueError):
+    """A batch request that can't be processed at all."""
+
+
+def get_max_items():
+    return getattr(settings, 'BATCH_MAX_ITEMS', DEFAULT_BATCH_MAX_ITEMS)
+
+
+def check_batch_size(count):
+    if not count:
+        raise BatchError("No items were submitted")
+    if count > get_max_items():
+        raise BatchError(f"A batch can hold at most {get_max_items()} items")
+
+
+def batch_upload(uploads, owner):
+    """Store files written by ``EncryptingUploadHandler`` with one insert."""
+    check_batch_size(len(uploads))
+    results = []
+    staged = []
+    for upload in uploads:
+        result = {'name': upload.name}
+        results.append(result)
+        if upload.size > MAX_UPLOAD_SIZE:
+            result.update(status=400, error="File size cannot exceed 10MB")
+            continue
+        try:
+            encrypted_file = stage_encrypted_upload(upload, owner)
+        except ValueError as e:
+            result.update(status=400, error=str(e))
+            continue
+        result.update(status=201, file=encrypted_file)
+        staged.append(encrypted_file)
+
+    try:
+        with transaction.atomic():
+            EncryptedFile.objects.bulk_create(staged)
+            if staged:
+                # bulk_create sends no signals
+                bump([owner.pk])
+    except Exception:
+        # Don't leave orphaned blobs behind
+        _delete_blobs([f.file.name for f in staged])
+        raise
+    return results
+
+
+def bulk_share(owner, file_ids, usernames, permission):
+    """Share every file in ``file_ids`` with every user in ``usernames``."""
+    check_batch_size(len(file_ids) * len(usernames))
+    if permission not in dict(FileShare.PERMISSIONS):
+        raise BatchError(f"Unknown permission {permission!r}")
+
+    parsed = [_parse_uuid(file_id) for file_id in file_ids]
+    files = EncryptedFile.objects.in_bulk([pk for pk in parsed if pk])
+    users = {user.username: user for user in User.objects.filter(username__in=usernames)}
+    existing = set(FileShare.objects.filter(
+        file_id__in=[file.pk for file in files.values() if file.owner_id == owner.pk],
+        shared_with__in=users.values(),
+    ).values_list('file_id', 'shared_with_id'))
+
+    results = []
+    pending = {}
+    created = []
+    for file_id, pk in zip(file_ids, parsed):
+        file = files.get(pk)
+        for username in usernames:
+            result = {'file_id': str(file_id), 'username': username}
+            results.append(result)
+            user = users.get(username)
+            if file is None:
+                result.update(status=404, error="File not found")
+            elif file.owner_id != owner.pk:
+                result.update(status=403, error="You don't own this file")
+            elif user is None:
+                result.update(status=404, error="User not found")
+            elif (file.pk, user.pk) in existing or (file.pk, user.pk) in pending:
+                result.update(status=409, error="File is already shared with this user")
+            else:
+                result.update(status=201)
+                created.append((result, (file.pk, user.pk)))
+                pending[(file.pk, user.pk)] = FileShare(
+                    file=file, shared_with=user, permission=permission
+                )
+
+    with transaction.atomic():
+        # A share created concurrently wins; it is reported as created
+        FileShare.objects.bulk_create(pending.values(), ignore_conflicts=True)
+        if pending:
+            bump([owner.pk, *(user_pk for _, user_pk in pending)])
+    shares = {
+        (share.file_id, share.shared_with_id): share
+        for share in FileShare.objects.select_related('file', 'file__owner', 'shared_with').filter(
+            file_id__in={file_pk for file_pk, _ in pending},
+            shared_with_id__in={user_pk for _, user_pk in pending},
+        )
+    }
+    for result, key in created:
+        result['share'] = shares.get(key)
+    return results
+
+
+def bulk_delete(queryset, user, file_ids):
+    """
+    Delete the files in ``file_ids`` visible through ``queryset``.
+
+    Only owners and admins may delete; the rows go in one statement and
+    their blobs are deleted by a background job after the commit.
+    """
+    check_batch_size(len(file_ids))
+    parsed = [_parse_uuid(file_id) for file_id in file_ids]
+    files = {file.pk: file for file in queryset.filter(pk__in=[pk for pk in parsed if pk])}
+
+    results = []
+    deletable = {}
+    for file_id, pk in zip(file_ids, parsed):
+        result = {'file_id': str(file_id)}
+        results.append(result)
+        file = files.get(pk)
+        if file is None:
+            result.update(status=404, error="File not found")
+        elif file.owner_id != user.pk and user.role != 'admin':
+            result.update(status=403, error="You don't own this file")
+        else:
+            result.update(status=204)
+            deletable[file.pk] = file.file.name
+
+    if deletable:
+        with transaction.atomic():
+            EncryptedFile.objects.filter(pk__in=deletable).delete()
+            enqueue('blobs.delete', {'names': list(deletable.values())})
+    return results
+
+
+def _delete_blobs(names):
+    """Delete blobs, logging (not raising) the ones that can't be removed."""
+    store = get_blob_store()
+    for name in names:
+        try:
+            store.delete(name)
+        except Exception:
+            logger.exception("Could not delete blob %s", name)
+
+
+def _parse_uuid(value):
+    """The UUID in ``value``, or None; unknown ids are reported as not found."""
+    try:
+        return uuid.UUID(str(value))
+    except ValueError:
+        return None
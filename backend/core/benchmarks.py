@@ -0,0 +1,483 @@
+"""
+Benchmarks for the crypto, storage and API hot paths.
+
+Everything runs in-process against the configured database and blob
+store, with no network access. Each suite returns a list of result dicts
+with a unique ``name`` so that runs can be written to JSON by the
+``run_benchmarks`` command and compared between commits.
+
+Point the run at a scratch database (e.g. ``SQLITE_PATH=/tmp/bench.sqlite3``):
+the API suite seeds synthetic users, files, shares and audit rows with
+:func:`seed_dataset`, and the seeded files all share a single small blob.
+"""
+import io
+import os
+import statistics
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from unittest import mock
+
+from django.db import close_old_connections, connection
+from django.test import Client
+from django.test.utils import (
+    CaptureQueriesContext, override_settings, setup_test_environment, teardown_test_environment,
+)
+from rest_framework.views import APIView
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .blobstore import blob_name, get_blob_store
+from .compression import CODEC_FLAGS
+from .crypto import encrypt_stream
+from .keys import key_version, wrap_key
+from .models import AuditLog, EncryptedFile, FileShare, ShareableLink, User
+from .parallel import get_engine
+from .utils import (
+    decrypt_file, encrypt_file, generate_encryption_key, get_decrypted_file,
+    iter_decrypted_file, save_encrypted_file, validate_file_type,
+)
+
+SIZE_UNITS = {'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+DEFAULT_SIZES = ['1KB', '1MB', '16MB', '128MB']
+DEFAULT_SCALES = [1000, 10000, 100000]
+COMPRESSION_SIZES = ['1MB', '16MB']
+# The upload endpoint rejects files over 10MB
+UPLOAD_SIZES = ['1KB', '1MB', '8MB']
+SEED_BATCH_SIZE = 5000
+SEED_EMAIL_DOMAIN = 'bench.invalid'
+# Every seeded file points at this one blob
+SEED_BLOB_ID = uuid.uuid5(uuid.NAMESPACE_URL, 'secure-share/benchmark-seed')
+SEED_CONTENT = b'%PDF-1.4\n% benchmark seed file\n' + b'0' * 4096
+
+_BLOCK = os.urandom(1024 * 1024)
+# Compressible, text-like data: varied lines rather than one repeated byte
+_TEXT_BLOCK = b''.join(
+    b'%06d The quick brown fox jumps over the lazy dog; record %d of the report.\n' % (i, i * 7919 % 10007)
+    for i in range(14000)
+)[:1024 * 1024]
+
+
+def parse_size(label):
+    label = label.strip().upper()
+    for unit, factor in SIZE_UNITS.items():
+        if label.endswith(unit):
+            return int(float(label[:-len(unit)]) * factor)
+    return int(label)
+
+
+def payload(size, block=_BLOCK):
+    """``size`` bytes of incompressible (or, given ``_TEXT_BLOCK``, text-like) data."""
+    repeats, remainder = divmod(size, len(block))
+    return block * repeats + block[:remainder]
+
+
+class SyntheticUpload:
+    """Stands in for an UploadedFile without holding the content in memory."""
+
+    def __init__(self, size, name='bench.pdf', content_type='application/pdf'):
+        self.size = size
+        self.name = name
+        self.content_type = content_type
+
+    def chunks(self, chunk_size=None):
+        remaining = self.size
+        while remaining > 0:
+            chunk = _BLOCK[:min(remaining, len(_BLOCK))]
+            remaining -= len(chunk)
+            yield chunk
+
+
+def time_runs(fn, repeat):
+    """Wall-clock seconds of ``repeat`` calls."""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def peak_memory(fn):
+    """Peak Python heap growth in bytes while running ``fn`` once."""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[max(0, int(len(samples) * fraction + 0.5) - 1)]
+
+
+def _result(suite, name, timings, **extra):
+    result = {
+        'suite': suite,
+        'name': name,
+        'runs': len(timings),
+        'seconds': statistics.median(timings),
+        'min_seconds': min(timings),
+    }
+    if 'bytes' in extra and result['seconds']:
+        result['mb_per_s'] = extra['bytes'] / result['seconds'] / 1024 / 1024
+    result.update(extra)
+    return result
+
+
+def _bench_user(email='runner@' + SEED_EMAIL_DOMAIN, role='user'):
+    user, _ = User.objects.get_or_create(
+        email=email, defaults={'username': email.split('@')[0], 'role': role}
+    )
+    return user
+
+
+def crypto_suite(sizes=DEFAULT_SIZES, repeat=3, memory=True, log=print):
+    """Throughput and peak memory of the crypto and storage helpers by file size."""
+    results = []
+    owner = _bench_user()
+    key = generate_encryption_key()
+
+    for label in sizes:
+        size = parse_size(label)
+        # Large inputs are slow and memory hungry; one run is enough
+        runs = repeat if size < 64 * 1024 * 1024 else 1
+        log(f"crypto: {label}")
+
+        data = payload(size)
+        token = encrypt_file(data, key)
+        cases = [
+            ('encrypt_file', lambda: encrypt_file(data, key)),
+            ('decrypt_file', lambda: decrypt_file(token, key)),
+        ]
+        for name, fn in cases:
+            results.append(_result(
+                'crypto', f'{name}[{label}]', time_runs(fn, runs), bytes=size,
+                peak_bytes=peak_memory(fn) if memory else None,
+            ))
+        del data, token
+
+        saved = []
+
+        def save():
+            saved.append(save_encrypted_file(SyntheticUpload(size), owner, 'application/pdf'))
+
+        results.append(_result(
+            'storage', f'save_encrypted_file[{label}]', time_runs(save, runs), bytes=size,
+            peak_bytes=peak_memory(save) if memory else None,
+        ))
+        encrypted_file = saved.pop()
+
+        def read_all():
+            get_decrypted_file(encrypted_file)
+
+        def stream_all():
+            for _ in iter_decrypted_file(encrypted_file):
+                pass
+
+        for name, fn in (('get_decrypted_file', read_all), ('iter_decrypted_file', stream_all)):
+            results.append(_result(
+                'storage', f'{name}[{label}]', time_runs(fn, runs), bytes=size,
+                peak_bytes=peak_memory(fn) if memory else None,
+            ))
+        for encrypted_file in [encrypted_file] + saved:
+            encrypted_file.delete()
+
+    from PIL import Image
+
+    png = io.BytesIO()
+    Image.new('RGB', (64, 64)).save(png, format='PNG')
+    samples = {
+        'pdf': SEED_CONTENT,
+        'png': png.getvalue(),
+        'txt': b'plain text line\n' * 128,
+    }
+    for kind, sample in samples.items():
+        calls = 200
+        timings = time_runs(lambda: [validate_file_type(sample) for _ in range(calls)], repeat)
+        results.append(_result(
+            'crypto', f'validate_file_type[{kind}]', [t / calls for t in timings],
+        ))
+    return results
+
+
+def compression_suite(sizes=COMPRESSION_SIZES, repeat=3, log=print):
+    """Stored size and encrypt/decrypt throughput per compression codec and kind of data."""
+    codecs = [('none', 0), *sorted(CODEC_FLAGS.items())]
+
+    engine = get_engine()
+    key = generate_encryption_key()
+    results = []
+    for label in sizes:
+        size = parse_size(label)
+        for kind, block in (('text', _TEXT_BLOCK), ('random', _BLOCK)):
+            data = payload(size, block)
+            for codec, flags in codecs:
+                log(f"compression: {codec} {kind} {label}")
+                blob = b''.join(engine.encrypt([data], key, flags=flags))
+
+                def encrypt():
+                    for _ in engine.encrypt([data], key, flags=flags):
+                        pass
+
+                def decrypt():
+                    for _ in engine.decrypt(io.BytesIO(blob), key):
+                        pass
+
+                for name, fn in (('encrypt', encrypt), ('decrypt', decrypt)):
+                    results.append(_result(
+                        'compression', f'{name}[{codec},{kind},{label}]', time_runs(fn, repeat),
+                        bytes=size, stored_bytes=len(blob), ratio=len(blob) / size,
+                    ))
+            del data
+    return results
+
+
+def seed_dataset(scale, log=print):
+    """
+    Grow the synthetic dataset to ``scale`` files, shares and audit rows.
+
+    Seeding is additive, so calling it with increasing scales only inserts
+    the difference. Users are added at one per thousand files (at least
+    ten); file ``i`` belongs to user ``i % users`` and is shared with the
+    next user.
+    """
+    store = get_blob_store()
+    path = blob_name(SEED_BLOB_ID)
+    key = generate_encryption_key()
+    seed_file = EncryptedFile.objects.filter(file=path).first()
+    if seed_file is None or not store.exists(path):
+        store.save(path, encrypt_stream([SEED_CONTENT], key))
+        wrapped_key = wrap_key(key)
+        EncryptedFile.objects.filter(file=path).update(encryption_key=wrapped_key)
+    else:
+        wrapped_key = seed_file.encryption_key
+
+    user_count = max(10, scale // 1000)
+    existing_users = set(
+        User.objects.filter(email__endswith='@' + SEED_EMAIL_DOMAIN, username__startswith='seed-')
+        .values_list('username', flat=True)
+    )
+    User.objects.bulk_create([
+        User(username=f'seed-{i}', email=f'seed-{i}@{SEED_EMAIL_DOMAIN}', password='!')
+        for i in range(user_count) if f'seed-{i}' not in existing_users
+    ], batch_size=SEED_BATCH_SIZE)
+    users = list(
+        User.objects.filter(username__startswith='seed-', email__endswith='@' + SEED_EMAIL_DOMAIN)
+        .order_by('id').values_list('id', flat=True)
+    )
+
+    seeded = EncryptedFile.objects.filter(file=path).count()
+    log(f"seeding {max(0, scale - seeded)} rows each of files, shares and audit logs")
+    for start in range(seeded, scale, SEED_BATCH_SIZE):
+        stop = min(start + SEED_BATCH_SIZE, scale)
+        files = [
+            EncryptedFile(
+                owner_id=users[i % len(users)],
+                name=f'seed-{i}.pdf',
+                file=path,
+                encryption_key=wrapped_key,
+                key_version=key_version(wrapped_key),
+                content_type='application/pdf',
+                size=len(SEED_CONTENT),
+            )
+            for i in range(start, stop)
+        ]
+        EncryptedFile.objects.bulk_create(files)
+        FileShare.objects.bulk_create([
+            FileShare(file=file, shared_with_id=users[(i + 1) % len(users)],
+                      permission='download' if i % 2 else 'view')
+            for i, file in enumerate(files, start)
+        ])
+        AuditLog.objects.bulk_create([
+            AuditLog(user_id=file.owner_id, action='upload', file=file,
+                     details={'seed': True}, ip_address='127.0.0.1')
+            for file in files
+        ])
+    return users
+
+
+@contextmanager
+def api_client_environment():
+    """Test client setup for in-process requests, with throttling disabled."""
+    setup_test_environment()
+    try:
+        # Measure the endpoints, not the per-day rate limits or background renders
+        with mock.patch.object(APIView, 'throttle_classes', ()), \
+                override_settings(PREVIEW_PRERENDER=False, RATE_LIMIT_ENABLED=False):
+            yield
+    finally:
+        teardown_test_environment()
+
+
+def _auth_client(user):
+    token = RefreshToken.for_user(user).access_token
+    return Client(HTTP_AUTHORIZATION=f'Bearer {token}')
+
+
+def _measure_get(client, url, repeat):
+    timings = []
+    queries = None
+    response = None
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            response = client.get(url)
+            if response.streaming:
+                for _ in response.streaming_content:
+                    pass
+            timings.append(time.perf_counter() - started)
+        queries = len(captured)
+    if response.status_code != 200:
+        raise RuntimeError(f"GET {url} returned {response.status_code}")
+    return timings, queries, response
+
+
+def list_suite(scales=DEFAULT_SCALES, repeat=10, pages=5, log=print):
+    """List latency and query counts as the file, share and audit tables grow."""
+    results = []
+    admin = _bench_user('admin@' + SEED_EMAIL_DOMAIN, role='admin')
+    with api_client_environment():
+        for scale in scales:
+            users = seed_dataset(scale, log=log)
+            user = User.objects.get(pk=users[0])
+            client = _auth_client(user)
+            log(f"list: {scale} rows")
+
+            for endpoint in ('files', 'shares'):
+                url = f'/api/{endpoint}/?page_size=50'
+                for page in range(pages):
+                    timings, queries, response = _measure_get(client, url, repeat)
+                    results.append(_result(
+                        'api', f'list_{endpoint}[{scale}][page {page + 1}]', timings,
+                        rows=scale, queries=queries, p95_seconds=percentile(timings, 0.95),
+                    ))
+                    url = response.json().get('next')
+                    if not url:
+                        break
+
+            timings, queries, _ = _measure_get(_auth_client(admin), '/api/files/?page_size=50', repeat)
+            results.append(_result(
+                'api', f'list_files_admin[{scale}]', timings,
+                rows=scale, queries=queries, p95_seconds=percentile(timings, 0.95),
+            ))
+    return results
+
+
+def transfer_suite(sizes=UPLOAD_SIZES, repeat=3, log=print):
+    """Latency and throughput of the upload and download endpoints."""
+    from django.core.files.uploadedfile import SimpleUploadedFile
+
+    results = []
+    user = _bench_user()
+    client = _auth_client(user)
+    with api_client_environment():
+        for label in sizes:
+            size = parse_size(label)
+            log(f"transfer: {label}")
+            # A valid PDF header so the type check passes
+            content = SEED_CONTENT[:9] + payload(max(0, size - 9))
+            created = []
+
+            def upload():
+                response = client.post('/api/files/', {
+                    'name': 'bench.pdf',
+                    'file': SimpleUploadedFile('bench.pdf', content, 'application/pdf'),
+                })
+                if response.status_code != 201:
+                    raise RuntimeError(f"Upload returned {response.status_code}: {response.content[:200]}")
+                created.append(response.json()['id'])
+
+            results.append(_result(
+                'api', f'upload[{label}]', time_runs(upload, repeat), bytes=size,
+            ))
+            timings, queries, _ = _measure_get(client, f'/api/files/{created[0]}/download/', repeat)
+            results.append(_result(
+                'api', f'download[{label}]', timings, bytes=size, queries=queries,
+            ))
+            for encrypted_file in EncryptedFile.objects.filter(pk__in=created):
+                encrypted_file.delete()
+    return results
+
+
+def link_suite(concurrency=(1, 8, 32), requests=200, log=print):
+    """Shareable link downloads under concurrent clients."""
+    results = []
+    user = _bench_user()
+    encrypted_file = save_encrypted_file(SyntheticUpload(64 * 1024), user, 'application/pdf')
+    try:
+        with api_client_environment():
+            for workers in concurrency:
+                log(f"link: {workers} concurrent clients")
+                link = ShareableLink.objects.create(
+                    file=encrypted_file, created_by=user,
+                    expires_at=datetime.now() + timedelta(days=1),
+                )
+                local = threading.local()
+
+                def download(_):
+                    if not hasattr(local, 'client'):
+                        close_old_connections()
+                        local.client = Client()
+                    started = time.perf_counter()
+                    response = local.client.get(f'/api/links/{link.pk}/download/')
+                    for _ in response.streaming_content if response.streaming else ():
+                        pass
+                    return response.status_code, time.perf_counter() - started
+
+                started = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    outcomes = list(executor.map(download, range(requests)))
+                elapsed = time.perf_counter() - started
+
+                timings = [t for _, t in outcomes]
+                succeeded = sum(1 for status, _ in outcomes if status == 200)
+                link.refresh_from_db()
+                results.append(_result(
+                    'api', f'link_download[{workers} clients]', timings,
+                    requests=requests, failed=requests - succeeded,
+                    requests_per_s=requests / elapsed,
+                    p95_seconds=percentile(timings, 0.95),
+                    # Every successful download must be counted exactly once
+                    counted=link.access_count, count_consistent=link.access_count == succeeded,
+                ))
+                link.delete()
+    finally:
+        encrypted_file.delete()
+    return results
+
+
+SUITES = {
+    'crypto': crypto_suite,
+    'compression': compression_suite,
+    'list': list_suite,
+    'transfer': transfer_suite,
+    'link': link_suite,
+}
+
+
+def compare_results(baseline, current, threshold=0.10):
+    """
+    Pair results by name and report relative changes in median time.
+
+    Returns ``(rows, regressions)`` where each row is
+    ``(name, old_seconds, new_seconds, change)``.
+    """
+    previous = {result['name']: result for result in baseline['results']}
+    rows = []
+    regressions = []
+    for result in current['results']:
+        old = previous.get(result['name'])
+        if not old or not old['seconds']:
+            continue
+        change = result['seconds'] / old['seconds'] - 1
+        row = (result['name'], old['seconds'], result['seconds'], change)
+        rows.append(row)
+        if change > threshold:
+            regressions.append(row)
+    return rows, regressions
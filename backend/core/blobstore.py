@@ -0,0 +1,334 @@
+"""
+Storage for encrypted file blobs.
+
+Blobs are keyed by the file's UUID rather than its name and laid out with a
+two-level hashed fan-out (``blobs/3f/a2/<uuid>``), so no directory grows
+with a single user's uploads and saving never has to probe for a free name.
+
+Two backends are available through ``BLOB_STORE``:
+
+``local``
+    Files under ``MEDIA_ROOT``. Writes go to a temporary file that is
+    renamed into place, so readers never see a partial blob.
+``s3``
+    Any S3-compatible object store (AWS, MinIO, ...). Blobs are written
+    with multipart uploads and read with ranged GETs, so ranged downloads
+    only fetch the segments they need. Requires ``boto3``.
+
+Legacy rows whose blob still lives at ``encrypted_files/<owner>/<name>``
+keep working with the local backend; ``migrate_blobs`` moves them into the
+hashed layout (and into S3).
+"""
+import errno
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+
+from django.conf import settings
+
+BLOB_PREFIX = 'blobs'
+# Where blobs were stored before the hashed layout (local backend only)
+LEGACY_PREFIX = 'encrypted_files'
+# S3 rejects multipart parts smaller than 5 MiB (except the last one)
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+def blob_name(file_id, revision=None):
+    """Storage key for a file's blob: ``blobs/<h0h1>/<h2h3>/<uuid>[.<revision>]``."""
+    digest = hashlib.sha256(str(file_id).encode()).hexdigest()
+    name = f'{BLOB_PREFIX}/{digest[:2]}/{digest[2:4]}/{file_id}'
+    return f'{name}.{revision}' if revision else name
+
+
+class BlobStore:
+    """Interface shared by the storage backends."""
+
+    def open(self, name):
+        """Open a blob for reading; the result is a seekable binary file object."""
+        raise NotImplementedError
+
+    def save(self, name, chunks):
+        """Write a blob from an iterable of bytes, replacing any existing one. Returns its size."""
+        raise NotImplementedError
+
+    def save_file(self, name, path):
+        """Move a finished local file into the store as ``name``."""
+        with open(path, 'rb') as f:
+            self.save(name, iter(lambda: f.read(MIN_PART_SIZE), b''))
+        os.remove(path)
+
+    def delete(self, name):
+        raise NotImplementedError
+
+    def exists(self, name):
+        raise NotImplementedError
+
+    def size(self, name):
+        raise NotImplementedError
+
+    def list(self, prefix):
+        """Yield ``(name, size, mtime)`` for every blob under ``prefix``; mtime is a Unix time."""
+        raise NotImplementedError
+
+
+class LocalBlobStore(BlobStore):
+    def __init__(self, root=None):
+        self.root = str(root or settings.MEDIA_ROOT)
+
+    def path(self, name):
+        path = os.path.normpath(os.path.join(self.root, name))
+        if not path.startswith(os.path.join(os.path.normpath(self.root), '')):
+            raise ValueError(f"Blob name {name!r} escapes the storage root")
+        return path
+
+    def open(self, name):
+        return open(self.path(name), 'rb')
+
+    def save(self, name, chunks):
+        path = self.path(name)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return size
+
+    def save_file(self, name, path):
+        target = self.path(name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.replace(path, target)
+        except OSError as e:
+            # Partial uploads may live on another filesystem
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.move(path, target)
+
+    def delete(self, name):
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def exists(self, name):
+        return os.path.isfile(self.path(name))
+
+    def size(self, name):
+        return os.path.getsize(self.path(name))
+
+    def list(self, prefix):
+        top = self.path(prefix)
+        for directory, _, filenames in os.walk(top):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                name = os.path.relpath(path, self.root).replace(os.sep, '/')
+                yield name, stat.st_size, stat.st_mtime
+
+
+class S3RangeReader(io.RawIOBase):
+    """
+    Seekable reader over an S3 object.
+
+    Sequential reads share one streaming GET; a seek to anywhere else
+    drops it and the next read opens a ranged GET from the new position.
+    """
+
+    def __init__(self, client, bucket, key):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self._size = None
+        self._position = 0
+        self._body = None
+        self._body_position = None
+
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = self.client.head_object(Bucket=self.bucket, Key=self.key)['ContentLength']
+        return self._size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        if position < 0:
+            raise ValueError("Negative seek position")
+        self._position = position
+        return position
+
+    def _close_body(self):
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+
+    def readinto(self, buffer):
+        if self._body is None or self._body_position != self._position:
+            self._close_body()
+            if self._size is not None and self._position >= self._size:
+                return 0
+            try:
+                response = self.client.get_object(
+                    Bucket=self.bucket, Key=self.key, Range=f'bytes={self._position}-'
+                )
+            except self.client.exceptions.ClientError as e:
+                if e.response.get('Error', {}).get('Code') == 'InvalidRange':
+                    return 0
+                raise
+            self._body = response['Body']
+            self._body_position = self._position
+        data = self._body.read(len(buffer))
+        buffer[:len(data)] = data
+        self._position += len(data)
+        self._body_position = self._position
+        return len(data)
+
+    def close(self):
+        self._close_body()
+        super().close()
+
+
+class S3BlobStore(BlobStore):
+    def __init__(self, bucket, prefix='', part_size=None, **client_kwargs):
+        import boto3
+
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.part_size = max(part_size or 8 * 1024 * 1024, MIN_PART_SIZE)
+        self.client = boto3.client('s3', **client_kwargs)
+
+    def key(self, name):
+        return f'{self.prefix}/{name}' if self.prefix else name
+
+    def open(self, name):
+        # Unbuffered: sequential reads already stream from a single GET
+        return S3RangeReader(self.client, self.bucket, self.key(name))
+
+    def save(self, name, chunks):
+        key = self.key(name)
+        buffer = bytearray()
+        size = 0
+        upload_id = None
+        parts = []
+        try:
+            for chunk in chunks:
+                buffer += chunk
+                size += len(chunk)
+                while len(buffer) >= self.part_size:
+                    if upload_id is None:
+                        upload_id = self.client.create_multipart_upload(
+                            Bucket=self.bucket, Key=key
+                        )['UploadId']
+                    parts.append(self._upload_part(key, upload_id, len(parts) + 1,
+                                                   bytes(buffer[:self.part_size])))
+                    del buffer[:self.part_size]
+
+            if upload_id is None:
+                # Small blobs don't need a multipart upload
+                self.client.put_object(Bucket=self.bucket, Key=key, Body=bytes(buffer))
+                return size
+            if buffer or not parts:
+                parts.append(self._upload_part(key, upload_id, len(parts) + 1, bytes(buffer)))
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id,
+                MultipartUpload={'Parts': parts},
+            )
+        except BaseException:
+            if upload_id is not None:
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+        return size
+
+    def _upload_part(self, key, upload_id, number, data):
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=data
+        )
+        return {'ETag': response['ETag'], 'PartNumber': number}
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+    def exists(self, name):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except self.client.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def size(self, name):
+        return self.client.head_object(Bucket=self.bucket, Key=self.key(name))['ContentLength']
+
+    def list(self, prefix):
+        strip = len(self.key('')) if self.prefix else 0
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.key(f'{prefix}/')):
+            for item in page.get('Contents', ()):
+                yield item['Key'][strip:], item['Size'], item['LastModified'].timestamp()
+
+
+def create_blob_store(backend=None):
+    """Build a blob store from settings; ``backend`` overrides ``BLOB_STORE``."""
+    backend = backend or getattr(settings, 'BLOB_STORE', 'local')
+    if backend == 'local':
+        return LocalBlobStore(getattr(settings, 'BLOB_STORE_ROOT', None))
+    if backend == 's3':
+        client_kwargs = {
+            key: value for key, value in (
+                ('endpoint_url', getattr(settings, 'BLOB_STORE_S3_ENDPOINT_URL', None)),
+                ('region_name', getattr(settings, 'BLOB_STORE_S3_REGION', None)),
+            ) if value
+        }
+        return S3BlobStore(
+            bucket=settings.BLOB_STORE_S3_BUCKET,
+            prefix=getattr(settings, 'BLOB_STORE_S3_PREFIX', ''),
+            part_size=getattr(settings, 'BLOB_STORE_S3_PART_SIZE', None),
+            **client_kwargs,
+        )
+    raise ValueError(f"Unknown blob store backend {backend!r}")
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_blob_store():
+    """Process-wide blob store configured from settings."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = create_blob_store()
+    return _store
@@ -0,0 +1,287 @@
+"""
+Optional compression of blob plaintext before it is encrypted.
+
+The codec is recorded in the ``flags`` byte of the segmented blob header,
+which is authenticated with every segment, so readers pick the matching
+decompressor and old (uncompressed) blobs keep working unchanged.
+
+The whole plaintext is compressed as one stream and the compressed bytes
+are what gets split into segments. Segments therefore no longer line up
+with plaintext offsets: ranged reads of a compressed blob decompress from
+the start, and resumable upload sessions, which write segments at fixed
+offsets, always store plaintext uncompressed.
+
+Whether a file is compressed is decided by ``BLOB_COMPRESSION``:
+
+``auto``
+    Skip types that are already compressed (images, docx), and compress
+    the rest if a fast probe of the first ``COMPRESSION_PROBE_BYTES``
+    saves at least ``COMPRESSION_MIN_SAVING`` of its size.
+``always`` / ``off``
+    Compress everything / nothing.
+
+``BLOB_COMPRESSION_CODEC`` is ``zstd`` (the default) or ``zlib``. Both
+are always available to read with, whatever wrote the blob.
+"""
+import zlib
+
+import zstandard
+from django.conf import settings
+
+FLAG_ZLIB = 0x01
+FLAG_ZSTD = 0x02
+COMPRESSION_FLAGS = FLAG_ZLIB | FLAG_ZSTD
+
+CODEC_FLAGS = {'zlib': FLAG_ZLIB, 'zstd': FLAG_ZSTD}
+
+# Formats that are compressed containers already
+INCOMPRESSIBLE_TYPES = {
+    'image/jpeg',
+    'image/png',
+    'image/gif',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+}
+
+DEFAULT_PROBE_BYTES = 64 * 1024
+DEFAULT_MIN_SAVING = 0.1
+# Upper bound on the plaintext produced per decompression step, so a
+# small, highly compressed segment can't expand into a huge buffer
+OUTPUT_CHUNK_SIZE = 256 * 1024
+
+
+def codec_flag(codec=None):
+    """Header flag for ``codec`` (the configured one by default)."""
+    codec = codec or getattr(settings, 'BLOB_COMPRESSION_CODEC', 'zstd')
+    try:
+        return CODEC_FLAGS[codec]
+    except KeyError:
+        raise ValueError(f"Unknown compression codec {codec!r}")
+
+
+class _Compressor:
+    def __init__(self, flags):
+        if flags & FLAG_ZSTD:
+            level = getattr(settings, 'BLOB_COMPRESSION_LEVEL', 3)
+            self._obj = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            level = getattr(settings, 'BLOB_COMPRESSION_LEVEL', 6)
+            self._obj = zlib.compressobj(level)
+
+    def compress(self, data):
+        return self._obj.compress(data)
+
+    def flush(self):
+        return self._obj.flush()
+
+
+def compressor(flags):
+    """Incremental compressor for the codec in ``flags``."""
+    return _Compressor(flags)
+
+
+def compress_stream(chunks, flags):
+    """Compress an iterable of plaintext chunks with the codec in ``flags``."""
+    obj = compressor(flags)
+    for chunk in chunks:
+        data = obj.compress(chunk)
+        if data:
+            yield data
+    yield obj.flush()
+
+
+class _ChunkReader:
+    """File-like view of an iterable of byte strings."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+
+    def read(self, size=-1):
+        while not self._buffer:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return b''
+            self._buffer = bytes(chunk)
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+ZSTD_MAGIC = 0xFD2FB528
+# Skippable frames use any magic from 0x184D2A50 to 0x184D2A5F
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A50
+
+
+class _ZstdFrames:
+    """
+    Follows the frame and block headers of a zstd stream as it passes by.
+
+    ``read_to_iter`` just stops at the end of its input, so this is how a
+    stream cut off inside a frame is told apart from a complete one.
+    """
+
+    def __init__(self):
+        self.complete = False
+        self._header = bytearray()
+        self._need = 4
+        self._skip = 0
+        self._state = 'magic'
+        self._checksum = False
+
+    def feed(self, data):
+        data = memoryview(data)
+        position = 0
+        while position < len(data):
+            if self._skip:
+                step = min(self._skip, len(data) - position)
+                self._skip -= step
+                position += step
+                if not self._skip:
+                    self._block_done()
+                continue
+            step = min(self._need - len(self._header), len(data) - position)
+            self._header += data[position:position + step]
+            position += step
+            if len(self._header) == self._need:
+                header, self._header = bytes(self._header), bytearray()
+                self._parse(header)
+
+    def _expect(self, state, size):
+        self._state = state
+        self._need = size
+
+    def _parse(self, header):
+        value = int.from_bytes(header, 'little')
+        if self._state == 'magic':
+            self.complete = False
+            if value == ZSTD_MAGIC:
+                self._expect('descriptor', 1)
+            elif value & ~0xF == ZSTD_SKIPPABLE_MAGIC:
+                self._expect('skippable', 4)
+            else:
+                raise ValueError("Compressed blob is corrupt")
+        elif self._state == 'skippable':
+            self._expect('frame end', 0)
+            self._skip_over(value)
+        elif self._state == 'descriptor':
+            content_size_flag, single_segment = value >> 6, value >> 5 & 1
+            self._checksum = bool(value >> 2 & 1)
+            rest = (
+                (0 if single_segment else 1)
+                + (0, 1, 2, 4)[value & 3]
+                + ((1 if single_segment else 0), 2, 4, 8)[content_size_flag]
+            )
+            if rest:
+                self._expect('frame header', rest)
+            else:
+                self._expect('block', 3)
+        elif self._state == 'frame header':
+            self._expect('block', 3)
+        elif self._state == 'block':
+            block_type = value >> 1 & 3
+            if block_type == 3:
+                raise ValueError("Compressed blob is corrupt")
+            self._state = 'last block' if value & 1 else 'block'
+            # RLE blocks hold a single byte however long they expand
+            self._skip_over(1 if block_type == 1 else value >> 3)
+        elif self._state == 'checksum':
+            self._frame_done()
+
+    def _skip_over(self, size):
+        self._skip = size
+        if not size:
+            self._block_done()
+
+    def _block_done(self):
+        if self._state == 'block':
+            self._need = 3
+        elif self._state == 'last block' and self._checksum:
+            self._expect('checksum', 4)
+        else:
+            self._frame_done()
+
+    def _frame_done(self):
+        self.complete = True
+        self._expect('magic', 4)
+
+
+def decompress_stream(chunks, flags):
+    """Decompress an iterable of compressed chunks, yielding bounded plaintext pieces."""
+    if flags & FLAG_ZSTD:
+        frames = _ZstdFrames()
+
+        def followed():
+            for chunk in chunks:
+                frames.feed(chunk)
+                yield chunk
+
+        dctx = zstandard.ZstdDecompressor()
+        yield from dctx.read_to_iter(_ChunkReader(followed()), write_size=OUTPUT_CHUNK_SIZE)
+        if not frames.complete:
+            raise ValueError("Compressed blob is truncated")
+        return
+
+    obj = zlib.decompressobj()
+    for chunk in chunks:
+        data = obj.decompress(chunk, OUTPUT_CHUNK_SIZE)
+        while data:
+            yield data
+            data = obj.decompress(obj.unconsumed_tail, OUTPUT_CHUNK_SIZE)
+    while not obj.eof:
+        data = obj.flush(OUTPUT_CHUNK_SIZE)
+        if not data:
+            break
+        yield data
+    if not obj.eof:
+        raise ValueError("Compressed blob is truncated")
+
+
+def is_compressed(flags):
+    return bool(flags & COMPRESSION_FLAGS)
+
+
+def choose_compression(content_type, sample):
+    """Header flags for a file of ``content_type`` whose data starts with ``sample``."""
+    mode = getattr(settings, 'BLOB_COMPRESSION', 'auto')
+    if mode == 'off':
+        return 0
+    flags = codec_flag()
+    if mode == 'always':
+        return flags
+    if content_type in INCOMPRESSIBLE_TYPES or not sample:
+        return 0
+    # Level 1 zlib is cheap and a good enough predictor for either codec
+    min_saving = getattr(settings, 'COMPRESSION_MIN_SAVING', DEFAULT_MIN_SAVING)
+    if len(zlib.compress(bytes(sample), 1)) <= len(sample) * (1 - min_saving):
+        return flags
+    return 0
+
+
+def get_probe_size():
+    return getattr(settings, 'COMPRESSION_PROBE_BYTES', DEFAULT_PROBE_BYTES)
+
+
+def probe_chunks(chunks, content_type):
+    """
+    Decide on compression from the head of an iterable of chunks.
+
+    Returns ``(flags, chunks)``; the returned iterable replays the bytes
+    that were consumed for the probe.
+    """
+    chunks = iter(chunks)
+    head = []
+    size = 0
+    probe_size = get_probe_size()
+    for chunk in chunks:
+        head.append(chunk)
+        size += len(chunk)
+        if size >= probe_size:
+            break
+    sample = b''.join(head)[:probe_size]
+
+    def replay():
+        yield from head
+        yield from chunks
+
+    return choose_compression(content_type, sample), replay()
@@ -0,0 +1,343 @@
+"""
+Segmented container format for encrypted blobs.
+
+A blob is a fixed-size header followed by independently authenticated
+AES-256-GCM segments. Every segment holds ``segment_size`` bytes of
+plaintext (the last one may be shorter), so encryption and decryption run
+as generators with memory bounded by one segment, and any segment can be
+located from its index alone.
+
+The header's flags may name a compression codec (see ``core.compression``);
+the plaintext is then compressed as a whole before it is split into
+segments and decompressed again on the way out.
+
+Blobs written before this format existed are single Fernet tokens; they
+are detected by the missing magic bytes and are still readable.
+"""
+import base64
+import os
+import struct
+from collections import namedtuple
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from django.conf import settings
+
+from .compression import COMPRESSION_FLAGS, compress_stream, compressor, decompress_stream, is_compressed
+
+MAGIC = b'SSEG'
+FORMAT_VERSION = 1
+
+# magic, version, flags, reserved, segment size, per-blob salt
+HEADER = struct.Struct('>4sBBHI16s')
+HEADER_SIZE = HEADER.size
+SALT_SIZE = 16
+TAG_SIZE = 16
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024
+MAX_SEGMENT_SIZE = 16 * 1024 * 1024
+
+BlobHeader = namedtuple('BlobHeader', ['version', 'flags', 'segment_size', 'salt'])
+
+
+def get_segment_size():
+    """Return the configured plaintext segment size in bytes."""
+    return getattr(settings, 'ENCRYPTION_SEGMENT_SIZE', DEFAULT_SEGMENT_SIZE)
+
+
+def is_segmented(prefix):
+    """Return True if the leading bytes of a blob carry the segmented magic."""
+    return bytes(prefix[:len(MAGIC)]) == MAGIC
+
+
+def pack_header(header):
+    """Serialize a BlobHeader to its on-disk form."""
+    return HEADER.pack(MAGIC, header.version, header.flags, 0,
+                       header.segment_size, header.salt)
+
+
+def parse_header(data):
+    """Parse and validate the on-disk header of a segmented blob."""
+    if len(data) < HEADER_SIZE or not is_segmented(data):
+        raise ValueError("Not a segmented encrypted blob")
+    _, version, flags, _, segment_size, salt = HEADER.unpack(bytes(data[:HEADER_SIZE]))
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported blob format version {version}")
+    if not 0 < segment_size <= MAX_SEGMENT_SIZE:
+        raise ValueError(f"Invalid segment size {segment_size}")
+    if flags & ~COMPRESSION_FLAGS or flags == COMPRESSION_FLAGS:
+        raise ValueError(f"Unsupported blob flags {flags:#x}")
+    return BlobHeader(version, flags, segment_size, salt)
+
+
+def new_header(segment_size=None, flags=0):
+    """Build a header with a fresh random salt."""
+    return BlobHeader(FORMAT_VERSION, flags, segment_size or get_segment_size(),
+                      os.urandom(SALT_SIZE))
+
+
+def segment_cipher(key, header):
+    """Return the AEAD for a blob, keyed by HKDF(file key, blob salt)."""
+    raw_key = base64.urlsafe_b64decode(bytes(key))
+    derived = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=header.salt,
+        info=b'secure-share segment v1',
+    ).derive(raw_key)
+    return AESGCM(derived)
+
+
+def segment_nonce(index, final):
+    """Nonce for segment ``index``; the final flag stops truncation attacks."""
+    return index.to_bytes(11, 'big') + (b'\x01' if final else b'\x00')
+
+
+def encrypted_segment_size(segment_size):
+    """Size on disk of one full segment."""
+    return segment_size + TAG_SIZE
+
+
+def segment_offset(index, segment_size):
+    """Byte offset of segment ``index`` inside the blob."""
+    return HEADER_SIZE + index * encrypted_segment_size(segment_size)
+
+
+def segment_count(blob_size, segment_size):
+    """Number of segments in a blob of ``blob_size`` bytes."""
+    body = blob_size - HEADER_SIZE
+    step = encrypted_segment_size(segment_size)
+    return max(1, -(-body // step))
+
+
+def plaintext_size(blob_size, segment_size):
+    """Plaintext length of a segmented blob, derived from its size on disk."""
+    body = blob_size - HEADER_SIZE
+    return body - segment_count(blob_size, segment_size) * TAG_SIZE
+
+
+def encrypt_segment(cipher, header_bytes, index, data, final):
+    """Encrypt a single segment."""
+    return cipher.encrypt(segment_nonce(index, final), data, header_bytes)
+
+
+def decrypt_segment(cipher, header_bytes, index, data, final):
+    """Decrypt and authenticate a single segment."""
+    try:
+        return cipher.decrypt(segment_nonce(index, final), bytes(data), header_bytes)
+    except InvalidTag:
+        raise ValueError(f"Segment {index} failed authentication")
+
+
+def rechunk(chunks, size):
+    """Regroup an iterable of byte strings into blocks of exactly ``size`` bytes."""
+    buffer = bytearray()
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if not isinstance(chunk, (bytes, bytearray, memoryview)):
+            chunk = chunk.encode()
+        buffer += chunk
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+    if buffer:
+        yield bytes(buffer)
+
+
+def encrypt_stream(chunks, key, segment_size=None, flags=0):
+    """Encrypt an iterable of plaintext chunks, yielding the blob piece by piece."""
+    header = new_header(segment_size, flags)
+    header_bytes = pack_header(header)
+    cipher = segment_cipher(key, header)
+    yield header_bytes
+
+    if is_compressed(flags):
+        chunks = compress_stream(chunks, flags)
+    index = 0
+    pending = None
+    for block in rechunk(chunks, header.segment_size):
+        if pending is not None:
+            yield encrypt_segment(cipher, header_bytes, index, pending, False)
+            index += 1
+        pending = block
+    # An empty input still gets one (empty) final segment
+    yield encrypt_segment(cipher, header_bytes, index, pending or b'', True)
+
+
+class SegmentEncryptor:
+    """
+    Push-style counterpart of ``encrypt_stream`` for data handed over in pieces.
+
+    ``header_bytes`` starts the blob; ``update`` returns the segments that
+    its data completes and ``finalize`` the rest. The last full segment
+    is held back until more data arrives, since only then is it known not to
+    be final. Subclasses may seal segments elsewhere (see ``core.parallel``)
+    by overriding ``_seal`` and ``_ready``.
+    """
+
+    def __init__(self, key, segment_size=None, flags=0):
+        self.header = new_header(segment_size, flags)
+        self.header_bytes = pack_header(self.header)
+        self._cipher = segment_cipher(key, self.header)
+        self._compressor = compressor(flags) if is_compressed(flags) else None
+        self._buffer = bytearray()
+        self._index = 0
+        self._sealed = []
+
+    def update(self, data):
+        """Buffer ``data`` and return the segments it completes."""
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self._buffer += data
+        self._seal_full()
+        return self._ready()
+
+    def finalize(self):
+        """Return the segments left, the last of them final."""
+        if self._compressor is not None:
+            self._buffer += self._compressor.flush()
+            self._compressor = None
+            self._seal_full()
+        self._seal(bytes(self._buffer), True)
+        self._buffer = bytearray()
+        return self._ready(wait=True)
+
+    def abort(self):
+        """Drop the segments not returned yet."""
+        self._sealed = []
+
+    def _seal_full(self):
+        size = self.header.segment_size
+        while len(self._buffer) > size:
+            self._seal(bytes(self._buffer[:size]), False)
+            del self._buffer[:size]
+
+    def _seal(self, data, final):
+        self._sealed.append(encrypt_segment(self._cipher, self.header_bytes, self._index,
+                                            data, final))
+        self._index += 1
+
+    def _ready(self, wait=False):
+        """Sealed segments that can be handed out, in order; all of them with ``wait``."""
+        segments, self._sealed = self._sealed, []
+        return segments
+
+
+def read_exact(fileobj, size):
+    """Read up to ``size`` bytes, looping over short reads."""
+    parts = []
+    remaining = size
+    while remaining > 0:
+        data = fileobj.read(remaining)
+        if not data:
+            break
+        parts.append(data)
+        remaining -= len(data)
+    return b''.join(parts)
+
+
+def decrypt_stream(fileobj, key):
+    """Decrypt a blob from a binary file object, yielding plaintext segments."""
+    prefix = read_exact(fileobj, HEADER_SIZE)
+    if not is_segmented(prefix):
+        # Legacy whole-file Fernet token
+        token = prefix + fileobj.read()
+        yield Fernet(bytes(key)).decrypt(token)
+        return
+
+    header = parse_header(prefix)
+    segments = _decrypt_segments(fileobj, key, header, bytes(prefix))
+    if is_compressed(header.flags):
+        segments = decompress_stream(segments, header.flags)
+    yield from segments
+
+
+def _decrypt_segments(fileobj, key, header, header_bytes):
+    cipher = segment_cipher(key, header)
+    step = encrypted_segment_size(header.segment_size)
+
+    index = 0
+    current = read_exact(fileobj, step)
+    while True:
+        following = read_exact(fileobj, step)
+        final = not following
+        yield decrypt_segment(cipher, header_bytes, index, current, final)
+        if final:
+            return
+        index += 1
+        current = following
+
+
+def decrypt_range(fileobj, key, start, stop):
+    """Yield plaintext bytes [start, stop), decrypting only the covering segments."""
+    prefix = read_exact(fileobj, HEADER_SIZE)
+    if not is_segmented(prefix):
+        # Legacy tokens can't be seeked into
+        token = prefix + fileobj.read()
+        yield Fernet(bytes(key)).decrypt(token)[start:stop]
+        return
+
+    header = parse_header(prefix)
+    header_bytes = bytes(prefix)
+    if is_compressed(header.flags):
+        # Compressed offsets aren't known, so decompress from the start
+        plaintext = decompress_stream(_decrypt_segments(fileobj, key, header, header_bytes),
+                                      header.flags)
+        yield from slice_stream(plaintext, start, stop)
+        return
+
+    cipher = segment_cipher(key, header)
+    size = header.segment_size
+    step = encrypted_segment_size(size)
+
+    fileobj.seek(0, os.SEEK_END)
+    last_index = segment_count(fileobj.tell(), size) - 1
+
+    first = start // size
+    fileobj.seek(segment_offset(first, size))
+    for index in range(first, min((stop - 1) // size, last_index) + 1):
+        data = read_exact(fileobj, step)
+        plain = decrypt_segment(cipher, header_bytes, index, data, index == last_index)
+        base = index * size
+        yield plain[max(start - base, 0):stop - base]
+
+
+def slice_stream(chunks, start, stop):
+    """Yield bytes [start, stop) of the concatenation of ``chunks``."""
+    position = 0
+    for chunk in chunks:
+        end = position + len(chunk)
+        if end > start:
+            yield chunk[max(start - position, 0):stop - position]
+        position = end
+        if position >= stop:
+            return
+
+
+def blob_size(plaintext_length, segment_size):
+    """Size on disk of a blob holding ``plaintext_length`` bytes."""
+    segments = max(1, -(-plaintext_length // segment_size))
+    return HEADER_SIZE + plaintext_length + segments * TAG_SIZE
+
+
+def encrypt_segments(key, header_bytes, first_index, data, final_index):
+    """
+    Encrypt plaintext that starts at segment ``first_index`` of a blob.
+
+    Lets independent parts of one blob (e.g. upload chunks covering whole
+    segments) be encrypted separately and in any order.
+    """
+    header = parse_header(header_bytes)
+    cipher = segment_cipher(key, header)
+    size = header.segment_size
+    if not data:
+        yield encrypt_segment(cipher, header_bytes, first_index, b'', first_index == final_index)
+        return
+    for offset in range(0, len(data), size):
+        index = first_index + offset // size
+        yield encrypt_segment(cipher, header_bytes, index, data[offset:offset + size],
+                              index == final_index)
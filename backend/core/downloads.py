@@ -0,0 +1,162 @@
+import secrets
+import urllib.parse
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+from .etags import content_etag, etag_matches, not_modified, set_etag
+from .streams import stream_body
+from .utils import iter_decrypted_file, iter_decrypted_range
+
+# Requests asking for more (coalesced) ranges than this get the whole file
+MAX_RANGES = 16
+
+
+def content_disposition(filename):
+    """Build an attachment Content-Disposition header for any filename."""
+    # URL encode the filename to handle special characters
+    encoded_filename = urllib.parse.quote(filename)
+    return f'attachment; filename="{encoded_filename}"; filename*=UTF-8\'\'{encoded_filename}'
+
+
+def parse_range_header(header, size):
+    """
+    Parse a Range header against a resource of ``size`` bytes.
+
+    Returns a sorted list of coalesced half-open ``(start, stop)`` ranges,
+    an empty list if none of them is satisfiable, or None if the header is
+    malformed and should be ignored.
+    """
+    units, _, specs = header.partition('=')
+    if units.strip().lower() != 'bytes' or not specs.strip():
+        return None
+
+    ranges = []
+    for spec in specs.split(','):
+        first, dash, last = spec.strip().partition('-')
+        if not dash:
+            return None
+        try:
+            if not first:
+                # Suffix range: the last N bytes
+                length = int(last)
+                if length <= 0:
+                    continue
+                ranges.append((max(size - length, 0), size))
+                continue
+            start = int(first)
+            stop = int(last) + 1 if last else None
+        except ValueError:
+            return None
+        if start < 0 or (stop is not None and stop <= start):
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(stop or size, size)))
+
+    # Merge overlapping and adjacent ranges
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def last_modified(file):
+    """Stored blobs are immutable, so the upload time is a strong validator."""
+    return int(file.uploaded_at.timestamp())
+
+
+def if_range_matches(request, file):
+    """Check an If-Range precondition; a failed one means serving the full file."""
+    value = request.META.get('HTTP_IF_RANGE')
+    if not value:
+        return True
+    if value.startswith('W/'):
+        # If-Range needs a strong validator
+        return False
+    if value.startswith('"'):
+        return value == content_etag(file)
+    return parse_http_date_safe(value) == last_modified(file)
+
+
+def _range_response(request, file, start, stop):
+    response = StreamingHttpResponse(
+        stream_body(request, iter_decrypted_range(file, start, stop)),
+        status=206,
+        content_type=file.content_type
+    )
+    response['Content-Range'] = f'bytes {start}-{stop - 1}/{file.size}'
+    response['Content-Length'] = stop - start
+    return response
+
+
+def _multipart_range_response(request, file, ranges):
+    boundary = secrets.token_hex(16)
+    heads = [
+        (
+            f'\r\n--{boundary}\r\n'
+            f'Content-Type: {file.content_type}\r\n'
+            f'Content-Range: bytes {start}-{stop - 1}/{file.size}\r\n\r\n'
+        ).encode()
+        for start, stop in ranges
+    ]
+    tail = f'\r\n--{boundary}--\r\n'.encode()
+
+    def parts():
+        for head, (start, stop) in zip(heads, ranges):
+            yield head
+            yield from iter_decrypted_range(file, start, stop)
+        yield tail
+
+    response = StreamingHttpResponse(
+        stream_body(request, parts()),
+        status=206,
+        content_type=f'multipart/byteranges; boundary={boundary}'
+    )
+    response['Content-Length'] = (
+        sum(len(head) for head in heads)
+        + sum(stop - start for start, stop in ranges)
+        + len(tail)
+    )
+    return response
+
+
+def build_download_response(request, file):
+    """
+    Stream a decrypted file to the client segment by segment.
+
+    Honours Range and If-Range: partial requests only decrypt the segments
+    covering the requested bytes and are answered with 206 (multipart for
+    several ranges) or 416 when nothing is satisfiable. A current
+    If-None-Match gets 304 without opening the blob. Under ASGI the body
+    is streamed from the event loop (see ``core.streams``).
+    """
+    etag = content_etag(file)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+
+    ranges = None
+    header = request.META.get('HTTP_RANGE')
+    if header and file.size and if_range_matches(request, file):
+        ranges = parse_range_header(header, file.size)
+
+    if ranges == []:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{file.size}'
+    elif ranges and len(ranges) == 1:
+        response = _range_response(request, file, *ranges[0])
+    elif ranges and len(ranges) <= MAX_RANGES:
+        response = _multipart_range_response(request, file, ranges)
+    else:
+        response = StreamingHttpResponse(
+            stream_body(request, iter_decrypted_file(file)),
+            content_type=file.content_type
+        )
+        # The plaintext size is known up front, so clients get a real progress bar
+        response['Content-Length'] = file.size
+
+    response['Content-Disposition'] = content_disposition(file.name)
+    response['Accept-Ranges'] = 'bytes'
+    response['Last-Modified'] = http_date(last_modified(file))
+    return set_etag(response, etag)
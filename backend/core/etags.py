@@ -0,0 +1,200 @@
+"""
+Entity tags for conditional GETs of the file, share and link lists and of
+downloads and previews.
+
+List tags are derived from the user's ``ListVersion``. Signal receivers
+bump it, in the writing transaction, for every user whose lists a change
+to a file, share or link shows up in. Bulk writes that bypass signals
+bump explicitly. A matching ``If-None-Match`` costs one primary key
+lookup instead of the list query and its serialization. The version is
+read before the list, so a tag can never claim newer data than the body
+it comes with.
+
+The links list also shows access counts and whether each link is still
+valid. Claiming and returning accesses (``core.links``) bump the lists
+of the link's creator and file owner, since those updates bypass signals.
+Expiry happens without any write, so ``ListVersion`` also keeps the
+earliest upcoming expiry among the user's links; the first tag computed
+after it passes bumps the version and looks up the next one.
+
+Download tags come from the stored content: the plaintext SHA-256, or for
+files stored without one the blob name, which is never reused for other
+content. A match is answered before storage or crypto is touched.
+"""
+import hashlib
+from datetime import datetime
+
+from django.db.models import F, Min, Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
+
+from .models import EncryptedFile, FileShare, ListVersion, ShareableLink, User
+
+
+def bump(user_ids):
+    """Invalidate the lists of ``user_ids``."""
+    user_ids = {pk for pk in user_ids if pk is not None}
+    if not user_ids:
+        return
+    ListVersion.objects.bulk_create(
+        [ListVersion(user_id=pk) for pk in user_ids], ignore_conflicts=True
+    )
+    ListVersion.objects.filter(user_id__in=user_ids).update(version=F('version') + 1)
+
+
+def bump_files(file_ids):
+    """Invalidate the lists of the owners of ``file_ids`` and the users they are shared with."""
+    owners = EncryptedFile.objects.filter(pk__in=file_ids).values_list('owner_id', flat=True)
+    recipients = FileShare.objects.filter(file_id__in=file_ids).values_list('shared_with_id', flat=True)
+    bump({*owners, *recipients})
+
+
+def bump_links(link_ids):
+    """Invalidate the lists showing the access counts of ``link_ids``."""
+    rows = ShareableLink.objects.filter(pk__in=link_ids).values_list('created_by_id', 'file__owner_id')
+    bump({pk for row in rows for pk in row})
+
+
+def note_expiry(user_ids, expires_at):
+    """Have the lists of ``user_ids`` change once a link expires at ``expires_at``."""
+    if expires_at <= datetime.now():
+        return
+    ListVersion.objects.filter(user_id__in=user_ids).filter(
+        Q(next_expiry__isnull=True) | Q(next_expiry__gt=expires_at)
+    ).update(next_expiry=expires_at)
+
+
+def current_version(user):
+    row = ListVersion.objects.filter(user_id=user.pk).values_list('version', 'next_expiry').first()
+    if row is None:
+        return 0
+    version, next_expiry = row
+    if next_expiry is not None and next_expiry <= datetime.now():
+        return _expire(user.pk, next_expiry)
+    return version
+
+
+def _expire(user_id, passed):
+    """A link in the user's lists expired: bump the version and track the next expiry."""
+    upcoming = ShareableLink.objects.filter(
+        Q(created_by_id=user_id) | Q(file__owner_id=user_id), expires_at__gt=datetime.now()
+    ).aggregate(next_expiry=Min('expires_at'))['next_expiry']
+    # Of several concurrent requests only one bumps
+    ListVersion.objects.filter(user_id=user_id, next_expiry=passed).update(
+        version=F('version') + 1, next_expiry=upcoming
+    )
+    return ListVersion.objects.filter(user_id=user_id).values_list('version', flat=True).first() or 0
+
+
+def _file_owner_id(instance):
+    if type(instance).file.is_cached(instance):
+        return instance.file.owner_id
+    return EncryptedFile.objects.filter(pk=instance.file_id).values_list('owner_id', flat=True).first()
+
+
+@receiver(post_save, sender=EncryptedFile)
+def file_saved(sender, instance, created, **kwargs):
+    if created:
+        bump([instance.owner_id])
+    else:
+        bump_files([instance.pk])
+
+
+@receiver(post_delete, sender=EncryptedFile)
+def file_deleted(sender, instance, **kwargs):
+    # Its shares are deleted (and signalled) first
+    bump([instance.owner_id])
+
+
+@receiver(post_save, sender=FileShare)
+@receiver(post_delete, sender=FileShare)
+def share_changed(sender, instance, **kwargs):
+    bump([_file_owner_id(instance), instance.shared_with_id])
+
+
+@receiver(post_save, sender=ShareableLink)
+def link_saved(sender, instance, **kwargs):
+    user_ids = [_file_owner_id(instance), instance.created_by_id]
+    bump(user_ids)
+    note_expiry(user_ids, instance.expires_at)
+
+
+@receiver(post_delete, sender=ShareableLink)
+def link_deleted(sender, instance, **kwargs):
+    bump([_file_owner_id(instance), instance.created_by_id])
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, **kwargs):
+    changed = getattr(instance, '_changed_fields', None)
+    if created or (changed is not None and not changed.intersection(User.LISTED_FIELDS)):
+        # Logins and the like leave everyone's lists as they were
+        return
+    # The user is nested in the lists of everyone they share with
+    recipients = FileShare.objects.filter(file__owner=instance).values_list('shared_with_id', flat=True)
+    owners = FileShare.objects.filter(shared_with=instance).values_list('file__owner_id', flat=True)
+    bump({instance.pk, *recipients, *owners})
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    ListVersion.objects.filter(user_id=instance.pk).delete()
+
+
+def make_etag(*parts):
+    return quote_etag(hashlib.sha256(':'.join(map(str, parts)).encode()).hexdigest()[:32])
+
+
+def list_etag(request, scope, *extra):
+    """Tag for ``scope``'s list as the request's user would get it."""
+    user = request.user
+    return make_etag(scope, user.pk, user.role, current_version(user),
+                     request.get_full_path(), request.accepted_media_type, *extra)
+
+
+def content_etag(encrypted_file, *extra):
+    """Strong validator for a file's content (and anything derived from it by ``extra``)."""
+    identity = encrypted_file.sha256 or f'blob:{encrypted_file.file.name}'
+    if not extra and encrypted_file.sha256:
+        return quote_etag(encrypted_file.sha256)
+    return make_etag(identity, *extra)
+
+
+def etag_matches(request, etag):
+    """True if ``If-None-Match`` lists ``etag`` (weak comparison) or is ``*``."""
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    tags = parse_etags(header)
+    return '*' in tags or any(tag.removeprefix('W/') == etag for tag in tags)
+
+
+def not_modified(etag):
+    return set_etag(HttpResponseNotModified(), etag)
+
+
+def set_etag(response, etag):
+    response['ETag'] = etag
+    # Cached copies are per user and always revalidated
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+class ConditionalListMixin:
+    """Answer list requests whose ``If-None-Match`` is still current with 304."""
+    list_scope = None
+
+    def get_list_etag(self, request):
+        """The list's tag; None to skip conditional handling."""
+        return list_etag(request, self.list_scope)
+
+    def list(self, request, *args, **kwargs):
+        etag = self.get_list_etag(request)
+        if etag is None:
+            return super().list(request, *args, **kwargs)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        return set_etag(super().list(request, *args, **kwargs), etag)
@@ -0,0 +1,312 @@
+"""
+Garbage collection of expired links, abandoned uploads and orphaned blobs.
+
+Everything is done in batches of ``GC_BATCH_SIZE``, each in its own short
+statement or transaction, so a collection never holds locks that requests
+wait on and can be stopped at any point. :func:`collect` runs every pass
+and returns a Counter of what was reclaimed; it runs as the ``gc.collect``
+job every ``GC_INTERVAL`` seconds and from ``manage.py collect_garbage``.
+
+Blobs are written before the row that refers to them is committed, so
+only blobs older than ``GC_GRACE_PERIOD`` can be orphans. The same holds
+for cached previews under ``previews/``. The blob store is listed once per
+collection; that listing finds both the orphaned blobs and the rows whose
+blob is missing. Such rows are reported, but only deleted with
+``GC_DELETE_ORPHAN_ROWS``: a missing blob is as likely to be a storage
+outage as a lost file, and deleting the row takes its shares and links
+with it.
+"""
+import logging
+import os
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db.models import F, Max, Q
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .blobstore import BLOB_PREFIX, LEGACY_PREFIX, get_blob_store
+from .models import EncryptedFile, PreviewCacheEntry, ShareableLink, UploadSession
+from .uploads import abort_upload_session
+
+logger = logging.getLogger(__name__)
+
+UPLOADS_DIR = 'uploads'
+PREVIEWS_DIR = 'previews'
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _batch_size():
+    return _setting('GC_BATCH_SIZE', 500)
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def delete_dead_links(dry_run=False):
+    """Delete links that expired or ran out of accesses over ``GC_LINK_RETENTION`` seconds ago."""
+    cutoff = timezone.now() - timedelta(seconds=_setting('GC_LINK_RETENTION', 24 * 3600))
+    dead = ShareableLink.objects.filter(
+        Q(expires_at__lt=cutoff) |
+        # max_access may have been raised since
+        Q(exhausted_at__lt=cutoff, access_count__gte=F('max_access'))
+    )
+    if dry_run:
+        return dead.count()
+    deleted = 0
+    while True:
+        pks = list(dead.order_by().values_list('pk', flat=True)[:_batch_size()])
+        if not pks:
+            return deleted
+        deleted += ShareableLink.objects.filter(pk__in=pks).delete()[0]
+
+
+def _abandoned_sessions():
+    cutoff = timezone.now() - timedelta(seconds=_setting('UPLOAD_SESSION_TTL', 24 * 3600))
+    # Age counts from the last chunk, so slow uploads in progress are kept
+    return UploadSession.objects.annotate(
+        last_activity=Coalesce(Max('chunks__received_at'), 'created_at')
+    ).filter(last_activity__lt=cutoff)
+
+
+def delete_abandoned_sessions(dry_run=False):
+    """Abort resumable uploads that received nothing for ``UPLOAD_SESSION_TTL`` seconds."""
+    sessions = _abandoned_sessions()
+    if dry_run:
+        return sessions.count()
+    deleted = 0
+    while True:
+        batch = list(sessions.order_by()[:_batch_size()])
+        if not batch:
+            return deleted
+        for session in batch:
+            abort_upload_session(session)
+        deleted += len(batch)
+
+
+def sweep_upload_files(dry_run=False):
+    """
+    Delete partial blobs under ``uploads/`` that no session owns and that
+    weren't written to for ``UPLOAD_SESSION_TTL`` seconds.
+
+    These are left by interrupted direct uploads and by sessions whose
+    completion failed half-way. Returns ``(files, bytes)``.
+    """
+    cutoff = time.time() - _setting('UPLOAD_SESSION_TTL', 24 * 3600)
+    try:
+        root = default_storage.path(UPLOADS_DIR)
+    except NotImplementedError:
+        return 0, 0
+    if not os.path.isdir(root):
+        return 0, 0
+
+    files = reclaimed = 0
+    for user_dir in os.scandir(root):
+        if not user_dir.is_dir():
+            continue
+        stale = {}
+        for entry in os.scandir(user_dir.path):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.is_file() and stat.st_mtime < cutoff:
+                stale[entry.path] = (entry.name.split('.', 1)[0], stat.st_size)
+        live = {
+            str(pk) for pk in UploadSession.objects.filter(
+                pk__in=[stem for stem, _ in stale.values() if _is_uuid(stem)]
+            ).values_list('pk', flat=True)
+        }
+        for path, (stem, size) in stale.items():
+            if stem in live:
+                continue
+            if not dry_run:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+            files += 1
+            reclaimed += size
+        if not dry_run:
+            try:
+                os.rmdir(user_dir.path)
+            except OSError:
+                # Not empty
+                pass
+    return files, reclaimed
+
+
+def _is_uuid(value):
+    try:
+        uuid.UUID(value)
+    except ValueError:
+        return False
+    return True
+
+
+def sweep_preview_files(dry_run=False):
+    """
+    Delete cached previews under ``previews/`` older than ``GC_GRACE_PERIOD``
+    that no PreviewCacheEntry refers to.
+
+    These are left when a render's entry couldn't be created or its file
+    couldn't be removed with the entry. Returns ``(files, bytes)``.
+    """
+    cutoff = time.time() - _setting('GC_GRACE_PERIOD', 24 * 3600)
+    try:
+        root = default_storage.path(PREVIEWS_DIR)
+    except NotImplementedError:
+        return 0, 0
+    if not os.path.isdir(root):
+        return 0, 0
+
+    def candidates():
+        for file_dir in os.scandir(root):
+            if not file_dir.is_dir():
+                continue
+            for entry in os.scandir(file_dir.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.is_file() and stat.st_mtime < cutoff:
+                    name = f'{PREVIEWS_DIR}/{file_dir.name}/{entry.name}'
+                    yield name, entry.path, stat.st_size
+
+    files = reclaimed = 0
+    for batch in _batches(candidates(), _batch_size()):
+        referenced = set(PreviewCacheEntry.objects.filter(
+            path__in=[name for name, _, _ in batch]
+        ).values_list('path', flat=True))
+        for name, path, size in batch:
+            if name in referenced:
+                continue
+            if not dry_run:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+            files += 1
+            reclaimed += size
+    if not dry_run:
+        for file_dir in os.scandir(root):
+            try:
+                os.rmdir(file_dir.path)
+            except OSError:
+                # Not empty
+                pass
+    return files, reclaimed
+
+
+def list_blobs(store=None):
+    """
+    ``{name: (size, mtime)}`` for every blob in the store, with the time the
+    listing started; shared by the orphan passes of a collection.
+    """
+    store = store or get_blob_store()
+    started = time.time()
+    blobs = {}
+    for prefix in (BLOB_PREFIX, LEGACY_PREFIX):
+        for name, size, mtime in store.list(prefix):
+            blobs[name] = (size, mtime)
+    return blobs, started
+
+
+def delete_orphan_blobs(dry_run=False, listing=None):
+    """
+    Delete blobs older than ``GC_GRACE_PERIOD`` that no file refers to.
+
+    The names from ``listing`` (see :func:`list_blobs`) are checked against
+    the table a batch at a time. Returns ``(blobs, bytes)``.
+    """
+    store = get_blob_store()
+    blobs_by_name, _ = listing or list_blobs(store)
+    cutoff = time.time() - _setting('GC_GRACE_PERIOD', 24 * 3600)
+    candidates = (
+        (name, size) for name, (size, mtime) in blobs_by_name.items() if mtime < cutoff
+    )
+    blobs = reclaimed = 0
+    for batch in _batches(candidates, _batch_size()):
+        referenced = set(EncryptedFile.objects.filter(
+            file__in=[name for name, _ in batch]
+        ).values_list('file', flat=True))
+        for name, size in batch:
+            if name in referenced:
+                continue
+            if not dry_run:
+                try:
+                    store.delete(name)
+                except Exception:
+                    logger.exception("Could not delete orphaned blob %s", name)
+                    continue
+            blobs += 1
+            reclaimed += size
+    return blobs, reclaimed
+
+
+def find_orphan_rows(delete=None, dry_run=False, listing=None):
+    """
+    Ids of files whose blob is missing; deleted as well with ``delete``.
+
+    Rows are compared against the names in ``listing``. Only rows uploaded
+    before the listing started can be judged by it, and the few names it
+    lacks are confirmed against the store before they count as missing.
+    """
+    if delete is None:
+        delete = _setting('GC_DELETE_ORPHAN_ROWS', False)
+    store = get_blob_store()
+    blobs_by_name, started = listing or list_blobs(store)
+    listed_before = datetime.fromtimestamp(started)
+    if settings.USE_TZ:
+        listed_before = timezone.make_aware(listed_before)
+    missing = []
+    last_pk = None
+    while True:
+        rows = EncryptedFile.objects.filter(uploaded_at__lt=listed_before)
+        rows = rows.order_by('pk').values_list('pk', 'file')
+        if last_pk is not None:
+            rows = rows.filter(pk__gt=last_pk)
+        batch = list(rows[:_batch_size()])
+        if not batch:
+            break
+        last_pk = batch[-1][0]
+        orphans = [
+            pk for pk, name in batch
+            if name not in blobs_by_name and not store.exists(name)
+        ]
+        if orphans and delete and not dry_run:
+            EncryptedFile.objects.filter(pk__in=orphans).delete()
+        missing.extend(orphans)
+    for pk in missing:
+        logger.warning("File %s has no blob%s", pk, " (deleted)" if delete and not dry_run else "")
+    return missing
+
+
+def collect(dry_run=False, delete_orphan_rows=None):
+    """Run every pass; returns a Counter of what was (or would be) reclaimed."""
+    report = Counter()
+    report['links'] = delete_dead_links(dry_run)
+    report['upload_sessions'] = delete_abandoned_sessions(dry_run)
+    report['upload_files'], report['upload_bytes'] = sweep_upload_files(dry_run)
+    report['preview_files'], report['preview_bytes'] = sweep_preview_files(dry_run)
+    listing = list_blobs()
+    report['orphan_blobs'], report['orphan_blob_bytes'] = delete_orphan_blobs(dry_run, listing)
+    report['orphan_rows'] = len(find_orphan_rows(delete_orphan_rows, dry_run, listing))
+    logger.info("Garbage collection%s: %s", " (dry run)" if dry_run else "",
+                ", ".join(f"{key}={value}" for key, value in report.items()))
+    return report
@@ -0,0 +1,357 @@
+"""
+Database-backed background jobs.
+
+Work that doesn't have to finish before the response (preview rendering,
+reclaiming storage, ...) is queued as a ``Job`` row with :func:`enqueue`
+and run by a named handler registered with :func:`register` (the handlers
+live in ``core.tasks``). There is no broker: the row is written in the
+caller's transaction, so a job exists exactly when the work that asked
+for it was committed, and workers claim jobs with one conditional UPDATE,
+so any number of threads and processes can share the table.
+
+Jobs run in priority order (higher first), then by ``run_at``. A job that
+raises is retried with exponential backoff until ``max_attempts``, after
+which it is left ``failed`` with its last error. While a job runs, its
+worker refreshes the lock every ``JOBS_HEARTBEAT_INTERVAL`` seconds; a
+job whose worker died stops getting refreshed and is put back in the
+queue once its lock is older than ``JOBS_LOCK_TIMEOUT``, however long
+the job itself would take. Enqueueing with an ``idempotency key`` that is
+already in the table returns the existing job instead of adding one.
+
+Handlers registered with ``every=seconds`` are also queued periodically by
+the maintenance loop; the idempotency key names the period, so however
+many processes run the loop, each period gets one job.
+
+``JOBS_MODE`` picks who runs the jobs:
+
+``thread``
+    A small pool of threads in every web process (``JOBS_THREADS``),
+    woken when a job is committed. Server entrypoints set
+    ``JOBS_AUTOSTART=1`` to start it with the app, so its maintenance
+    loop recovers stale jobs and schedules the periodic ones even in
+    processes that never enqueue anything; management commands and tests
+    leave it unset.
+``worker``
+    Only ``manage.py run_jobs`` processes; web processes just enqueue.
+``inline``
+    Right after the enqueueing transaction commits, in the same thread
+    (development and tests).
+"""
+import atexit
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HIGH = 10
+PRIORITY_NORMAL = 0
+PRIORITY_LOW = -10
+
+_handlers = {}
+_periodic = {}
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def register(name, every=None):
+    """
+    Register the decorated function as the handler for jobs called ``name``.
+
+    With ``every`` (seconds), a job without payload is also queued once
+    per period.
+    """
+    def decorator(fn):
+        _handlers[name] = fn
+        if every:
+            _periodic[name] = every
+        return fn
+    return decorator
+
+
+def enqueue(name, payload=None, *, priority=PRIORITY_NORMAL, key=None, delay=0,
+            max_attempts=None):
+    """
+    Queue job ``name`` with ``payload`` (JSON-serializable keyword arguments).
+
+    The job becomes visible to workers when the current transaction
+    commits. Returns the Job, or the existing one for a known ``key``.
+    """
+    if name not in _handlers:
+        raise ValueError(f"No job handler registered for {name!r}")
+    job, created = _create(name, payload, priority, key, delay, max_attempts)
+    if created:
+        transaction.on_commit(lambda: runner.notify(job.pk))
+    return job
+
+
+def _create(name, payload, priority, key, delay, max_attempts):
+    fields = dict(
+        name=name,
+        payload=payload or {},
+        priority=priority,
+        run_at=timezone.now() + timedelta(seconds=delay),
+        max_attempts=max_attempts or _setting('JOBS_MAX_ATTEMPTS', 5),
+    )
+    if key is None:
+        return Job.objects.create(**fields), True
+    try:
+        with transaction.atomic():
+            return Job.objects.get_or_create(idempotency_key=key, defaults=fields)
+    except IntegrityError:
+        # Lost a race with another enqueue of the same key
+        return Job.objects.get(idempotency_key=key), False
+
+
+def schedule_periodic():
+    """Queue the current period's job of every periodic handler that lacks one."""
+    now = time.time()
+    for name, every in _periodic.items():
+        # Picked up by polling workers; no need to wake a pool here
+        _create(name, None, PRIORITY_LOW, f'{name}@{int(now // every)}', 0, None)
+
+
+def retry_delay(attempts):
+    """Seconds to wait before the next attempt: exponential with jitter, capped."""
+    base = _setting('JOBS_RETRY_BASE_DELAY', 5)
+    delay = min(base * 2 ** (attempts - 1), _setting('JOBS_RETRY_MAX_DELAY', 3600))
+    return delay * random.uniform(0.8, 1.2)
+
+
+def claim(worker_id, pk=None):
+    """Lock the next due job (or job ``pk``) for ``worker_id``; None if there is none."""
+    now = timezone.now()
+    if pk is not None:
+        candidates = [pk]
+    else:
+        candidates = list(
+            Job.objects.filter(status='queued', run_at__lte=now)
+            .order_by('-priority', 'run_at', 'pk').values_list('pk', flat=True)[:10]
+        )
+    for candidate in candidates:
+        # Only one worker's UPDATE can match a queued row
+        claimed = Job.objects.filter(pk=candidate, status='queued', run_at__lte=now).update(
+            status='running', locked_by=worker_id, locked_at=now, attempts=F('attempts') + 1
+        )
+        if claimed:
+            return Job.objects.get(pk=candidate)
+    return None
+
+
+def run(job):
+    """Run a claimed job and record the outcome."""
+    handler = _handlers.get(job.name)
+    try:
+        if handler is None:
+            raise LookupError(f"No job handler registered for {job.name!r}")
+        with heartbeat(job):
+            handler(**job.payload)
+    except Exception:
+        error = traceback.format_exc()
+        now = timezone.now()
+        if job.attempts >= job.max_attempts:
+            logger.error("Job %s failed for good after %d attempts:\n%s",
+                         job, job.attempts, error)
+            Job.objects.filter(pk=job.pk).update(
+                status='failed', last_error=error, finished_at=now, locked_by='', locked_at=None
+            )
+        else:
+            logger.warning("Job %s failed (attempt %d), retrying", job, job.attempts)
+            Job.objects.filter(pk=job.pk).update(
+                status='queued', last_error=error, locked_by='', locked_at=None,
+                run_at=now + timedelta(seconds=retry_delay(job.attempts))
+            )
+        return False
+    Job.objects.filter(pk=job.pk).update(
+        status='done', finished_at=timezone.now(), locked_by='', locked_at=None
+    )
+    return True
+
+
+@contextmanager
+def heartbeat(job):
+    """Keep refreshing the lock of a running job, so it isn't recovered as stale."""
+    stop = threading.Event()
+    thread = threading.Thread(target=_beat, args=(job, stop),
+                              name=f'job-heartbeat-{job.pk}', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _beat(job, stop):
+    interval = _setting('JOBS_HEARTBEAT_INTERVAL', 30)
+    try:
+        while not stop.wait(interval):
+            try:
+                alive = Job.objects.filter(
+                    pk=job.pk, status='running', locked_by=job.locked_by
+                ).update(locked_at=timezone.now())
+            except Exception:
+                logger.exception("Could not refresh the lock of job %s", job)
+                continue
+            if not alive:
+                logger.warning("Job %s was taken over while running", job)
+                return
+    finally:
+        connection.close()
+
+
+def maintain():
+    """Periodic upkeep: requeue stale jobs, prune old ones and queue periodic jobs."""
+    recover_stale()
+    prune_finished()
+    schedule_periodic()
+
+
+def recover_stale():
+    """Requeue running jobs whose worker stopped refreshing their lock."""
+    cutoff = timezone.now() - timedelta(seconds=_setting('JOBS_LOCK_TIMEOUT', 120))
+    recovered = Job.objects.filter(status='running', locked_at__lt=cutoff).update(
+        status='queued', locked_by='', locked_at=None
+    )
+    if recovered:
+        logger.warning("Requeued %d stale job(s)", recovered)
+    return recovered
+
+
+def prune_finished():
+    """Delete finished jobs older than ``JOBS_RETENTION`` seconds."""
+    cutoff = timezone.now() - timedelta(seconds=_setting('JOBS_RETENTION', 7 * 24 * 3600))
+    deleted, _ = Job.objects.filter(status__in=('done', 'failed'), finished_at__lt=cutoff).delete()
+    return deleted
+
+
+def work(worker_id, stop=None, wake=None):
+    """Claim and run due jobs until ``stop`` is set; returns when idle if ``stop`` is None."""
+    poll_interval = _setting('JOBS_POLL_INTERVAL', 1.0)
+    while stop is None or not stop.is_set():
+        close_old_connections()
+        try:
+            job = claim(worker_id)
+            if job is not None:
+                run(job)
+                continue
+        except Exception:
+            logger.exception("Job worker %s failed to claim or record a job", worker_id)
+        if stop is None:
+            return
+        if wake is not None:
+            wake.wait(poll_interval)
+            wake.clear()
+        else:
+            stop.wait(poll_interval)
+
+
+def worker_name(index=0):
+    return f'{socket.gethostname()}:{os.getpid()}:{index}'
+
+
+class JobRunner:
+    """Runs jobs on threads in this process, or inline, as ``JOBS_MODE`` says."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._maintenance = None
+        self._fork_hook = False
+
+    @property
+    def mode(self):
+        return _setting('JOBS_MODE', 'thread')
+
+    def notify(self, pk):
+        """A job was committed; run it inline or wake the pool."""
+        mode = self.mode
+        if mode == 'inline':
+            job = claim(worker_name(), pk)
+            if job is not None:
+                run(job)
+        elif mode == 'thread':
+            self.start()
+            self._wake.set()
+
+    def autostart(self):
+        """Start the pool at startup in ``thread`` mode, and again in forked children."""
+        if self.mode != 'thread' or not _setting('JOBS_AUTOSTART', False):
+            return
+        self.start()
+        if not self._fork_hook:
+            os.register_at_fork(after_in_child=self._after_fork)
+            self._fork_hook = True
+
+    def _after_fork(self):
+        # The parent's threads are gone, and the lock may have been held by one
+        self._lock = threading.Lock()
+        self.start()
+
+    def start(self, threads=None):
+        # Start lazily, and restart after a fork (e.g. preloading servers)
+        if self._threads and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._threads and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop = threading.Event()
+            count = threads or _setting('JOBS_THREADS', 2)
+            self._threads = [
+                threading.Thread(
+                    target=work, args=(worker_name(i), self._stop, self._wake),
+                    name=f'job-worker-{i}', daemon=True,
+                )
+                for i in range(count)
+            ]
+            self._maintenance = threading.Thread(
+                target=self._maintain, name='job-maintenance', daemon=True
+            )
+            for thread in self._threads + [self._maintenance]:
+                thread.start()
+
+    def _maintain(self):
+        interval = _setting('JOBS_MAINTENANCE_INTERVAL', 60)
+        while not self._stop.wait(interval):
+            close_old_connections()
+            try:
+                maintain()
+            except Exception:
+                logger.exception("Job maintenance failed")
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def shutdown(self, timeout=10):
+        """Let running jobs finish and stop the threads."""
+        if not self._threads or self._pid != os.getpid():
+            return
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+
+runner = JobRunner()
+atexit.register(runner.shutdown)
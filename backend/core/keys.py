@@ -0,0 +1,188 @@
+"""
+Envelope encryption for per-file data keys.
+
+Each file is encrypted under its own data key. What gets stored in
+``encryption_key`` is that data key wrapped (AES-256-GCM) by a versioned
+master key, so rotating the master key only rewrites these small records,
+never the blobs themselves.
+
+Master keys come from ``MASTER_KEYS`` (``{version: key}``) and/or the JSON
+keyfile at ``MASTER_KEY_FILE``; ``MASTER_KEY_VERSION`` picks the one used
+for wrapping (the highest version by default). Without any configuration
+a version 0 key is derived from ``SECRET_KEY`` so development setups work;
+it stays available after real keys are configured so its records can be
+rotated away.
+
+Rows written before envelope encryption hold a bare key; they are still
+accepted and get wrapped by the rotation command.
+"""
+import base64
+import json
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from django.conf import settings
+
+WRAP_MAGIC = b'SSKW'
+# magic, master key version, nonce
+WRAP_HEADER = struct.Struct('>4sI12s')
+WRAP_AAD = b'secure-share data key'
+
+
+def _decode_master_key(value):
+    key = base64.urlsafe_b64decode(value)
+    if len(key) != 32:
+        raise ValueError("Master keys must be 32 bytes, urlsafe base64 encoded")
+    return key
+
+
+def _load_master_keys():
+    keys = {}
+    path = getattr(settings, 'MASTER_KEY_FILE', None)
+    if path and os.path.exists(path):
+        with open(path) as f:
+            data = json.load(f)
+        for version, value in data.get('keys', {}).items():
+            keys[int(version)] = _decode_master_key(value)
+    for version, value in (getattr(settings, 'MASTER_KEYS', None) or {}).items():
+        keys[int(version)] = _decode_master_key(value)
+    if 0 not in keys:
+        keys[0] = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=b'secure-share master key v0',
+        ).derive(settings.SECRET_KEY.encode())
+    return keys
+
+
+_master_keys = None
+_master_keys_lock = threading.Lock()
+
+
+def get_master_keys():
+    """All known master keys by version."""
+    global _master_keys
+    if _master_keys is None:
+        with _master_keys_lock:
+            if _master_keys is None:
+                _master_keys = _load_master_keys()
+    return _master_keys
+
+
+def reload_master_keys():
+    """Forget loaded master keys (after editing the keyfile or settings)."""
+    global _master_keys
+    with _master_keys_lock:
+        _master_keys = None
+    key_cache.clear()
+
+
+def get_active_version():
+    """Version of the master key used for wrapping new data keys."""
+    version = getattr(settings, 'MASTER_KEY_VERSION', None)
+    keys = get_master_keys()
+    if version is None:
+        return max(keys)
+    if int(version) not in keys:
+        raise ValueError(f"Master key version {version} is not configured")
+    return int(version)
+
+
+def is_wrapped(stored):
+    return bytes(stored[:len(WRAP_MAGIC)]) == WRAP_MAGIC
+
+
+def key_version(stored):
+    """Master key version of a stored key, or None for a bare legacy key."""
+    stored = bytes(stored)
+    if not is_wrapped(stored):
+        return None
+    return WRAP_HEADER.unpack(stored[:WRAP_HEADER.size])[1]
+
+
+def wrap_key(data_key, version=None):
+    """Wrap a data key under a master key (the active one by default)."""
+    version = get_active_version() if version is None else version
+    nonce = os.urandom(12)
+    wrapped = AESGCM(get_master_keys()[version]).encrypt(nonce, bytes(data_key), WRAP_AAD)
+    return WRAP_HEADER.pack(WRAP_MAGIC, version, nonce) + wrapped
+
+
+def _unwrap(stored):
+    if not is_wrapped(stored):
+        return stored
+    _, version, nonce = WRAP_HEADER.unpack(stored[:WRAP_HEADER.size])
+    try:
+        master_key = get_master_keys()[version]
+    except KeyError:
+        raise ValueError(f"Master key version {version} is not configured")
+    try:
+        return AESGCM(master_key).decrypt(nonce, stored[WRAP_HEADER.size:], WRAP_AAD)
+    except InvalidTag:
+        raise ValueError(f"Data key failed to unwrap with master key version {version}")
+
+
+def rewrap_key(stored, version=None):
+    """Re-wrap a stored key under another master key version."""
+    return wrap_key(_unwrap(bytes(stored)), version)
+
+
+class DataKeyCache:
+    """Bounded LRU of unwrapped data keys with a time-to-live."""
+
+    def __init__(self, max_entries=1024, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, stored):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(stored)
+            if entry and entry[1] > now:
+                self._entries.move_to_end(stored)
+                self.hits += 1
+                return entry[0]
+            self._entries.pop(stored, None)
+            self.misses += 1
+        return None
+
+    def put(self, stored, data_key):
+        with self._lock:
+            self._entries[stored] = (data_key, time.monotonic() + self.ttl)
+            self._entries.move_to_end(stored)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+key_cache = DataKeyCache(
+    max_entries=getattr(settings, 'DATA_KEY_CACHE_SIZE', 1024),
+    ttl=getattr(settings, 'DATA_KEY_CACHE_TTL', 300),
+)
+
+
+def unwrap_key(stored):
+    """Return the data key for a stored (wrapped or legacy bare) key."""
+    stored = bytes(stored)
+    if not is_wrapped(stored):
+        return stored
+    data_key = key_cache.get(stored)
+    if data_key is None:
+        data_key = _unwrap(stored)
+        key_cache.put(stored, data_key)
+    return data_key
@@ -0,0 +1,204 @@
+"""
+Access counting for shareable links.
+
+Every download claims one access with a single conditional UPDATE that
+checks ``expires_at`` and ``max_access`` and increments ``access_count``
+in the same statement, so concurrent requests can neither lose
+increments nor overshoot the limit.
+
+With ``LINK_COUNTER_MODE = 'buffered'`` links that get hot (more than
+``LINK_COUNTER_HOT_THRESHOLD`` accesses per flush interval in this
+process) switch to leases: the process reserves a block of accesses with
+one conditional UPDATE and hands them out from memory. Unused accesses are
+returned every ``LINK_COUNTER_FLUSH_INTERVAL`` seconds and at exit.
+Because accesses are reserved before they are served, ``max_access`` is
+never exceeded; a crashed process at worst leaves some reserved accesses
+counted as used. The flip side is that accesses leased by one process
+but not used yet are unavailable to the others: on a link close to
+``max_access`` another process may answer 403 while some remain leased,
+until the next flush returns them.
+
+A download made of ranged requests (PDF viewers, video players) counts
+as one access. The request that claims it gets a signed range token
+(:func:`set_range_token`) in a cookie scoped to the link's download URL.
+Ranged requests carrying a valid token for the link, for
+``LINK_RANGE_TOKEN_TTL`` seconds, are served without claiming again.
+Requests without a Range header are always claimed.
+
+Every change to ``access_count`` bumps the list versions of the link's
+creator and file owner (see ``core.etags``).
+
+Refilling a lease is a database write, which may wait on the database's
+lock. Only threads claiming the same link wait for it; claims of other
+links, and lease hits, only take the in-memory lock.
+"""
+import atexit
+import logging
+import threading
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.core import signing
+from django.db import close_old_connections
+from django.db.models import Case, F, Q, Value, When
+
+from .etags import bump_links
+from .models import ShareableLink
+
+logger = logging.getLogger(__name__)
+
+
+def _valid_links(now):
+    return ShareableLink.objects.filter(expires_at__gt=now)
+
+
+def claim_access(link_id, count=1):
+    """Atomically count ``count`` accesses if the link allows them. Returns success."""
+    now = datetime.now()
+    claimed = _valid_links(now).filter(pk=link_id).filter(
+        Q(max_access__isnull=True) |
+        Q(access_count__lte=F('max_access') - count)
+    ).update(
+        access_count=F('access_count') + count,
+        exhausted_at=Case(
+            When(max_access=F('access_count') + count, then=Value(now)),
+            default=F('exhausted_at'),
+        ),
+    ) == 1
+    if claimed:
+        # Access counts are shown in the links list
+        bump_links([link_id])
+    return claimed
+
+
+def release_access(link_id, count):
+    """Give back reserved accesses that were never used."""
+    if count:
+        ShareableLink.objects.filter(pk=link_id).update(
+            access_count=F('access_count') - count, exhausted_at=None
+        )
+        bump_links([link_id])
+
+
+RANGE_TOKEN_COOKIE = 'link_range'
+_range_signer = signing.TimestampSigner(salt='core.links.range')
+
+
+def _range_token_ttl():
+    return getattr(settings, 'LINK_RANGE_TOKEN_TTL', 600)
+
+
+def has_range_token(request, link):
+    """True if ``request`` continues a download of ``link`` claimed recently."""
+    token = request.COOKIES.get(RANGE_TOKEN_COOKIE)
+    if not token:
+        return False
+    try:
+        return _range_signer.unsign(token, max_age=_range_token_ttl()) == str(link.pk)
+    except signing.BadSignature:
+        return False
+
+
+def set_range_token(response, request, link):
+    """Let the rest of this download's ranged requests through without a claim."""
+    response.set_cookie(
+        RANGE_TOKEN_COOKIE, _range_signer.sign(str(link.pk)),
+        max_age=_range_token_ttl(), path=request.path,
+        httponly=True, samesite='Lax', secure=request.is_secure(),
+    )
+    return response
+
+
+class _Lease:
+    __slots__ = ('remaining', 'hits', 'refill')
+
+    def __init__(self):
+        self.remaining = 0
+        self.hits = 0
+        # Held while the lease is refilled from the database
+        self.refill = threading.Lock()
+
+
+class LinkAccessCounter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._leases = {}
+        self._flusher = None
+
+    @property
+    def buffered(self):
+        return getattr(settings, 'LINK_COUNTER_MODE', 'atomic') == 'buffered'
+
+    def claim(self, link):
+        """Count one access to ``link``; False if it expired or is exhausted."""
+        if not self.buffered:
+            return claim_access(link.pk)
+        if link.expires_at <= datetime.now():
+            return False
+
+        self._ensure_flusher()
+        with self._lock:
+            lease = self._leases.setdefault(link.pk, _Lease())
+            lease.hits += 1
+            if lease.remaining:
+                lease.remaining -= 1
+                return True
+            hot = lease.hits > getattr(settings, 'LINK_COUNTER_HOT_THRESHOLD', 10)
+            refill = lease.refill
+
+        if hot:
+            size = getattr(settings, 'LINK_COUNTER_LEASE_SIZE', 16)
+            with refill:
+                # Another thread may have refilled while this one waited
+                if self._take_leased(link.pk):
+                    return True
+                if claim_access(link.pk, size):
+                    with self._lock:
+                        self._leases.setdefault(link.pk, _Lease()).remaining += size - 1
+                    return True
+        # Cold link, or too close to max_access for a full lease
+        if claim_access(link.pk):
+            return True
+        # A refill in flight when that failed may have taken the last
+        # accesses; wait for it to publish them
+        with refill:
+            return self._take_leased(link.pk)
+
+    def _take_leased(self, link_id):
+        with self._lock:
+            lease = self._leases.get(link_id)
+            if lease is not None and lease.remaining:
+                lease.remaining -= 1
+                return True
+        return False
+
+    def flush(self):
+        """Return unused leased accesses and reset hotness tracking."""
+        with self._lock:
+            leases, self._leases = self._leases, {}
+        for link_id, lease in leases.items():
+            release_access(link_id, lease.remaining)
+
+    def _ensure_flusher(self):
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(
+                    target=self._run, name='link-counter-flush', daemon=True
+                )
+                self._flusher.start()
+
+    def _run(self):
+        while True:
+            time.sleep(getattr(settings, 'LINK_COUNTER_FLUSH_INTERVAL', 5.0))
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Returning leased link accesses failed")
+
+
+link_counter = LinkAccessCounter()
+atexit.register(link_counter.flush)
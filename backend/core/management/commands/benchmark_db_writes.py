@@ -0,0 +1,125 @@
+import json
+import random
+import statistics
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, close_old_connections, connection
+
+from core.links import claim_access
+from core.models import AuditLog, EncryptedFile, ShareableLink, User
+
+OPERATIONS = ('audit', 'link', 'upload')
+
+
+class Command(BaseCommand):
+    help = (
+        "Hammer the configured database with concurrent writers (audit "
+        "batches, link counter updates and file inserts) and report "
+        "throughput, latency and lock errors. Run it once per "
+        "DATABASE_PROFILE to compare them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--seconds', type=float, default=10)
+        parser.add_argument('--operations', default=','.join(OPERATIONS),
+                            help='Comma separated subset of: ' + ', '.join(OPERATIONS))
+        parser.add_argument('--json', help='Also write the results to this file')
+
+    def handle(self, *args, **options):
+        operations = [op for op in options['operations'].split(',') if op]
+        for op in operations:
+            if op not in OPERATIONS:
+                raise ValueError(f"Unknown operation {op!r}")
+
+        tag = uuid.uuid4().hex[:8]
+        user = User.objects.create_user(
+            username=f'bench-{tag}', email=f'bench-{tag}@example.com', password=None
+        )
+        file = EncryptedFile.objects.create(
+            owner=user, name='bench.txt', file='bench/none', encryption_key=b'',
+            content_type='text/plain', size=0
+        )
+        link = ShareableLink.objects.create(
+            file=file, created_by=user, expires_at=datetime.now() + timedelta(days=1)
+        )
+
+        latencies = {op: [] for op in operations}
+        errors = {op: 0 for op in operations}
+        lock = threading.Lock()
+        deadline = time.monotonic() + options['seconds']
+
+        def run_operation(op):
+            if op == 'audit':
+                AuditLog.objects.bulk_create([
+                    AuditLog(user=user, action='access', details={'bench': tag},
+                             ip_address='127.0.0.1')
+                    for _ in range(20)
+                ])
+            elif op == 'link':
+                claim_access(link.pk)
+            else:
+                EncryptedFile.objects.create(
+                    owner=user, name='bench.txt', file='bench/none', encryption_key=b'',
+                    content_type='text/plain', size=0
+                )
+
+        def worker():
+            close_old_connections()
+            while time.monotonic() < deadline:
+                op = random.choice(operations)
+                started = time.perf_counter()
+                try:
+                    run_operation(op)
+                except OperationalError:
+                    with lock:
+                        errors[op] += 1
+                    continue
+                elapsed = time.perf_counter() - started
+                with lock:
+                    latencies[op].append(elapsed)
+            connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(options['workers'])]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.monotonic() - started
+
+        results = {
+            'database_profile': getattr(settings, 'DATABASE_PROFILE', 'sqlite'),
+            'vendor': connection.vendor,
+            'workers': options['workers'],
+            'seconds': round(wall, 3),
+            'operations': {},
+        }
+        for op in operations:
+            samples = sorted(latencies[op])
+            results['operations'][op] = {
+                'count': len(samples),
+                'per_second': round(len(samples) / wall, 1),
+                'errors': errors[op],
+                'p50_ms': round(statistics.median(samples) * 1000, 2) if samples else None,
+                'p95_ms': round(samples[int(len(samples) * 0.95) - 1] * 1000, 2) if samples else None,
+            }
+
+        # Clean up everything the run created
+        AuditLog.objects.filter(user=user).delete()
+        EncryptedFile.objects.filter(owner=user).delete()
+        user.delete()
+
+        for op, stats in results['operations'].items():
+            self.stdout.write(
+                f"{op:>7}: {stats['per_second']:>8} ops/s  p50 {stats['p50_ms']} ms  "
+                f"p95 {stats['p95_ms']} ms  errors {stats['errors']}"
+            )
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump(results, f, indent=2)
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from core.garbage import collect
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete expired and used-up shareable links, abandoned uploads and "
+        "blobs no file refers to, and report files whose blob is missing."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report what would be reclaimed')
+        parser.add_argument('--delete-orphan-rows', action='store_true', default=None,
+                            help='Also delete files whose blob is missing')
+
+    def handle(self, *args, **options):
+        report = collect(dry_run=options['dry_run'],
+                         delete_orphan_rows=options['delete_orphan_rows'])
+        verb = "Would reclaim" if options['dry_run'] else "Reclaimed"
+        self.stdout.write(f"{verb} {report['links']} link(s), "
+                          f"{report['upload_sessions']} upload session(s)")
+        self.stdout.write(f"{verb} {report['upload_files']} partial upload(s), "
+                          f"{report['upload_bytes']} bytes")
+        self.stdout.write(f"{verb} {report['preview_files']} cached preview(s), "
+                          f"{report['preview_bytes']} bytes")
+        self.stdout.write(f"{verb} {report['orphan_blobs']} orphaned blob(s), "
+                          f"{report['orphan_blob_bytes']} bytes")
+        if report['orphan_rows']:
+            self.stdout.write(self.style.WARNING(
+                f"{report['orphan_rows']} file(s) have no blob (ids in the log)"
+            ))
+        self.stdout.write(self.style.SUCCESS("Done"))
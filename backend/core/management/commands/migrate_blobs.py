@@ -0,0 +1,105 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from core.blobstore import blob_name, create_blob_store
+from core.etags import bump_files
+from core.models import EncryptedFile
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class Command(BaseCommand):
+    help = (
+        "Move encrypted blobs into the hashed blobs/ layout of the configured "
+        "blob store, copying several files in parallel. Rows are repointed "
+        "one at a time, so the command can be interrupted and rerun."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='source', default='local',
+                            help="Blob store holding the existing blobs (default: local)")
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--keep-source', action='store_true',
+                            help='Leave the original blobs in place')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report which files would be moved')
+
+    def handle(self, *args, **options):
+        self.source = create_blob_store(options['source'])
+        self.target = create_blob_store()
+        self.keep_source = options['keep_source']
+        same_store = type(self.source) is type(self.target)
+
+        rows = EncryptedFile.objects.order_by('uploaded_at').values_list('pk', 'file')
+        pending = [
+            (pk, name) for pk, name in rows.iterator()
+            # Within one store only blobs outside the hashed layout need moving
+            if not same_store or name != blob_name(pk)
+        ]
+        self.stdout.write(
+            f"Moving {len(pending)} blobs with {options['workers']} worker(s)"
+        )
+        if options['dry_run']:
+            for pk, name in pending:
+                self.stdout.write(f"Would move {name} -> {blob_name(pk)}")
+            return
+
+        started = time.monotonic()
+        moved = failed = total_bytes = 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            in_flight = deque()
+
+            def collect(future):
+                nonlocal moved, failed, total_bytes
+                pk, name = future.args
+                try:
+                    total_bytes += future.result()
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f"Failed {pk} ({name}): {e}")
+                    return
+                moved += 1
+                if moved % 100 == 0:
+                    self.stdout.write(f"{moved}/{len(pending)} blobs moved...")
+
+            for pk, name in pending:
+                future = executor.submit(self.move_blob, pk, name)
+                future.args = (pk, name)
+                in_flight.append(future)
+                # Bound the queue instead of submitting every row up front
+                if len(in_flight) >= options['workers'] * 4:
+                    collect(in_flight.popleft())
+            while in_flight:
+                collect(in_flight.popleft())
+
+        elapsed = time.monotonic() - started
+        rate = total_bytes / elapsed / 1024 / 1024 if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f"Moved {moved}, failed {failed} ({total_bytes} bytes, {rate:.1f} MiB/s)"
+        ))
+
+    def move_blob(self, pk, name):
+        """Copy one blob to its hashed name, repoint the row and drop the original."""
+        close_old_connections()
+        try:
+            new_name = blob_name(pk)
+            with self.source.open(name) as f:
+                size = self.target.save(new_name, iter(lambda: f.read(COPY_CHUNK_SIZE), b''))
+            if self.target.size(new_name) != size:
+                raise ValueError("Copied blob has the wrong size")
+
+            # Skip rows that changed (e.g. were re-encrypted) while copying
+            updated = EncryptedFile.objects.filter(pk=pk, file=name).update(file=new_name)
+            if not updated:
+                self.target.delete(new_name)
+                raise ValueError("File changed during the move")
+            bump_files([pk])
+            if not self.keep_source:
+                self.source.delete(name)
+            return size
+        finally:
+            close_old_connections()
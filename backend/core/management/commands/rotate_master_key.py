@@ -0,0 +1,95 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+
+from core.keys import get_active_version, get_master_keys, key_version, rewrap_key
+from core.models import EncryptedFile, UploadSession
+
+# Times a row may change under the command before it is given up on
+MAX_CONFLICTS = 3
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-wrap per-file data keys under a master key version. Only the "
+        "small key records are rewritten; encrypted blobs are untouched. "
+        "Each row is updated only if its key is still the one that was read."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--key-version', type=int,
+                            help='Target master key version (defaults to the active one)')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        version = options['key_version']
+        if version is None:
+            version = get_active_version()
+        if version not in get_master_keys():
+            raise CommandError(f"Master key version {version} is not configured")
+        batch_size = options['batch_size']
+
+        stale = EncryptedFile.objects.filter(~Q(key_version=version) | Q(key_version__isnull=True))
+        total = stale.count()
+        self.stdout.write(f"Re-wrapping {total} file keys under master key version {version}")
+
+        started = time.monotonic()
+        done = 0
+        failed_ids = set()
+        # Rows rewritten by someone else between the read and the update
+        # come back in a later batch and are retried
+        conflicts = {}
+        while True:
+            rows = list(
+                stale.exclude(pk__in=failed_ids)
+                .order_by('pk')
+                .values_list('pk', 'encryption_key')[:batch_size]
+            )
+            if not rows:
+                break
+
+            with transaction.atomic():
+                for pk, stored in rows:
+                    try:
+                        wrapped = rewrap_key(stored, version)
+                    except ValueError as e:
+                        failed_ids.add(pk)
+                        self.stderr.write(f"Skipping {pk}: {e}")
+                        continue
+                    if EncryptedFile.objects.filter(pk=pk, encryption_key=bytes(stored)).update(
+                        encryption_key=wrapped, key_version=version
+                    ):
+                        done += 1
+                        continue
+                    conflicts[pk] = conflicts.get(pk, 0) + 1
+                    if conflicts[pk] >= MAX_CONFLICTS:
+                        failed_ids.add(pk)
+                        self.stderr.write(f"Skipping {pk}: key kept changing during the rotation")
+            elapsed = time.monotonic() - started
+            self.stdout.write(
+                f"{done + len(failed_ids)}/{total} processed ({done / elapsed:.0f} keys/s)"
+            )
+
+        # Pending upload sessions carry keys too
+        sessions = rewrapped_sessions = 0
+        for pk, stored in UploadSession.objects.values_list('pk', 'encryption_key').iterator():
+            if key_version(stored) == version:
+                continue
+            sessions += 1
+            try:
+                wrapped = rewrap_key(stored, version)
+            except ValueError as e:
+                self.stderr.write(f"Skipping upload session {pk}: {e}")
+                continue
+            # A session completed or discarded meanwhile has nothing left to rewrap
+            rewrapped_sessions += UploadSession.objects.filter(
+                pk=pk, encryption_key=bytes(stored)
+            ).update(encryption_key=wrapped)
+
+        failed = len(failed_ids)
+        self.stdout.write(self.style.SUCCESS(
+            f"Re-wrapped {done} file keys and {rewrapped_sessions}/{sessions} upload session keys"
+            + (f", {failed} failed" if failed else "")
+        ))
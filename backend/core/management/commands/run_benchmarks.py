@@ -0,0 +1,117 @@
+import json
+import platform
+import subprocess
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from core.benchmarks import (
+    COMPRESSION_SIZES, DEFAULT_SCALES, DEFAULT_SIZES, SUITES, UPLOAD_SIZES, compare_results,
+)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the crypto, storage and API benchmarks and write the results as "
+        "JSON. Runs locally against the configured database (use a scratch "
+        "one) and blob store. Pass --compare with an earlier results file to "
+        "report changes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--suite', action='append', choices=sorted(SUITES),
+                            help='Suite to run; repeatable (default: all)')
+        parser.add_argument('--sizes', default=','.join(DEFAULT_SIZES),
+                            help='File sizes for the crypto suite, e.g. 1KB,1MB,1GB')
+        parser.add_argument('--compression-sizes', default=','.join(COMPRESSION_SIZES),
+                            help='File sizes for the compression suite')
+        parser.add_argument('--upload-sizes', default=','.join(UPLOAD_SIZES),
+                            help='File sizes for the upload/download endpoints')
+        parser.add_argument('--scales', default=','.join(map(str, DEFAULT_SCALES)),
+                            help='Row counts for the list suite, e.g. 1000,1000000')
+        parser.add_argument('--concurrency', default='1,8,32',
+                            help='Concurrent clients for the link suite')
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--no-memory', action='store_true',
+                            help='Skip the (slower) peak memory runs')
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--compare', help='Earlier results file to compare against')
+        parser.add_argument('--threshold', type=float, default=0.10,
+                            help='Relative slowdown reported as a regression')
+        parser.add_argument('--fail-on-regression', action='store_true')
+
+    def handle(self, *args, **options):
+        suites = options['suite'] or list(SUITES)
+        sizes = options['sizes'].split(',')
+        log = self.stdout.write
+        kwargs = {
+            'crypto': dict(sizes=sizes, repeat=options['repeat'],
+                           memory=not options['no_memory'], log=log),
+            'compression': dict(sizes=options['compression_sizes'].split(','),
+                                repeat=options['repeat'], log=log),
+            'list': dict(scales=[int(s) for s in options['scales'].split(',')],
+                         repeat=max(options['repeat'], 5), log=log),
+            'transfer': dict(sizes=options['upload_sizes'].split(','),
+                             repeat=options['repeat'], log=log),
+            'link': dict(concurrency=[int(c) for c in options['concurrency'].split(',')], log=log),
+        }
+
+        run = {
+            'commit': _git_commit(),
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': connection.vendor,
+            'database_profile': getattr(settings, 'DATABASE_PROFILE', 'sqlite'),
+            'blob_store': getattr(settings, 'BLOB_STORE', 'local'),
+            'segment_size': getattr(settings, 'ENCRYPTION_SEGMENT_SIZE', None),
+            'compression': getattr(settings, 'BLOB_COMPRESSION', 'auto'),
+            'results': [],
+        }
+        for suite in suites:
+            run['results'].extend(SUITES[suite](**kwargs[suite]))
+
+        for result in run['results']:
+            line = f"{result['name']:<48} {result['seconds'] * 1000:>10.2f} ms"
+            if 'mb_per_s' in result:
+                line += f"  {result['mb_per_s']:>9.1f} MiB/s"
+            if 'ratio' in result:
+                line += f"  stored {result['ratio']:.1%}"
+            if result.get('peak_bytes') is not None:
+                line += f"  peak {result['peak_bytes'] / 1024 / 1024:.1f} MiB"
+            if result.get('queries') is not None:
+                line += f"  {result['queries']} queries"
+            if 'requests_per_s' in result:
+                line += f"  {result['requests_per_s']:.0f} req/s, {result['failed']} failed"
+            self.stdout.write(line)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(run, f, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            rows, regressions = compare_results(baseline, run, options['threshold'])
+            self.stdout.write(f"Compared with {baseline.get('commit') or options['compare']}:")
+            for name, old, new, change in rows:
+                marker = ' <- regression' if change > options['threshold'] else ''
+                self.stdout.write(
+                    f"{name:<48} {old * 1000:>10.2f} -> {new * 1000:>10.2f} ms "
+                    f"({change:+.1%}){marker}"
+                )
+            if regressions and options['fail_on_regression']:
+                raise CommandError(f"{len(regressions)} benchmark(s) regressed")
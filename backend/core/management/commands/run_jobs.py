@@ -0,0 +1,53 @@
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.jobs import maintain, prune_finished, recover_stale, schedule_periodic, work, worker_name
+
+
+class Command(BaseCommand):
+    help = (
+        "Run background jobs from the job table. Any number of these "
+        "processes can run side by side; use it with JOBS_MODE=worker so "
+        "the web processes only enqueue."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=None,
+                            help='Jobs run concurrently by this process (default: JOBS_THREADS)')
+        parser.add_argument('--once', action='store_true',
+                            help='Run the jobs that are due and exit')
+
+    def handle(self, *args, **options):
+        recovered = recover_stale()
+        pruned = prune_finished()
+        self.stdout.write(f"Requeued {recovered} stale job(s), pruned {pruned} finished job(s)")
+        schedule_periodic()
+
+        if options['once']:
+            work(worker_name())
+            self.stdout.write(self.style.SUCCESS("No jobs left to run"))
+            return
+
+        stop = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            # Finish the jobs in hand, then exit
+            signal.signal(signum, lambda *_: stop.set())
+
+        threads = [
+            threading.Thread(target=work, args=(worker_name(i), stop), name=f'job-worker-{i}')
+            for i in range(options['threads'] or getattr(settings, 'JOBS_THREADS', 2))
+        ]
+        for thread in threads:
+            thread.start()
+        self.stdout.write(f"Running jobs on {len(threads)} thread(s)")
+        while not stop.wait(getattr(settings, 'JOBS_MAINTENANCE_INTERVAL', 60)):
+            try:
+                maintain()
+            except Exception as e:
+                self.stderr.write(f"Job maintenance failed: {e}")
+        for thread in threads:
+            thread.join()
+        self.stdout.write(self.style.SUCCESS("Job workers stopped"))
@@ -0,0 +1,244 @@
+"""
+Per-request performance instrumentation.
+
+``MetricsMiddleware`` attaches a :class:`RequestMetrics` to the request's
+context. Code on the hot paths marks its phases with :func:`timed`,
+:func:`timed_iter` and :class:`TimedReader`; phases nest, and each one is
+charged only its exclusive time (storage reads made while decrypting count
+as storage, not crypto). Database queries are timed through a connection
+execute wrapper.
+
+When the response is closed (after a streamed body has been sent) the
+totals are folded into process-wide histograms served in Prometheus text
+format by the ``/metrics`` endpoint. With ``SERVER_TIMING`` on, the phases
+measured before the response is returned are also sent in a
+``Server-Timing`` header. Outside a request every hook is a single
+context variable lookup.
+"""
+import bisect
+import contextvars
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+PHASES = ('db', 'crypto', 'storage', 'sniff', 'serialize', 'preview')
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+_END = object()
+
+
+class RequestMetrics:
+    """Exclusive time per phase and counters for one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations = defaultdict(float)
+        self.counts = defaultdict(int)
+        self._stack = []
+
+    def start(self, phase):
+        self._stack.append([phase, time.perf_counter(), 0.0])
+
+    def stop(self):
+        phase, started, nested = self._stack.pop()
+        elapsed = time.perf_counter() - started
+        self.durations[phase] += elapsed - nested
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    def add(self, counter, amount=1):
+        self.counts[counter] += amount
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """Value for a Server-Timing header, durations in milliseconds."""
+        entries = []
+        for phase in PHASES:
+            if phase not in self.durations:
+                continue
+            entry = f'{phase};dur={self.durations[phase] * 1000:.2f}'
+            if phase == 'db':
+                entry += f';desc="{self.counts["db_queries"]} queries"'
+            elif phase == 'storage' and self.counts['storage_bytes']:
+                entry += f';desc="{self.counts["storage_bytes"]} bytes"'
+            entries.append(entry)
+        entries.append(f'total;dur={self.elapsed() * 1000:.2f}')
+        return ', '.join(entries)
+
+
+def current_metrics():
+    return _current.get()
+
+
+def activate(metrics):
+    _current.set(metrics)
+
+
+@contextmanager
+def timed(phase):
+    """Charge the enclosed block to ``phase`` of the current request."""
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    metrics.start(phase)
+    try:
+        yield
+    finally:
+        metrics.stop()
+
+
+def timed_iter(phase, iterator):
+    """Yield from ``iterator``, charging the time spent producing items to ``phase``."""
+    metrics = _current.get()
+    if metrics is None:
+        yield from iterator
+        return
+    iterator = iter(iterator)
+    try:
+        while True:
+            metrics.start(phase)
+            try:
+                item = next(iterator, _END)
+            finally:
+                metrics.stop()
+            if item is _END:
+                return
+            yield item
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close()
+
+
+def count(counter, amount=1):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add(counter, amount)
+
+
+class TimedReader:
+    """File object wrapper charging reads to the ``storage`` phase."""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+    def read(self, size=-1):
+        with timed('storage'):
+            data = self._fileobj.read(size)
+        count('storage_bytes', len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._fileobj.close()
+
+
+def db_execute_wrapper(execute, sql, params, many, context):
+    with timed('db'):
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            count('db_queries')
+
+
+class Histogram:
+    def __init__(self, name, help, buckets, labels):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.labels = labels
+        # label values -> [per-bucket counts..., +Inf count], sum
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for label_values, (counts, total) in sorted(self._series.items()):
+            labels = ','.join(f'{k}="{v}"' for k, v in zip(self.labels, label_values))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total}')
+            lines.append(f'{self.name}_count{{{labels}}} {cumulative}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._series = defaultdict(float)
+
+    def inc(self, amount, *label_values):
+        self._series[label_values] += amount
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for label_values, value in sorted(self._series.items()):
+            labels = ','.join(f'{k}="{v}"' for k, v in zip(self.labels, label_values))
+            lines.append(f'{self.name}{{{labels}}} {value}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.request_duration = Histogram(
+            'secureshare_request_duration_seconds',
+            'Time from receiving a request to closing its response',
+            DURATION_BUCKETS, ('view', 'method'),
+        )
+        self.phase_duration = Histogram(
+            'secureshare_request_phase_seconds',
+            'Exclusive time per request spent in each phase',
+            DURATION_BUCKETS, ('view', 'phase'),
+        )
+        self.db_queries = Histogram(
+            'secureshare_request_db_queries',
+            'Database queries per request',
+            QUERY_BUCKETS, ('view',),
+        )
+        self.storage_bytes = Counter(
+            'secureshare_storage_bytes_total',
+            'Bytes read from and written to the blob store',
+            ('view',),
+        )
+
+    def record(self, view, method, metrics):
+        with self._lock:
+            self.request_duration.observe(metrics.elapsed(), view, method)
+            for phase, seconds in metrics.durations.items():
+                self.phase_duration.observe(seconds, view, phase)
+            self.db_queries.observe(metrics.counts['db_queries'], view)
+            if metrics.counts['storage_bytes']:
+                self.storage_bytes.inc(metrics.counts['storage_bytes'], view)
+
+    def expose(self):
+        with self._lock:
+            lines = []
+            for metric in (self.request_duration, self.phase_duration,
+                           self.db_queries, self.storage_bytes):
+                lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
@@ -1,5 +1,63 @@
-from .models import AuditLog
-import json
+import logging
+import uuid
+from django.conf import settings
+from django.db import connection
+from .audit import audit_writer
+from .metrics import RequestMetrics, activate, db_execute_wrapper, registry
+
+logger = logging.getLogger(__name__)
+
+class MetricsMiddleware:
+    """Time each request's phases; see core.metrics."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        server_timing = getattr(settings, 'SERVER_TIMING', settings.DEBUG)
+        if not server_timing and not getattr(settings, 'METRICS_ENABLED', True):
+            return self.get_response(request)
+
+        metrics = RequestMetrics()
+        activate(metrics)
+        with connection.execute_wrapper(db_execute_wrapper):
+            response = self.get_response(request)
+
+        if server_timing:
+            # Streamed bodies are still to come; they only reach /metrics
+            response['Server-Timing'] = metrics.server_timing()
+        match = request.resolver_match
+        view = match.view_name if match else 'unmatched'
+
+        def record():
+            registry.record(view, request.method, metrics)
+            activate(None)
+
+        if not response.streaming:
+            record()
+            return response
+        # Streamed bodies are timed until they have been sent, or abandoned
+        response.streaming_content = _recorded_after(response, record)
+        return response
+
+
+def _recorded_after(response, record):
+    """``response``'s streaming content, calling ``record`` once it is done."""
+    content = response.streaming_content
+    if response.is_async:
+        async def recorded():
+            try:
+                async for chunk in content:
+                    yield chunk
+            finally:
+                record()
+    else:
+        def recorded():
+            try:
+                yield from content
+            finally:
+                record()
+    return recorded()
 
 class AuditLogMiddleware:
     def __init__(self, get_response):
@@ -12,29 +70,47 @@ class AuditLogMiddleware:
         if request.path.startswith('/api/'):
             if request.user.is_authenticated:
                 try:
-                    # Extract file ID from URL if present
-                    file_id = None
-                    if 'files' in request.path:
-                        parts = request.path.split('/')
-                        if len(parts) > 3:
-                            file_id = parts[3]
-                    
-                    AuditLog.objects.create(
-                        user=request.user,
-                        action=self._get_action_type(request),
-                        file_id=file_id,
-                        details={
-                            'method': request.method,
-                            'path': request.path,
-                            'status_code': response.status_code,
-                        },
-                        ip_address=self._get_client_ip(request)
-                    )
+                    # Batch endpoints supply one event per item (audit.record_events)
+                    events = getattr(request, 'audit_events', None)
+                    if events is None:
+                        events = [{
+                            'action': self._get_action_type(request),
+                            'file_id': self._get_file_id(request),
+                        }]
+                    details = {
+                        'method': request.method,
+                        'path': request.path,
+                        'status_code': response.status_code,
+                    }
+                    ip_address = self._get_client_ip(request)
+                    # Hand the events to the batched writer; nothing is
+                    # written to the database on the request path
+                    audit_writer.enqueue_many([
+                        dict(
+                            user_id=request.user.pk,
+                            action=event['action'],
+                            file_id=event.get('file_id'),
+                            details={**details, **event.get('details', {})},
+                            ip_address=ip_address
+                        )
+                        for event in events
+                    ])
                 except Exception as e:
-                    print(f"Error logging audit: {e}")
+                    logger.error(f"Error logging audit: {e}")
         
         return response
     
+    def _get_file_id(self, request):
+        # Extract file ID from URL if present
+        if 'files' in request.path:
+            parts = request.path.split('/')
+            if len(parts) > 3:
+                try:
+                    return str(uuid.UUID(parts[3]))
+                except ValueError:
+                    return None
+        return None
+    
     def _get_action_type(self, request):
         if 'files' in request.path:
             if request.method == 'POST':
@@ -54,4 +130,4 @@ class AuditLogMiddleware:
         x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
         if x_forwarded_for:
             return x_forwarded_for.split(',')[0]
-        return request.META.get('REMOTE_ADDR') 
\ No newline at end of file
+        return request.META.get('REMOTE_ADDR')
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0003_upload_sessions"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="encryptedfile",
+            name="key_version",
+            field=models.IntegerField(blank=True, db_index=True, null=True),
+        ),
+    ]
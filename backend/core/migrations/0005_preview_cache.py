@@ -0,0 +1,50 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0004_encryptedfile_key_version"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PreviewCacheEntry",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("params_key", models.CharField(max_length=64)),
+                ("path", models.CharField(max_length=255)),
+                ("content_type", models.CharField(max_length=100)),
+                ("size", models.BigIntegerField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "last_accessed",
+                    models.DateTimeField(
+                        db_index=True, default=django.utils.timezone.now
+                    ),
+                ),
+                (
+                    "file",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="previews",
+                        to="core.encryptedfile",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("file", "params_key")},
+            },
+        ),
+    ]
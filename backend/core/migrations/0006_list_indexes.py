@@ -0,0 +1,46 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0005_preview_cache"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="encryptedfile",
+            index=models.Index(
+                fields=["owner", "-uploaded_at"], name="file_owner_uploaded_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="encryptedfile",
+            index=models.Index(fields=["-uploaded_at"], name="file_uploaded_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="fileshare",
+            index=models.Index(
+                fields=["shared_with", "-created_at"], name="share_user_created_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="fileshare",
+            index=models.Index(
+                fields=["file", "-created_at"], name="share_file_created_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="shareablelink",
+            index=models.Index(
+                fields=["created_by", "-expires_at"], name="link_creator_expires_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="shareablelink",
+            index=models.Index(
+                fields=["file", "-expires_at"], name="link_file_expires_idx"
+            ),
+        ),
+    ]
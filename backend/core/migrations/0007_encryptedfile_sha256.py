@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 20:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0006_list_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="encryptedfile",
+            name="sha256",
+            field=models.CharField(blank=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.7 on 2026-10-18 21:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0009_user_token_version"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ListVersion",
+            fields=[
+                ("user_id", models.IntegerField(primary_key=True, serialize=False)),
+                ("version", models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
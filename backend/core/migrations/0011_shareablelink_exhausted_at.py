@@ -0,0 +1,27 @@
+# Generated by Django 4.2.7 on 2026-10-18 23:10
+
+from django.db import migrations, models
+from django.db.models import F
+from django.utils import timezone
+
+
+def stamp_exhausted_links(apps, schema_editor):
+    ShareableLink = apps.get_model("core", "ShareableLink")
+    ShareableLink.objects.filter(
+        max_access__isnull=False, access_count__gte=F("max_access")
+    ).update(exhausted_at=timezone.now())
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0010_listversion"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="shareablelink",
+            name="exhausted_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(stamp_exhausted_links, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.7 on 2026-10-18 23:40
+
+from datetime import datetime
+
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def stamp_next_expiry(apps, schema_editor):
+    ListVersion = apps.get_model("core", "ListVersion")
+    ShareableLink = apps.get_model("core", "ShareableLink")
+    upcoming = ShareableLink.objects.filter(expires_at__gt=datetime.now())
+    next_expiry = {}
+    for field in ("created_by_id", "file__owner_id"):
+        for user_id, expires_at in upcoming.values_list(field).annotate(Min("expires_at")):
+            if user_id not in next_expiry or expires_at < next_expiry[user_id]:
+                next_expiry[user_id] = expires_at
+    ListVersion.objects.bulk_create(
+        [ListVersion(user_id=user_id) for user_id in next_expiry], ignore_conflicts=True
+    )
+    for user_id, expires_at in next_expiry.items():
+        ListVersion.objects.filter(user_id=user_id).update(next_expiry=expires_at)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0011_shareablelink_exhausted_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="listversion",
+            name="next_expiry",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(stamp_next_expiry, migrations.RunPython.noop),
+    ]
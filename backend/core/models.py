@@ -1,8 +1,11 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
+from .keys import unwrap_key
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 import uuid
 from datetime import datetime
-import os
 
 class User(AbstractUser):
     ROLES = (
@@ -15,39 +18,124 @@ class User(AbstractUser):
     role = models.CharField(max_length=10, choices=ROLES, default='user')
     mfa_secret = models.CharField(max_length=32, blank=True)
     mfa_enabled = models.BooleanField(default=False)
+    # Carried by every token; bumping it revokes all the user's tokens
+    token_version = models.PositiveIntegerField(default=0)
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username']
 
+    # Changing any of these revokes the user's tokens
+    REVOKING_FIELDS = ('password', 'is_active')
+    # Shown nested in other users' lists (UserSummarySerializer)
+    LISTED_FIELDS = ('email', 'role', 'mfa_enabled')
+    TRACKED_FIELDS = REVOKING_FIELDS + LISTED_FIELDS
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        user = super().from_db(db, field_names, values)
+        user._remember_loaded()
+        return user
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self._remember_loaded()
+
+    def _remember_loaded(self, update_fields=None):
+        loaded = self.__dict__.setdefault('_loaded', {})
+        for field in self.TRACKED_FIELDS:
+            if update_fields is not None and field not in update_fields:
+                continue
+            # Deferred fields are not in __dict__ and stay unknown
+            if field in self.__dict__:
+                loaded[field] = self.__dict__[field]
+
+    def changed_fields(self, update_fields=None):
+        """Tracked fields that differ from the loaded values (unknown ones count as changed)."""
+        loaded = self.__dict__.get('_loaded', {})
+        fields = self.TRACKED_FIELDS
+        if update_fields is not None:
+            fields = [field for field in fields if field in update_fields]
+        return {
+            field for field in fields
+            if field not in loaded or loaded[field] != getattr(self, field)
+        }
+
+    def save(self, *args, **kwargs):
+        from .authentication import forget_user
+
+        update_fields = kwargs.get('update_fields')
+        changed = set() if self._state.adding else self.changed_fields(update_fields)
+        versions = {self.token_version}
+        if changed.intersection(self.REVOKING_FIELDS):
+            old = User.objects.filter(pk=self.pk).values(
+                'token_version', *self.REVOKING_FIELDS
+            ).first()
+            if old and any(old[field] != getattr(self, field) for field in self.REVOKING_FIELDS):
+                self.token_version = old['token_version'] + 1
+                versions.update((old['token_version'], self.token_version))
+                if update_fields is not None:
+                    kwargs['update_fields'] = {*update_fields, 'token_version'}
+        # Read by the post_save receivers
+        self._changed_fields = changed
+        super().save(*args, **kwargs)
+        self._remember_loaded(update_fields)
+        # Cached copies (role, MFA state, ...) are stale now
+        transaction.on_commit(lambda: forget_user(self.pk, *versions))
+
+    def delete(self, *args, **kwargs):
+        from .authentication import forget_user
+
+        pk, version = self.pk, self.token_version
+        result = super().delete(*args, **kwargs)
+        transaction.on_commit(lambda: forget_user(pk, version))
+        return result
+
     def has_file_access(self, file):
-        if self.role == 'admin':
-            return True
-        if file.owner == self:
-            return True
-        return file.shares.filter(shared_with=self).exists()
+        from .access import AccessResolver
+        # Reuse the request's resolver when there is one, so checking a
+        # whole page of files costs a single share query
+        resolver = getattr(self, '_access_resolver', None) or AccessResolver(self)
+        return resolver.can_view(file)
 
 class EncryptedFile(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='files')
     name = models.CharField(max_length=255)
     file = models.FileField(upload_to='encrypted_files/')
+    # Per-file data key, wrapped by the master key of version key_version
     encryption_key = models.BinaryField()
+    key_version = models.IntegerField(null=True, blank=True, db_index=True)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     content_type = models.CharField(max_length=100)
     size = models.BigIntegerField()
+    # SHA-256 of the plaintext, computed while it was encrypted
+    sha256 = models.CharField(max_length=64, blank=True)
 
     def __str__(self):
         return f"{self.name} ({self.owner.username})"
 
+    @property
+    def data_key(self):
+        """The unwrapped per-file encryption key."""
+        return unwrap_key(self.encryption_key)
+
     class Meta:
         ordering = ['-uploaded_at']
+        indexes = [
+            models.Index(fields=['owner', '-uploaded_at'], name='file_owner_uploaded_idx'),
+            models.Index(fields=['-uploaded_at'], name='file_uploaded_idx'),
+        ]
 
     def delete(self, *args, **kwargs):
-        # Delete the actual file
-        if self.file:
-            if os.path.isfile(self.file.path):
-                os.remove(self.file.path)
-        super().delete(*args, **kwargs)
+        from .jobs import enqueue
+
+        name = self.file.name if self.file else None
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            if name:
+                # The blob is reclaimed by a background job once the row is gone
+                enqueue('blobs.delete', {'names': [name]})
+        return result
 
 class FileShare(models.Model):
     PERMISSIONS = (
@@ -63,6 +151,10 @@ class FileShare(models.Model):
     class Meta:
         unique_together = ('file', 'shared_with')
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['shared_with', '-created_at'], name='share_user_created_idx'),
+            models.Index(fields=['file', '-created_at'], name='share_file_created_idx'),
+        ]
 
     def __str__(self):
         return f"{self.file.name} shared with {self.shared_with.username}"
@@ -74,9 +166,15 @@ class ShareableLink(models.Model):
     expires_at = models.DateTimeField()
     access_count = models.IntegerField(default=0)
     max_access = models.IntegerField(null=True, blank=True)
+    # When the last access was claimed; kept for GC_LINK_RETENTION like expiry
+    exhausted_at = models.DateTimeField(null=True, blank=True)
     
     class Meta:
         ordering = ['-expires_at']
+        indexes = [
+            models.Index(fields=['created_by', '-expires_at'], name='link_creator_expires_idx'),
+            models.Index(fields=['file', '-expires_at'], name='link_file_expires_idx'),
+        ]
 
     @property
     def is_valid(self):
@@ -88,6 +186,76 @@ class ShareableLink(models.Model):
     def __str__(self):
         return f"Link for {self.file.name} (expires: {self.expires_at})" 
 
+class ListVersion(models.Model):
+    """Bumped whenever a file, share or link in the user's lists changes (see core.etags)."""
+    # Not a foreign key: a user's own cascade can still bump their version
+    user_id = models.IntegerField(primary_key=True)
+    version = models.BigIntegerField(default=0)
+    # When the first link in the user's lists that is still valid expires
+    next_expiry = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"List version {self.version} of {self.user_id}"
+
+class PreviewCacheEntry(models.Model):
+    """A rendered preview, stored encrypted under the file's data key."""
+    file = models.ForeignKey(EncryptedFile, on_delete=models.CASCADE, related_name='previews')
+    params_key = models.CharField(max_length=64)
+    path = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    size = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_accessed = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        unique_together = ('file', 'params_key')
+
+    def __str__(self):
+        return f"Preview {self.params_key} of {self.file_id}"
+
+class UploadSession(models.Model):
+    """A resumable upload; chunks land encrypted at their final offsets."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upload_sessions')
+    name = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    chunk_size = models.IntegerField()
+    encryption_key = models.BinaryField()
+    header = models.BinaryField()
+    content_type = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    @property
+    def total_chunks(self):
+        return max(1, -(-self.size // self.chunk_size))
+
+    @property
+    def blob_path(self):
+        return f'uploads/{self.owner_id}/{self.id}.part'
+
+    @property
+    def data_key(self):
+        return unwrap_key(self.encryption_key)
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def __str__(self):
+        return f"Upload of {self.name} ({self.owner_id})"
+
+class UploadChunk(models.Model):
+    session = models.ForeignKey(UploadSession, on_delete=models.CASCADE, related_name='chunks')
+    index = models.IntegerField()
+    checksum = models.CharField(max_length=64)
+    received_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('session', 'index')
+        ordering = ['index']
+
 # Add new model for audit logs
 class AuditLog(models.Model):
     ACTION_TYPES = (
@@ -103,7 +271,48 @@ class AuditLog(models.Model):
     file = models.ForeignKey(EncryptedFile, on_delete=models.SET_NULL, null=True)
     details = models.JSONField(default=dict)
     ip_address = models.GenericIPAddressField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the event happens, not when the batched writer flushes it
+    timestamp = models.DateTimeField(default=timezone.now)
     
     class Meta:
-        ordering = ['-timestamp'] 
\ No newline at end of file
+        ordering = ['-timestamp']
+
+class Job(models.Model):
+    """Deferred work run by the core.jobs workers."""
+    STATUSES = (
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    # Higher runs first
+    priority = models.IntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUSES, default='queued')
+    # Enqueueing again with the same key returns the existing job
+    idempotency_key = models.CharField(max_length=255, null=True, blank=True, unique=True)
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-priority', 'run_at']
+        indexes = [
+            models.Index(fields=['status', '-priority', 'run_at'], name='job_ready_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.pk} ({self.status})"
+
+@receiver(post_delete, sender=PreviewCacheEntry)
+def delete_preview_blob(sender, instance, **kwargs):
+    # Also runs for entries removed by the cascade when their file is deleted
+    from django.core.files.storage import default_storage
+    default_storage.delete(instance.path)
@@ -0,0 +1,23 @@
+from rest_framework.pagination import CursorPagination
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Cursor pagination: pages are fetched with ``WHERE <ordering> < cursor``
+    against an index instead of COUNT(*) plus OFFSET, so the cost of a page
+    doesn't grow with the number of rows or how deep the client pages.
+    """
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class FileCursorPagination(KeysetPagination):
+    ordering = '-uploaded_at'
+
+
+class ShareCursorPagination(KeysetPagination):
+    ordering = '-created_at'
+
+
+class LinkCursorPagination(KeysetPagination):
+    ordering = '-expires_at'
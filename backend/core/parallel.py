@@ -0,0 +1,211 @@
+"""
+Parallel segment encryption engine.
+
+Segments of the container format in ``core.crypto`` are independent, so
+they can be encrypted and decrypted on a worker pool. Results are always
+yielded in segment order and at most ``window`` segments are in flight,
+which keeps memory bounded by ``window * segment_size`` whatever the size
+of the file. :meth:`SegmentEngine.encryptor` does the same for data pushed
+in pieces, such as uploads arriving off the wire.
+"""
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+
+from .compression import compress_stream, decompress_stream, is_compressed
+from .crypto import (
+    HEADER_SIZE, SegmentEncryptor, decrypt_segment, decrypt_stream, encrypt_segment,
+    encrypted_segment_size, is_segmented, new_header, pack_header,
+    parse_header, read_exact, rechunk, segment_cipher,
+)
+
+
+def _cipher(key, header_bytes):
+    # Derived per segment rather than cached: a cache would keep raw data
+    # keys in memory past the request, and HKDF is cheap next to a segment
+    return segment_cipher(key, parse_header(header_bytes))
+
+
+# Module-level jobs so they can be shipped to process pools
+def _encrypt_job(key, header_bytes, index, data, final):
+    return encrypt_segment(_cipher(key, header_bytes), header_bytes, index, data, final)
+
+
+def _decrypt_job(key, header_bytes, index, data, final):
+    return decrypt_segment(_cipher(key, header_bytes), header_bytes, index, data, final)
+
+
+class SegmentEngine:
+    def __init__(self, workers=None, window=None, backend='thread'):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.window = max(1, window or 2 * self.workers)
+        self.backend = backend
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    if self.backend == 'process':
+                        self._executor = ProcessPoolExecutor(self.workers)
+                    else:
+                        self._executor = ThreadPoolExecutor(
+                            self.workers, thread_name_prefix='segment-crypto'
+                        )
+        return self._executor
+
+    def map_ordered(self, fn, jobs):
+        """Run ``fn(*job)`` for every job, yielding results in submission order."""
+        if self.workers == 1:
+            for job in jobs:
+                yield fn(*job)
+            return
+
+        pending = deque()
+        try:
+            for job in jobs:
+                pending.append(self.executor.submit(fn, *job))
+                if len(pending) >= self.window:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def encryptor(self, key, segment_size=None, flags=0):
+        """A ``crypto.SegmentEncryptor`` that seals segments on the pool."""
+        return ParallelSegmentEncryptor(self, key, segment_size, flags)
+
+    def encrypt(self, chunks, key, segment_size=None, flags=0):
+        """Parallel equivalent of ``crypto.encrypt_stream``."""
+        key = bytes(key)
+        header = new_header(segment_size, flags)
+        header_bytes = pack_header(header)
+        if is_compressed(flags):
+            # Compression is one sequential stream; only the segments fan out
+            chunks = compress_stream(chunks, flags)
+
+        def jobs():
+            index = 0
+            pending = None
+            for block in rechunk(chunks, header.segment_size):
+                if pending is not None:
+                    yield key, header_bytes, index, pending, False
+                    index += 1
+                pending = block
+            yield key, header_bytes, index, pending or b'', True
+
+        yield header_bytes
+        yield from self.map_ordered(_encrypt_job, jobs())
+
+    def decrypt(self, fileobj, key):
+        """Parallel equivalent of ``crypto.decrypt_stream``."""
+        key = bytes(key)
+        prefix = read_exact(fileobj, HEADER_SIZE)
+        if not is_segmented(prefix):
+            yield from decrypt_stream(_Prefixed(prefix, fileobj), key)
+            return
+
+        header_bytes = bytes(prefix)
+        header = parse_header(header_bytes)
+        step = encrypted_segment_size(header.segment_size)
+
+        def jobs():
+            index = 0
+            current = read_exact(fileobj, step)
+            while True:
+                following = read_exact(fileobj, step)
+                yield key, header_bytes, index, current, not following
+                if not following:
+                    return
+                index += 1
+                current = following
+
+        segments = self.map_ordered(_decrypt_job, jobs())
+        if is_compressed(header.flags):
+            segments = decompress_stream(segments, header.flags)
+        yield from segments
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+
+class ParallelSegmentEncryptor(SegmentEncryptor):
+    """
+    Push-style encryption on an engine's pool.
+
+    Segments are returned in order as they are sealed; at most ``window``
+    are in flight, so ``update`` waits for the oldest once that many are.
+    """
+
+    def __init__(self, engine, key, segment_size=None, flags=0):
+        super().__init__(key, segment_size, flags)
+        self._engine = engine
+        self._key = bytes(key)
+        self._pending = deque()
+
+    def _seal(self, data, final):
+        job = (self._key, self.header_bytes, self._index, data, final)
+        self._index += 1
+        if self._engine.workers == 1:
+            future = Future()
+            future.set_result(_encrypt_job(*job))
+        else:
+            future = self._engine.executor.submit(_encrypt_job, *job)
+        self._pending.append(future)
+
+    def _ready(self, wait=False):
+        segments = []
+        while self._pending and (
+            wait or len(self._pending) > self._engine.window or self._pending[0].done()
+        ):
+            segments.append(self._pending.popleft().result())
+        return segments
+
+    def abort(self):
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+
+
+class _Prefixed:
+    """Put already-consumed bytes back in front of a file object."""
+
+    def __init__(self, prefix, fileobj):
+        self.prefix = prefix
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data, self.prefix = self.prefix + self.fileobj.read(), b''
+            return data
+        if self.prefix:
+            data, self.prefix = self.prefix[:size], self.prefix[size:]
+            return data
+        return self.fileobj.read(size)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Process-wide engine configured from settings."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = SegmentEngine(
+                    workers=getattr(settings, 'ENCRYPTION_WORKERS', None),
+                    window=getattr(settings, 'ENCRYPTION_WINDOW', None),
+                    backend=getattr(settings, 'ENCRYPTION_WORKER_BACKEND', 'thread'),
+                )
+    return _engine
@@ -1,5 +1,6 @@
 from rest_framework import permissions
 from .models import ShareableLink
+from .access import get_access_resolver, ADMIN, OWNER
 
 class IsOwnerOrAdmin(permissions.BasePermission):
     """
@@ -24,20 +25,17 @@ class HasFileAccess(permissions.BasePermission):
     Permission to check if user has access to a file through sharing.
     """
     def has_object_permission(self, request, view, obj):
-        # Admin has full access
-        if request.user.role == 'admin':
-            return True
-            
-        # Owner has full access
-        if obj.owner == request.user:
+        permission = get_access_resolver(request).permission(obj)
+        
+        # Admin and owner have full access
+        if permission in (ADMIN, OWNER):
             return True
             
         # Check if file is shared with user
-        share = obj.shares.filter(shared_with=request.user).first()
-        if share:
+        if permission:
             if request.method in permissions.SAFE_METHODS:
                 return True
-            return share.permission == 'download'
+            return permission == 'download'
             
         return False 
 
@@ -62,8 +60,7 @@ class GuestPermission(permissions.BasePermission):
 
         # For EncryptedFile objects
         if hasattr(obj, 'shares'):
-            share = obj.shares.filter(shared_with=user).first()
-            if share and share.permission == 'download':
+            if get_access_resolver(request).share_permission(obj) == 'download':
                 return True
 
         # For ShareableLink objects
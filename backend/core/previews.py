@@ -0,0 +1,147 @@
+"""
+Persistent cache of rendered previews.
+
+Rendered previews (PDF pages, resized images) are stored under
+``previews/`` encrypted with the owning file's data key and indexed by
+PreviewCacheEntry rows keyed on the render parameters. The cache is
+bounded by ``PREVIEW_CACHE_MAX_BYTES`` and evicts the least recently used
+entries; entries disappear with their file through the FK cascade and the
+post_delete hook in ``core.models``.
+"""
+import io
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from .crypto import encrypt_stream, decrypt_stream
+from .jobs import PRIORITY_LOW, enqueue
+from .metrics import TimedReader, timed, timed_iter
+from .models import PreviewCacheEntry
+from .utils import get_decrypted_file
+
+logger = logging.getLogger(__name__)
+
+MAX_PREVIEW_WIDTH = 2048
+# Don't rewrite last_accessed on every hit
+TOUCH_INTERVAL = timedelta(minutes=1)
+
+
+def is_previewable(content_type):
+    return content_type.startswith(('image/', 'application/pdf'))
+
+
+def needs_render(content_type, width=None):
+    """Images are served as-is unless a resize is requested."""
+    return content_type == 'application/pdf' or width is not None
+
+
+def preview_params_key(page=0, width=None):
+    return f'p{page}-w{width or 0}'
+
+
+def render_preview(encrypted_file, page=0, width=None):
+    """Render a PNG preview of a PDF page or a resized image."""
+    from PIL import Image
+
+    content = get_decrypted_file(encrypted_file)
+    if encrypted_file.content_type == 'application/pdf':
+        import fitz  # PyMuPDF
+
+        pdf = fitz.open(stream=content, filetype="pdf")
+        if not 0 <= page < pdf.page_count:
+            raise ValueError(f"Page {page} does not exist")
+        pdf_page = pdf[page]
+        zoom = width / pdf_page.rect.width if width else 1
+        pix = pdf_page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+    else:
+        img = Image.open(io.BytesIO(content))
+        img.thumbnail((width, width * 10))
+
+    img_buffer = io.BytesIO()
+    img.save(img_buffer, format='PNG')
+    return img_buffer.getvalue(), 'image/png'
+
+
+def _read_entry(entry):
+    with TimedReader(default_storage.open(entry.path, 'rb')) as f:
+        return b''.join(timed_iter('crypto', decrypt_stream(f, entry.file.data_key)))
+
+
+def _store_entry(encrypted_file, params_key, content, content_type):
+    blob = b''.join(encrypt_stream([content], encrypted_file.data_key))
+    path = default_storage.save(
+        f'previews/{encrypted_file.id}/{params_key}.bin', ContentFile(blob)
+    )
+    try:
+        with transaction.atomic():
+            PreviewCacheEntry.objects.create(
+                file=encrypted_file,
+                params_key=params_key,
+                path=path,
+                content_type=content_type,
+                size=len(blob),
+            )
+    except IntegrityError:
+        # Someone else rendered the same preview concurrently
+        default_storage.delete(path)
+
+
+def evict_previews(max_bytes=None):
+    """Drop least recently used previews until the cache fits its budget."""
+    if max_bytes is None:
+        max_bytes = getattr(settings, 'PREVIEW_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+    total = PreviewCacheEntry.objects.aggregate(total=Sum('size'))['total'] or 0
+    evicted = 0
+    if total <= max_bytes:
+        return evicted
+    for entry in PreviewCacheEntry.objects.order_by('last_accessed').iterator():
+        entry.delete()
+        evicted += 1
+        total -= entry.size
+        if total <= max_bytes:
+            break
+    return evicted
+
+
+def get_preview(encrypted_file, page=0, width=None):
+    """Return (content, content_type) for a preview, rendering it on a cache miss."""
+    params_key = preview_params_key(page, width)
+    entry = PreviewCacheEntry.objects.filter(
+        file=encrypted_file, params_key=params_key
+    ).first()
+    if entry:
+        entry.file = encrypted_file
+        try:
+            content = _read_entry(entry)
+        except (OSError, ValueError):
+            logger.warning("Dropping unreadable preview %s", entry.path)
+            entry.delete()
+        else:
+            now = timezone.now()
+            if now - entry.last_accessed > TOUCH_INTERVAL:
+                PreviewCacheEntry.objects.filter(pk=entry.pk).update(last_accessed=now)
+            return content, entry.content_type
+
+    with timed('preview'):
+        content, content_type = render_preview(encrypted_file, page, width)
+    _store_entry(encrypted_file, params_key, content, content_type)
+    evict_previews()
+    return content, content_type
+
+
+def schedule_prerender(encrypted_file):
+    """Render the default preview in a background job once the upload commits."""
+    if not getattr(settings, 'PREVIEW_PRERENDER', True):
+        return
+    if not needs_render(encrypted_file.content_type):
+        return
+    file_id = str(encrypted_file.pk)
+    enqueue('previews.prerender', {'file_id': file_id},
+            priority=PRIORITY_LOW, key=f'previews.prerender:{file_id}')
@@ -1,12 +1,24 @@
 from rest_framework import serializers
 from django.contrib.auth.password_validation import validate_password
-from .models import User, EncryptedFile, FileShare, ShareableLink
+from .models import User, EncryptedFile, FileShare, ShareableLink, UploadSession
 import pyotp
 from django.core.mail import send_mail
 from django.template.loader import render_to_string
 from django.conf import settings
+from .access import get_access_resolver
+from .metrics import timed
 
-class UserSerializer(serializers.ModelSerializer):
+# Largest file accepted by the direct upload endpoints
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+
+class TimedSerializerMixin:
+    """Charge representation time to the request's 'serialize' phase."""
+
+    def to_representation(self, instance):
+        with timed('serialize'):
+            return super().to_representation(instance)
+
+class UserSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     password = serializers.CharField(write_only=True, required=True, validators=[validate_password])
     confirm_password = serializers.CharField(write_only=True, required=False)
 
@@ -35,8 +47,16 @@ class UserSerializer(serializers.ModelSerializer):
         user.save()
         return user
 
-class EncryptedFileSerializer(serializers.ModelSerializer):
-    owner = UserSerializer(read_only=True)
+class UserSummarySerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    """Read-only user representation for nesting in list responses."""
+
+    class Meta:
+        model = User
+        fields = ('id', 'email', 'role', 'mfa_enabled')
+        read_only_fields = fields
+
+class EncryptedFileSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    owner = UserSummarySerializer(read_only=True)
     download_url = serializers.SerializerMethodField()
     content_type = serializers.CharField(read_only=True)
     size = serializers.IntegerField(read_only=True)
@@ -44,28 +64,27 @@ class EncryptedFileSerializer(serializers.ModelSerializer):
     class Meta:
         model = EncryptedFile
         fields = ('id', 'name', 'file', 'owner', 'uploaded_at', 
-                 'content_type', 'size', 'download_url')
+                 'content_type', 'size', 'sha256', 'download_url')
         read_only_fields = ('id', 'owner', 'uploaded_at', 'download_url', 
-                          'content_type', 'size')
+                          'content_type', 'size', 'sha256')
 
     def get_download_url(self, obj):
         request = self.context.get('request')
-        if request and request.user.has_file_access(obj):
+        if request and get_access_resolver(request).can_view(obj):
             return request.build_absolute_uri(f'/api/files/{obj.id}/download/')
         return None
 
     def validate_file(self, value):
-        # 10MB file size limit
-        if value.size > 10 * 1024 * 1024:
+        if value.size > MAX_UPLOAD_SIZE:
             raise serializers.ValidationError(
                 "File size cannot exceed 10MB"
             )
         return value
 
-class FileShareSerializer(serializers.ModelSerializer):
+class FileShareSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     file = EncryptedFileSerializer(read_only=True)
     file_id = serializers.UUIDField(write_only=True)
-    shared_with = UserSerializer(read_only=True)
+    shared_with = UserSummarySerializer(read_only=True)
     shared_with_username = serializers.CharField(write_only=True)
 
     class Meta:
@@ -98,7 +117,7 @@ class FileShareSerializer(serializers.ModelSerializer):
             **validated_data
         )
 
-class ShareableLinkSerializer(serializers.ModelSerializer):
+class ShareableLinkSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     file = EncryptedFileSerializer(read_only=True)
     file_id = serializers.UUIDField(write_only=True)
     share_url = serializers.SerializerMethodField()
@@ -117,4 +136,14 @@ class ShareableLinkSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         validated_data['created_by'] = self.context['request'].user
-        return super().create(validated_data) 
\ No newline at end of file
+        return super().create(validated_data)
+
+class UploadSessionSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    total_chunks = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = UploadSession
+        fields = ('id', 'name', 'size', 'chunk_size', 'total_chunks',
+                 'content_type', 'created_at')
+        read_only_fields = ('id', 'chunk_size', 'total_chunks',
+                          'content_type', 'created_at')
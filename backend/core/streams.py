@@ -0,0 +1,65 @@
+"""
+Response bodies that work under both WSGI and ASGI.
+
+Under WSGI a worker thread belongs to the request until the last byte is
+sent, so download bodies are plain generators. Under ASGI the view only
+authorizes the request and builds the response; the body is an async
+iterator that the event loop drives while each blocking step (reading the
+next segment from the blob store and decrypting it) runs on a shared
+thread pool. A slow client then costs an idle coroutine instead of a
+thread, so one process can keep thousands of downloads open.
+"""
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+
+_executor = None
+_executor_lock = threading.Lock()
+_END = object()
+
+
+def get_stream_executor():
+    """Thread pool running blocking body steps for async responses."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'ASYNC_STREAM_WORKERS', 32),
+                    thread_name_prefix='stream-io',
+                )
+    return _executor
+
+
+async def aiterate(iterator, context=None):
+    """Drive a blocking iterator from the event loop, one step per executor call."""
+    loop = asyncio.get_running_loop()
+    executor = get_stream_executor()
+    # Steps run in the request's context so per-request metrics keep counting
+    context = context or contextvars.copy_context()
+    try:
+        while True:
+            item = await loop.run_in_executor(executor, context.run, next, iterator, _END)
+            if item is _END:
+                break
+            yield item
+    finally:
+        # Releases the open blob if the client went away mid-stream
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            await loop.run_in_executor(executor, context.run, close)
+
+
+def is_async_request(request):
+    return isinstance(getattr(request, '_request', request), ASGIRequest)
+
+
+def stream_body(request, iterator):
+    """Return ``iterator`` in the form the serving handler streams without buffering."""
+    if is_async_request(request):
+        return aiterate(iter(iterator), contextvars.copy_context())
+    return iterator
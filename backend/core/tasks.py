@@ -0,0 +1,36 @@
+"""
+Handlers for the background jobs in ``core.jobs``.
+
+Payloads are JSON, so ids travel as strings. Handlers must be safe to run
+more than once: a job is retried after a failure and requeued if its
+worker dies mid-way.
+"""
+from django.conf import settings
+
+from .blobstore import get_blob_store
+from .garbage import collect
+from .jobs import register
+from .models import EncryptedFile
+from .previews import get_preview
+
+
+@register('previews.prerender')
+def prerender_preview(file_id):
+    """Render and cache the default preview of a new upload."""
+    encrypted_file = EncryptedFile.objects.filter(pk=file_id).first()
+    if encrypted_file:
+        get_preview(encrypted_file)
+
+
+@register('blobs.delete')
+def delete_blobs(names):
+    """Reclaim the storage of deleted files."""
+    store = get_blob_store()
+    for name in names:
+        store.delete(name)
+
+
+@register('gc.collect', every=getattr(settings, 'GC_INTERVAL', 3600))
+def collect_garbage():
+    """Reclaim dead links, abandoned uploads and orphaned blobs."""
+    collect()
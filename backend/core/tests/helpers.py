@@ -0,0 +1,49 @@
+"""Shared fixtures for the core tests."""
+import shutil
+import tempfile
+
+from django.core.files.base import ContentFile
+from django.test import override_settings
+from rest_framework.test import APIClient
+
+from core import blobstore
+from core.models import User
+from core.utils import save_encrypted_file
+
+
+class StorageMixin:
+    """
+    Keep blobs in a temporary MEDIA_ROOT, run jobs inline, write audit
+    events synchronously and switch off rate limits, preview prerendering
+    and the HTTPS redirect.
+    """
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        overrides = override_settings(
+            MEDIA_ROOT=media_root, BLOB_STORE='local', BLOB_STORE_ROOT=None,
+            JOBS_MODE='inline', RATE_LIMIT_ENABLED=False, PREVIEW_PRERENDER=False,
+            AUDIT_LOG_ASYNC=False, SECURE_SSL_REDIRECT=False,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        # The blob store is built once per process from settings
+        blobstore._store = None
+        self.addCleanup(setattr, blobstore, '_store', None)
+
+
+def make_user(name, **fields):
+    return User.objects.create_user(username=name, email=f'{name}@example.com',
+                                    password='pass', **fields)
+
+
+def make_file(owner, name='note.txt', content=b'hello world\n'):
+    return save_encrypted_file(ContentFile(content, name=name), owner, 'text/plain')
+
+
+def client_for(user):
+    client = APIClient()
+    client.force_authenticate(user)
+    return client
@@ -0,0 +1,34 @@
+import io
+import zipfile
+
+from django.test import TestCase
+
+from core.tests.helpers import StorageMixin, client_for, make_file, make_user
+
+
+class ArchiveDownloadTests(StorageMixin, TestCase):
+    def test_archive_reads_back(self):
+        owner = make_user('owner')
+        first = make_file(owner, 'a.txt', b'first file\n' * 100)
+        second = make_file(owner, 'b.txt', b'second file\n')
+        duplicate = make_file(owner, 'a.txt', b'same name\n')
+
+        response = client_for(owner).get(
+            '/api/files/archive/', {'ids': f'{first.pk},{second.pk},{duplicate.pk}'}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(archive.namelist(), ['a.txt', 'b.txt', 'a (1).txt'])
+        self.assertEqual(archive.read('a.txt'), b'first file\n' * 100)
+        self.assertEqual(archive.read('b.txt'), b'second file\n')
+        self.assertEqual(archive.read('a (1).txt'), b'same name\n')
+
+    def test_archive_of_unknown_file_is_404(self):
+        owner = make_user('owner')
+        response = client_for(owner).get(
+            '/api/files/archive/', {'ids': '00000000-0000-0000-0000-000000000000'}
+        )
+        self.assertEqual(response.status_code, 404)
@@ -0,0 +1,126 @@
+import fcntl
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
+
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from core.audit import AuditLogWriter
+from core.models import AuditLog
+
+
+def event(action='upload', **fields):
+    return {'action': action, 'ip_address': '127.0.0.1', 'details': {}, **fields}
+
+
+class SpillDirMixin:
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.spill_path = os.path.join(directory, 'audit-spill.jsonl')
+        overrides = override_settings(AUDIT_LOG_SPILL_PATH=self.spill_path)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+
+class OverflowTests(SpillDirMixin, TestCase):
+    def full_writer(self):
+        """A writer whose queue holds a single event and is never drained."""
+        writer = AuditLogWriter()
+        writer._queue = queue.Queue(maxsize=1)
+        writer._thread = threading.current_thread()
+        writer._pid = os.getpid()
+        return writer
+
+    @override_settings(AUDIT_LOG_OVERFLOW='drop')
+    def test_drop(self):
+        writer = self.full_writer()
+        writer.enqueue_many([event(), event(), event()])
+        stats = writer.stats()
+        self.assertEqual((stats['enqueued'], stats['dropped']), (1, 2))
+        self.assertEqual(stats['queue_depth'], 1)
+        self.assertFalse(os.path.exists(self.spill_path))
+
+    @override_settings(AUDIT_LOG_OVERFLOW='block', AUDIT_LOG_BLOCK_TIMEOUT=0.01)
+    def test_block_gives_up_after_the_timeout(self):
+        writer = self.full_writer()
+        writer.enqueue_many([event(), event()])
+        stats = writer.stats()
+        self.assertEqual((stats['enqueued'], stats['dropped']), (1, 1))
+
+    @override_settings(AUDIT_LOG_OVERFLOW='spill')
+    def test_spilled_events_are_replayed(self):
+        writer = self.full_writer()
+        writer.enqueue_many([event(), event('share'), event('delete')])
+        self.assertEqual(writer.stats()['spilled'], 2)
+        with open(self.spill_path) as f:
+            self.assertEqual([json.loads(line)['action'] for line in f], ['share', 'delete'])
+
+        writer._replay_spill()
+        self.assertEqual(sorted(AuditLog.objects.values_list('action', flat=True)),
+                         ['delete', 'share'])
+        self.assertIsNotNone(AuditLog.objects.first().timestamp)
+        self.assertEqual(writer.stats()['replayed'], 2)
+        self.assertFalse(os.path.exists(self.spill_path))
+
+    @override_settings(AUDIT_LOG_OVERFLOW='spill')
+    def test_spill_waits_for_the_lock_held_by_another_process(self):
+        writer = self.full_writer()
+        writer.enqueue(**event())
+        with open(f'{self.spill_path}.lock', 'a') as lock:
+            # A separate open file description conflicts like another process would
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            spilling = threading.Thread(target=writer.enqueue, kwargs=event())
+            spilling.start()
+            spilling.join(0.2)
+            self.assertTrue(spilling.is_alive())
+            self.assertFalse(os.path.exists(self.spill_path))
+        spilling.join(5)
+        self.assertEqual(writer.stats()['spilled'], 1)
+
+    def test_unknown_policy_is_rejected(self):
+        with override_settings(AUDIT_LOG_OVERFLOW='ignore'):
+            with self.assertRaises(ValueError):
+                AuditLogWriter().overflow
+
+
+@override_settings(AUDIT_LOG_ASYNC=False)
+class WriteTests(TestCase):
+    def test_bad_row_does_not_lose_the_batch(self):
+        writer = AuditLogWriter()
+        writer.enqueue_many([event(), event('share', ip_address=None), event('delete')])
+        self.assertEqual(sorted(AuditLog.objects.values_list('action', flat=True)),
+                         ['delete', 'upload'])
+        stats = writer.stats()
+        self.assertEqual((stats['written'], stats['dropped']), (2, 1))
+
+    def test_missing_file_is_logged_without_it(self):
+        writer = AuditLogWriter()
+        writer.enqueue(**event(file_id='00000000-0000-0000-0000-000000000000'))
+        self.assertIsNone(AuditLog.objects.get().file_id)
+
+
+@override_settings(AUDIT_LOG_ASYNC=True, AUDIT_LOG_FLUSH_INTERVAL=60, AUDIT_LOG_BATCH_SIZE=100)
+class ShutdownTests(SpillDirMixin, TransactionTestCase):
+    def test_shutdown_writes_queued_and_spilled_events(self):
+        with open(self.spill_path, 'w') as f:
+            f.write(json.dumps(event('share', timestamp='2026-01-01T00:00:00')) + '\n')
+        writer = AuditLogWriter()
+        writer.enqueue_many([event(), event('delete')])
+        writer.shutdown()
+        self.assertIsNone(writer._thread)
+        self.assertEqual(sorted(AuditLog.objects.values_list('action', flat=True)),
+                         ['delete', 'share', 'upload'])
+        self.assertFalse(os.path.exists(self.spill_path))
+
+    def test_flush_waits_for_queued_events(self):
+        writer = AuditLogWriter()
+        self.addCleanup(writer.shutdown)
+        with override_settings(AUDIT_LOG_FLUSH_INTERVAL=0.05):
+            writer.enqueue(**event())
+            writer.flush(timeout=5)
+        self.assertEqual(AuditLog.objects.count(), 1)
@@ -0,0 +1,139 @@
+import shutil
+import tempfile
+from datetime import datetime
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+
+from core.authentication import CachedJWTAuthentication, VersionedRefreshToken
+from core.models import User
+from core.tests.helpers import make_user
+
+
+class CachedJWTAuthenticationTests(TestCase):
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        overrides = override_settings(
+            CACHES={
+                'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                'auth': {
+                    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                    'LOCATION': cache_dir,
+                },
+            },
+            AUTH_USER_CACHE='auth',
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.user = make_user('alice')
+        self.auth = CachedJWTAuthentication()
+
+    def token(self):
+        return VersionedRefreshToken.for_user(self.user).access_token
+
+    def save(self, **fields):
+        for name, value in fields.items():
+            setattr(self.user, name, value)
+        # Cached copies are dropped on commit
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+
+    def test_cache_hit_skips_the_database(self):
+        token = self.token()
+        self.assertEqual(self.auth.get_user(token), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.auth.get_user(token), self.user)
+
+    def test_changes_are_seen_on_the_next_request(self):
+        token = self.token()
+        self.auth.get_user(token)
+        self.save(role='guest')
+        self.assertEqual(self.auth.get_user(token).role, 'guest')
+
+    def test_deactivation_revokes_cached_user(self):
+        token = self.token()
+        self.auth.get_user(token)
+        self.save(is_active=False)
+        with self.assertRaises(AuthenticationFailed):
+            self.auth.get_user(token)
+
+    def test_password_change_revokes_old_tokens(self):
+        token = self.token()
+        self.auth.get_user(token)
+        self.user.set_password('new password')
+        self.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.auth.get_user(token)
+        self.assertEqual(self.auth.get_user(self.token()), self.user)
+
+    def test_copy_loaded_before_a_change_is_not_served(self):
+        token = self.token()
+        load_user = CachedJWTAuthentication._load_user
+
+        def load_then_change(auth, validated_token, version):
+            # The user changes between the stamp being read and the row
+            # being cached, as with a request racing the save
+            user = load_user(auth, validated_token, version)
+            self.save(role='guest')
+            return user
+
+        with mock.patch.object(CachedJWTAuthentication, '_load_user', load_then_change):
+            self.assertEqual(self.auth.get_user(token).role, 'user')
+        self.assertEqual(self.auth.get_user(token).role, 'guest')
+
+    @override_settings(AUTH_USER_CACHE='default')
+    def test_per_process_cache_is_not_used(self):
+        token = self.token()
+        self.auth.get_user(token)
+        with self.assertNumQueries(1):
+            self.auth.get_user(token)
+
+
+class UserSaveTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.get(pk=make_user('alice').pk)
+
+    def token_version(self):
+        return User.objects.get(pk=self.user.pk).token_version
+
+    def test_login_update_is_a_single_query(self):
+        self.user.last_login = datetime.now()
+        with self.assertNumQueries(1):
+            self.user.save(update_fields=['last_login'])
+        self.assertEqual(self.token_version(), 0)
+
+    def test_unchanged_save_does_not_read_the_row_back(self):
+        self.user.first_name = 'Alice'
+        with self.assertNumQueries(1):
+            self.user.save()
+        self.assertEqual(self.token_version(), 0)
+
+    def test_revoking_change_bumps_the_version(self):
+        self.user.set_password('new password')
+        self.user.save(update_fields=['password'])
+        self.assertEqual(self.token_version(), 1)
+        # Saving the same values again revokes nothing more
+        self.user.save()
+        self.assertEqual(self.token_version(), 1)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.token_version(), 2)
+
+    def test_bump_starts_from_the_stored_version(self):
+        User.objects.filter(pk=self.user.pk).update(token_version=5)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.token_version(), 6)
+
+    def test_refresh_resets_the_loaded_values(self):
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.changed_fields(), set())
+        self.user.is_active = True
+        self.assertEqual(self.user.changed_fields(), {'is_active'})
+
+    def test_deferred_fields_count_as_changed(self):
+        user = User.objects.only('email').get(pk=self.user.pk)
+        self.assertEqual(user.changed_fields(), {'password', 'is_active', 'role', 'mfa_enabled'})
@@ -0,0 +1,194 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import uuid
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TransactionTestCase
+
+from core.blobstore import BLOB_PREFIX, LocalBlobStore, S3RangeReader, blob_name, get_blob_store
+from core.management.commands.migrate_blobs import Command as MigrateBlobs
+from core.models import EncryptedFile
+from core.tests.helpers import StorageMixin, make_file, make_user
+from core.utils import get_decrypted_file
+
+
+class BlobNameTests(SimpleTestCase):
+    def test_hashed_fan_out(self):
+        file_id = uuid.uuid4()
+        digest = hashlib.sha256(str(file_id).encode()).hexdigest()
+        self.assertEqual(blob_name(file_id), f'{BLOB_PREFIX}/{digest[:2]}/{digest[2:4]}/{file_id}')
+        self.assertEqual(blob_name(file_id, revision='ab12'), f'{blob_name(file_id)}.ab12')
+
+    def test_ids_spread_over_directories(self):
+        directories = {blob_name(uuid.uuid4()).rsplit('/', 1)[0] for _ in range(200)}
+        self.assertGreater(len(directories), 150)
+
+
+class LocalBlobStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.store = LocalBlobStore(self.root)
+        self.name = blob_name(uuid.uuid4())
+
+    def test_save_open_size_exists_delete(self):
+        self.assertFalse(self.store.exists(self.name))
+        self.assertEqual(self.store.save(self.name, [b'abc', b'', b'defgh']), 8)
+        self.assertTrue(self.store.exists(self.name))
+        self.assertEqual(self.store.size(self.name), 8)
+        with self.store.open(self.name) as f:
+            self.assertEqual(f.read(), b'abcdefgh')
+        self.store.delete(self.name)
+        self.assertFalse(self.store.exists(self.name))
+        # Deleting a missing blob is fine
+        self.store.delete(self.name)
+
+    def test_open_reads_from_offsets(self):
+        self.store.save(self.name, [bytes(range(100))])
+        with self.store.open(self.name) as f:
+            f.seek(40)
+            self.assertEqual(f.read(5), bytes(range(40, 45)))
+            f.seek(-10, io.SEEK_END)
+            self.assertEqual(f.read(), bytes(range(90, 100)))
+
+    def test_failed_save_leaves_nothing_behind(self):
+        self.store.save(self.name, [b'old'])
+
+        def chunks():
+            yield b'new'
+            raise OSError('disk full')
+
+        with self.assertRaises(OSError):
+            self.store.save(self.name, chunks())
+        with self.store.open(self.name) as f:
+            self.assertEqual(f.read(), b'old')
+        self.assertEqual(os.listdir(os.path.dirname(self.store.path(self.name))),
+                         [self.name.rsplit('/', 1)[1]])
+
+    def test_save_file_moves_the_file(self):
+        source = os.path.join(self.root, 'partial')
+        with open(source, 'wb') as f:
+            f.write(b'finished')
+        self.store.save_file(self.name, source)
+        self.assertFalse(os.path.exists(source))
+        with self.store.open(self.name) as f:
+            self.assertEqual(f.read(), b'finished')
+
+    def test_list(self):
+        other = blob_name(uuid.uuid4())
+        self.store.save(self.name, [b'12345'])
+        self.store.save(other, [b'1'])
+        self.store.save('elsewhere/blob', [b'1'])
+        listed = {name: size for name, size, _ in self.store.list(BLOB_PREFIX)}
+        self.assertEqual(listed, {self.name: 5, other: 1})
+
+    def test_names_cannot_escape_the_root(self):
+        with self.assertRaises(ValueError):
+            self.store.path('../outside')
+
+
+class FakeS3:
+    class exceptions:
+        class ClientError(Exception):
+            def __init__(self, code):
+                self.response = {'Error': {'Code': code}}
+
+    def __init__(self, data):
+        self.data = data
+        self.gets = []
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.data)}
+
+    def get_object(self, Bucket, Key, Range):
+        start = int(Range.removeprefix('bytes=').rstrip('-'))
+        if start >= len(self.data):
+            raise self.exceptions.ClientError('InvalidRange')
+        self.gets.append(start)
+        return {'Body': io.BytesIO(self.data[start:])}
+
+
+class S3RangeReaderTests(SimpleTestCase):
+    def setUp(self):
+        self.client = FakeS3(bytes(range(256)))
+        self.reader = S3RangeReader(self.client, 'bucket', 'key')
+
+    def test_sequential_reads_share_one_get(self):
+        self.assertEqual(self.reader.read(10), bytes(range(10)))
+        self.assertEqual(self.reader.read(10), bytes(range(10, 20)))
+        self.assertEqual(self.client.gets, [0])
+
+    def test_seek_starts_a_ranged_get_at_the_offset(self):
+        self.reader.read(4)
+        self.reader.seek(100)
+        self.assertEqual(self.reader.read(3), bytes([100, 101, 102]))
+        self.reader.seek(-6, io.SEEK_CUR)
+        self.assertEqual(self.reader.tell(), 97)
+        self.assertEqual(self.reader.read(2), bytes([97, 98]))
+        self.assertEqual(self.client.gets, [0, 100, 97])
+
+    def test_seek_from_the_end(self):
+        self.reader.seek(-4, io.SEEK_END)
+        self.assertEqual(self.reader.read(), bytes([252, 253, 254, 255]))
+
+    def test_reading_past_the_end(self):
+        self.reader.seek(300)
+        self.assertEqual(self.reader.read(10), b'')
+        self.reader.seek(0, io.SEEK_END)
+        self.assertEqual(self.reader.read(10), b'')
+        self.assertEqual(self.client.gets, [])
+
+    def test_negative_position_is_rejected(self):
+        with self.assertRaises(ValueError):
+            self.reader.seek(-1)
+
+
+class MigrateBlobsTests(StorageMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.store = get_blob_store()
+        self.file = make_file(make_user('owner'), content=b'legacy content')
+        # Put the blob where it lived before the hashed layout
+        self.legacy = f'encrypted_files/{self.file.owner_id}/note.txt'
+        with self.store.open(self.file.file.name) as f:
+            self.store.save(self.legacy, [f.read()])
+        self.store.delete(self.file.file.name)
+        EncryptedFile.objects.filter(pk=self.file.pk).update(file=self.legacy)
+
+    def migrate(self, *args):
+        call_command('migrate_blobs', *args, stdout=io.StringIO(), stderr=io.StringIO())
+
+    def test_moves_the_blob_into_the_hashed_layout(self):
+        self.migrate()
+        moved = EncryptedFile.objects.get(pk=self.file.pk)
+        self.assertEqual(moved.file.name, blob_name(self.file.pk))
+        self.assertFalse(self.store.exists(self.legacy))
+        self.assertEqual(get_decrypted_file(moved), b'legacy content')
+
+    def test_rerun_is_a_no_op(self):
+        self.migrate()
+        out = io.StringIO()
+        call_command('migrate_blobs', stdout=out)
+        self.assertIn('Moving 0 blobs', out.getvalue())
+        self.assertEqual(get_decrypted_file(EncryptedFile.objects.get(pk=self.file.pk)),
+                         b'legacy content')
+
+    def test_keep_source(self):
+        self.migrate('--keep-source')
+        self.assertTrue(self.store.exists(self.legacy))
+        self.assertTrue(self.store.exists(blob_name(self.file.pk)))
+
+    def test_row_changed_during_the_move_is_left_alone(self):
+        command = MigrateBlobs()
+        command.source = command.target = self.store
+        command.keep_source = False
+        # Re-encrypted (say) after the command listed it
+        EncryptedFile.objects.filter(pk=self.file.pk).update(file='blobs/elsewhere')
+        with self.assertRaisesRegex(ValueError, 'changed'):
+            command.move_blob(self.file.pk, self.legacy)
+        self.assertEqual(EncryptedFile.objects.get(pk=self.file.pk).file.name, 'blobs/elsewhere')
+        self.assertFalse(self.store.exists(blob_name(self.file.pk)))
+        self.assertTrue(self.store.exists(self.legacy))
@@ -0,0 +1,111 @@
+import io
+import os
+
+from cryptography.fernet import Fernet
+from django.test import SimpleTestCase, override_settings
+
+from core.compression import (
+    FLAG_ZLIB, FLAG_ZSTD, INCOMPRESSIBLE_TYPES, OUTPUT_CHUNK_SIZE, choose_compression,
+    compress_stream, decompress_stream, probe_chunks,
+)
+from core.crypto import decrypt_range, decrypt_stream, encrypt_stream
+
+TEXT = b''.join(b'line %06d of a very compressible file\n' % i for i in range(20000))
+
+
+def compress(data, flags, piece=4096):
+    return b''.join(compress_stream([data[i:i + piece] for i in range(0, len(data), piece)], flags))
+
+
+def pieces(data, size=1000):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class CodecTests(SimpleTestCase):
+    def test_round_trips(self):
+        for flags in (FLAG_ZLIB, FLAG_ZSTD):
+            for data in (b'', b'x', TEXT, os.urandom(100000)):
+                with self.subTest(flags=flags, length=len(data)):
+                    compressed = compress(data, flags)
+                    self.assertEqual(b''.join(decompress_stream(pieces(compressed), flags)), data)
+
+    def test_compressible_data_shrinks(self):
+        for flags in (FLAG_ZLIB, FLAG_ZSTD):
+            self.assertLess(len(compress(TEXT, flags)), len(TEXT) // 10)
+
+    def test_truncated_stream_is_rejected(self):
+        for flags in (FLAG_ZLIB, FLAG_ZSTD):
+            compressed = compress(TEXT, flags)
+            for cut in (0, 5, len(compressed) // 2, len(compressed) - 1):
+                with self.subTest(flags=flags, cut=cut):
+                    with self.assertRaisesRegex(ValueError, 'truncated'):
+                        b''.join(decompress_stream(pieces(compressed[:cut]), flags))
+
+    def test_garbage_is_rejected(self):
+        with self.assertRaises(ValueError):
+            b''.join(decompress_stream([b'not a zstd frame'], FLAG_ZSTD))
+
+    def test_output_comes_in_bounded_pieces(self):
+        zeros = bytes(8 * OUTPUT_CHUNK_SIZE)
+        for flags in (FLAG_ZLIB, FLAG_ZSTD):
+            compressed = compress(zeros, flags, piece=len(zeros))
+            output = list(decompress_stream([compressed], flags))
+            self.assertEqual(b''.join(output), zeros)
+            self.assertLessEqual(max(map(len, output)), OUTPUT_CHUNK_SIZE)
+
+
+class ChooseCompressionTests(SimpleTestCase):
+    @override_settings(BLOB_COMPRESSION='auto', BLOB_COMPRESSION_CODEC='zstd')
+    def test_auto_compresses_what_the_probe_shrinks(self):
+        self.assertEqual(choose_compression('text/plain', TEXT[:65536]), FLAG_ZSTD)
+        self.assertEqual(choose_compression('text/plain', os.urandom(65536)), 0)
+        self.assertEqual(choose_compression('text/plain', b''), 0)
+
+    @override_settings(BLOB_COMPRESSION='auto')
+    def test_auto_skips_incompressible_types(self):
+        for content_type in INCOMPRESSIBLE_TYPES:
+            with self.subTest(content_type=content_type):
+                self.assertEqual(choose_compression(content_type, TEXT[:65536]), 0)
+
+    @override_settings(BLOB_COMPRESSION='auto', COMPRESSION_MIN_SAVING=0.99)
+    def test_auto_requires_the_minimum_saving(self):
+        self.assertEqual(choose_compression('text/plain', b'abcdefgh' * 100), 0)
+
+    @override_settings(BLOB_COMPRESSION='always', BLOB_COMPRESSION_CODEC='zlib')
+    def test_always(self):
+        self.assertEqual(choose_compression('image/png', os.urandom(1000)), FLAG_ZLIB)
+
+    @override_settings(BLOB_COMPRESSION='off')
+    def test_off(self):
+        self.assertEqual(choose_compression('text/plain', TEXT), 0)
+
+    @override_settings(BLOB_COMPRESSION='always', BLOB_COMPRESSION_CODEC='lzma')
+    def test_unknown_codec_is_rejected(self):
+        with self.assertRaises(ValueError):
+            choose_compression('text/plain', TEXT)
+
+    @override_settings(BLOB_COMPRESSION='auto', COMPRESSION_PROBE_BYTES=4096)
+    def test_probe_replays_the_consumed_chunks(self):
+        flags, chunks = probe_chunks(iter(pieces(TEXT)), 'text/plain')
+        self.assertEqual(flags, FLAG_ZSTD)
+        self.assertEqual(b''.join(chunks), TEXT)
+
+
+class CompressedBlobTests(SimpleTestCase):
+    def setUp(self):
+        self.key = Fernet.generate_key()
+
+    def test_compressed_blob_round_trip(self):
+        for flags in (FLAG_ZLIB, FLAG_ZSTD):
+            blob = b''.join(encrypt_stream(pieces(TEXT), self.key, segment_size=1024, flags=flags))
+            self.assertLess(len(blob), len(TEXT) // 5)
+            self.assertEqual(b''.join(decrypt_stream(io.BytesIO(blob), self.key)), TEXT)
+
+    def test_ranged_read_of_a_compressed_blob(self):
+        for flags in (FLAG_ZLIB, FLAG_ZSTD):
+            blob = b''.join(encrypt_stream(pieces(TEXT), self.key, segment_size=1024, flags=flags))
+            for start, stop in ((0, 10), (1000, 5000), (len(TEXT) - 7, len(TEXT)),
+                                (123456, 654321)):
+                with self.subTest(flags=flags, start=start, stop=stop):
+                    ranged = b''.join(decrypt_range(io.BytesIO(blob), self.key, start, stop))
+                    self.assertEqual(ranged, TEXT[start:stop])
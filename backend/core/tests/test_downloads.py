@@ -0,0 +1,123 @@
+import io
+
+from cryptography.fernet import Fernet
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils.http import http_date
+
+from core.crypto import decrypt_range, encrypt_stream
+from core.downloads import last_modified, parse_range_header
+from core.tests.helpers import StorageMixin, client_for, make_file, make_user
+
+CONTENT = bytes(range(256)) * 2
+
+
+class ParseRangeHeaderTests(SimpleTestCase):
+    def test_closed_range(self):
+        self.assertEqual(parse_range_header('bytes=0-9', 100), [(0, 10)])
+
+    def test_open_ended_range(self):
+        self.assertEqual(parse_range_header('bytes=90-', 100), [(90, 100)])
+
+    def test_suffix_range(self):
+        self.assertEqual(parse_range_header('bytes=-10', 100), [(90, 100)])
+        self.assertEqual(parse_range_header('bytes=-500', 100), [(0, 100)])
+
+    def test_range_past_the_end_is_clamped(self):
+        self.assertEqual(parse_range_header('bytes=95-200', 100), [(95, 100)])
+
+    def test_unsatisfiable_ranges(self):
+        self.assertEqual(parse_range_header('bytes=100-', 100), [])
+        self.assertEqual(parse_range_header('bytes=-0', 100), [])
+
+    def test_overlapping_and_adjacent_ranges_are_merged(self):
+        self.assertEqual(parse_range_header('bytes=20-29,0-9,10-14,25-40', 100),
+                         [(0, 15), (20, 41)])
+
+    def test_malformed_headers_are_ignored(self):
+        for header in ('items=0-9', 'bytes=', 'bytes=5', 'bytes=a-b', 'bytes=9-0'):
+            with self.subTest(header=header):
+                self.assertIsNone(parse_range_header(header, 100))
+
+
+class DecryptRangeTests(SimpleTestCase):
+    def setUp(self):
+        self.key = Fernet.generate_key()
+        self.blob = b''.join(encrypt_stream([CONTENT], self.key, segment_size=64))
+
+    def read(self, start, stop):
+        return b''.join(decrypt_range(io.BytesIO(self.blob), self.key, start, stop))
+
+    def test_ranges_within_and_across_segments(self):
+        for start, stop in ((0, 1), (10, 20), (60, 70), (63, 129), (0, 64), (64, 128),
+                            (500, 512), (0, len(CONTENT))):
+            with self.subTest(start=start, stop=stop):
+                self.assertEqual(self.read(start, stop), CONTENT[start:stop])
+
+    def test_stop_past_the_end(self):
+        self.assertEqual(self.read(500, 1000), CONTENT[500:])
+
+
+@override_settings(ENCRYPTION_SEGMENT_SIZE=64, BLOB_COMPRESSION='off')
+class RangeResponseTests(StorageMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        owner = make_user('owner')
+        self.file = make_file(owner, content=CONTENT)
+        self.client = client_for(owner)
+        self.url = f'/api/files/{self.file.pk}/download/'
+
+    def get(self, **headers):
+        response = self.client.get(self.url, **headers)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, body
+
+    def test_single_range_crosses_segments(self):
+        response, body = self.get(HTTP_RANGE='bytes=60-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, CONTENT[60:200])
+        self.assertEqual(response['Content-Range'], f'bytes 60-199/{len(CONTENT)}')
+        self.assertEqual(int(response['Content-Length']), 140)
+
+    def test_suffix_range(self):
+        response, body = self.get(HTTP_RANGE='bytes=-16')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, CONTENT[-16:])
+
+    def test_open_ended_range(self):
+        response, body = self.get(HTTP_RANGE='bytes=500-')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, CONTENT[500:])
+
+    def test_unsatisfiable_range_is_416(self):
+        response, _ = self.get(HTTP_RANGE=f'bytes={len(CONTENT)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(CONTENT)}')
+
+    def test_multiple_ranges_are_multipart(self):
+        response, body = self.get(HTTP_RANGE='bytes=0-9,100-109')
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges; boundary='))
+        self.assertEqual(int(response['Content-Length']), len(body))
+        self.assertIn(b'Content-Range: bytes 0-9/512\r\n\r\n' + CONTENT[0:10], body)
+        self.assertIn(b'Content-Range: bytes 100-109/512\r\n\r\n' + CONTENT[100:110], body)
+
+    def test_matching_if_range_serves_the_range(self):
+        etag = self.client.get(self.url)['ETag']
+        response, body = self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, CONTENT[:10])
+        date = http_date(last_modified(self.file))
+        response, _ = self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=date)
+        self.assertEqual(response.status_code, 206)
+
+    def test_if_range_mismatch_serves_the_whole_file(self):
+        for validator in ('"other"', 'W/"weak"', 'Mon, 01 Jan 2001 00:00:00 GMT'):
+            with self.subTest(validator=validator):
+                response, body = self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=validator)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(body, CONTENT)
+
+    def test_malformed_range_serves_the_whole_file(self):
+        response, body = self.get(HTTP_RANGE='bytes=oops')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, CONTENT)
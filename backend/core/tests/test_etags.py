@@ -0,0 +1,117 @@
+from datetime import datetime, timedelta
+from unittest import mock
+
+from django.test import TestCase
+
+from core.etags import current_version
+from core.links import claim_access, release_access
+from core.models import FileShare, ShareableLink, User
+from core.tests.helpers import StorageMixin, client_for, make_file, make_user
+
+
+class ListETagTests(StorageMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = make_user('owner')
+        self.recipient = make_user('recipient')
+        self.client = client_for(self.owner)
+        self.file = make_file(self.owner)
+
+    def etag(self, url='/api/files/', client=None):
+        response = (client or self.client).get(url)
+        self.assertEqual(response.status_code, 200)
+        return response['ETag']
+
+    def add_link(self, expires_in=timedelta(days=1), **fields):
+        return ShareableLink.objects.create(
+            file=self.file, created_by=self.owner,
+            expires_at=datetime.now() + expires_in, **fields
+        )
+
+    def test_current_tag_gets_304(self):
+        for url in ('/api/files/', '/api/shares/', '/api/links/'):
+            with self.subTest(url=url):
+                etag = self.etag(url)
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response['ETag'], etag)
+                self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='"stale"').status_code, 200)
+
+    def test_tag_depends_on_the_query(self):
+        self.assertNotEqual(self.etag('/api/files/'), self.etag('/api/files/?search=note'))
+
+    def test_upload_and_delete_change_the_tag(self):
+        before = self.etag()
+        other = make_file(self.owner, 'other.txt')
+        uploaded = self.etag()
+        self.assertNotEqual(uploaded, before)
+        self.assertEqual(self.client.delete(f'/api/files/{other.pk}/').status_code, 204)
+        self.assertNotIn(self.etag(), (before, uploaded))
+
+    def test_sharing_changes_both_users_tags(self):
+        recipient = client_for(self.recipient)
+        owner_before = self.etag()
+        recipient_before = self.etag(client=recipient)
+        share = FileShare.objects.create(file=self.file, shared_with=self.recipient)
+        self.assertNotEqual(self.etag(), owner_before)
+        shared = self.etag(client=recipient)
+        self.assertNotEqual(shared, recipient_before)
+        share.delete()
+        self.assertNotEqual(self.etag(client=recipient), shared)
+
+    def test_link_changes_change_the_tag(self):
+        before = self.etag('/api/links/')
+        link = self.add_link()
+        created = self.etag('/api/links/')
+        self.assertNotEqual(created, before)
+        link.max_access = 3
+        link.save()
+        self.assertNotIn(self.etag('/api/links/'), (before, created))
+
+    def test_link_accesses_change_the_tag(self):
+        link = self.add_link(max_access=5)
+        before = self.etag('/api/links/')
+        self.assertTrue(claim_access(link.pk))
+        claimed = self.etag('/api/links/')
+        self.assertNotEqual(claimed, before)
+        release_access(link.pk, 1)
+        self.assertNotIn(self.etag('/api/links/'), (before, claimed))
+
+    def test_link_download_changes_the_tag(self):
+        link = self.add_link()
+        before = self.etag('/api/links/')
+        response = self.client.get(f'/api/links/{link.pk}/download/')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(self.etag('/api/links/'), before)
+
+    def test_expiry_changes_the_tag_once(self):
+        self.add_link(expires_in=timedelta(hours=1))
+        self.add_link(expires_in=timedelta(hours=2))
+        before = self.etag('/api/links/')
+        later = datetime.now() + timedelta(minutes=90)
+        with mock.patch('core.etags.datetime', mock.Mock(now=lambda: later)):
+            expired = self.etag('/api/links/')
+            self.assertNotEqual(expired, before)
+            self.assertEqual(self.etag('/api/links/'), expired)
+            self.assertEqual(
+                self.client.get('/api/links/', HTTP_IF_NONE_MATCH=expired).status_code, 304
+            )
+
+    def test_user_changes_only_bump_shown_fields(self):
+        FileShare.objects.create(file=self.file, shared_with=self.recipient)
+        recipient = client_for(self.recipient)
+        before = self.etag('/api/shares/', client=recipient)
+        owner = User.objects.get(pk=self.owner.pk)
+        owner.last_login = datetime.now()
+        owner.save(update_fields=['last_login'])
+        owner.first_name = 'Owner'
+        owner.save()
+        self.assertEqual(self.etag('/api/shares/', client=recipient), before)
+        owner.email = 'renamed@example.com'
+        owner.save()
+        self.assertNotEqual(self.etag('/api/shares/', client=recipient), before)
+
+    def test_checking_the_tag_is_one_lookup(self):
+        self.add_link(max_access=5)
+        with self.assertNumQueries(1):
+            current_version(self.owner)
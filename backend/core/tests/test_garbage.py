@@ -0,0 +1,92 @@
+import os
+import time
+from datetime import datetime, timedelta
+from unittest import mock
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.test import TestCase
+
+from core import garbage
+from core.blobstore import get_blob_store
+from core.links import claim_access
+from core.models import PreviewCacheEntry, ShareableLink
+from core.tests.helpers import StorageMixin, make_file, make_user
+
+
+def age(path, seconds):
+    then = time.time() - seconds
+    os.utime(path, (then, then))
+
+
+class GarbageCollectionTests(StorageMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = make_user('owner')
+        self.file = make_file(self.owner)
+
+    def make_link(self, **fields):
+        fields.setdefault('expires_at', datetime.now() + timedelta(days=1))
+        return ShareableLink.objects.create(file=self.file, created_by=self.owner, **fields)
+
+    def test_expired_and_exhausted_links_share_the_retention(self):
+        long_ago = datetime.now() - timedelta(days=2)
+        expired_long_ago = self.make_link(expires_at=long_ago)
+        expired_just_now = self.make_link(expires_at=datetime.now() - timedelta(minutes=1))
+        exhausted_long_ago = self.make_link(max_access=1, access_count=1, exhausted_at=long_ago)
+        exhausted_just_now = self.make_link(max_access=1)
+        self.assertTrue(claim_access(exhausted_just_now.pk))
+        raised_since = self.make_link(max_access=5, access_count=1, exhausted_at=long_ago)
+
+        self.assertEqual(garbage.delete_dead_links(), 2)
+        remaining = set(ShareableLink.objects.values_list('pk', flat=True))
+        self.assertNotIn(expired_long_ago.pk, remaining)
+        self.assertNotIn(exhausted_long_ago.pk, remaining)
+        self.assertEqual(remaining, {expired_just_now.pk, exhausted_just_now.pk, raised_since.pk})
+
+    def test_claiming_the_last_access_stamps_the_link(self):
+        link = self.make_link(max_access=2)
+        self.assertTrue(claim_access(link.pk))
+        link.refresh_from_db()
+        self.assertIsNone(link.exhausted_at)
+        self.assertTrue(claim_access(link.pk))
+        link.refresh_from_db()
+        self.assertIsNotNone(link.exhausted_at)
+
+    def test_unreferenced_previews_are_swept(self):
+        kept = default_storage.save(f'previews/{self.file.pk}/kept.bin', ContentFile(b'kept'))
+        PreviewCacheEntry.objects.create(file=self.file, params_key='kept', path=kept,
+                                         content_type='image/png', size=4)
+        orphan = default_storage.save(f'previews/{self.file.pk}/orphan.bin', ContentFile(b'orphan'))
+        fresh = default_storage.save(f'previews/{self.file.pk}/fresh.bin', ContentFile(b'fresh'))
+        for name in (kept, orphan):
+            age(default_storage.path(name), 2 * 24 * 3600)
+
+        self.assertEqual(garbage.sweep_preview_files(dry_run=True), (1, 6))
+        self.assertTrue(default_storage.exists(orphan))
+        self.assertEqual(garbage.sweep_preview_files(), (1, 6))
+        self.assertFalse(default_storage.exists(orphan))
+        self.assertTrue(default_storage.exists(kept))
+        self.assertTrue(default_storage.exists(fresh))
+
+    def test_orphan_rows_are_found_from_the_listing(self):
+        lost = make_file(self.owner, 'lost.txt')
+        make_file(self.owner, 'other.txt')
+        store = get_blob_store()
+        store.delete(lost.file.name)
+        listing = garbage.list_blobs(store)
+
+        with mock.patch.object(type(store), 'exists', autospec=True,
+                               side_effect=lambda self, name: os.path.isfile(self.path(name))) as exists:
+            self.assertEqual(garbage.find_orphan_rows(listing=listing), [lost.pk])
+        # Only the name the listing lacked is checked against the store
+        self.assertEqual(exists.call_count, 1)
+        self.assertTrue(type(lost).objects.filter(pk=lost.pk).exists())
+
+    def test_unreferenced_blobs_are_deleted(self):
+        store = get_blob_store()
+        store.save('blobs/ff/ff/stray', [b'stray'])
+        age(store.path('blobs/ff/ff/stray'), 2 * 24 * 3600)
+        self.assertEqual(garbage.delete_orphan_blobs(), (1, 5))
+        self.assertFalse(store.exists('blobs/ff/ff/stray'))
+        self.assertTrue(store.exists(self.file.file.name))
@@ -0,0 +1,79 @@
+import time
+from datetime import timedelta
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from core import jobs
+from core.jobs import JobRunner
+from core.models import Job
+
+
+@mock.patch('core.jobs.os.register_at_fork')
+@mock.patch.object(JobRunner, 'start')
+class JobRunnerAutostartTests(SimpleTestCase):
+    @override_settings(JOBS_MODE='thread', JOBS_AUTOSTART=True)
+    def test_thread_mode_starts_at_startup(self, start, register_at_fork):
+        runner = JobRunner()
+        runner.autostart()
+        runner.autostart()
+        self.assertEqual(start.call_count, 2)
+        register_at_fork.assert_called_once_with(after_in_child=runner._after_fork)
+
+    @override_settings(JOBS_MODE='thread', JOBS_AUTOSTART=True)
+    def test_forked_child_restarts_the_pool(self, start, register_at_fork):
+        runner = JobRunner()
+        runner.autostart()
+        start.reset_mock()
+        runner._after_fork()
+        start.assert_called_once_with()
+
+    @override_settings(JOBS_MODE='worker', JOBS_AUTOSTART=True)
+    def test_worker_mode_leaves_jobs_to_run_jobs(self, start, register_at_fork):
+        JobRunner().autostart()
+        start.assert_not_called()
+
+    @override_settings(JOBS_MODE='thread', JOBS_AUTOSTART=False)
+    def test_autostart_can_be_disabled(self, start, register_at_fork):
+        JobRunner().autostart()
+        start.assert_not_called()
+
+
+class HeartbeatTests(TransactionTestCase):
+    def setUp(self):
+        self.addCleanup(jobs._handlers.pop, 'test-slow', None)
+        self.seen = []
+
+        @jobs.register('test-slow')
+        def slow():
+            first = Job.objects.get(name='test-slow').locked_at
+            time.sleep(0.3)
+            self.seen.append((first, Job.objects.get(name='test-slow').locked_at))
+
+    @override_settings(JOBS_MODE='worker', JOBS_HEARTBEAT_INTERVAL=0.05)
+    def test_running_job_keeps_its_lock_fresh(self):
+        jobs.enqueue('test-slow')
+        job = jobs.claim('test-worker')
+        self.assertTrue(jobs.run(job))
+        first, last = self.seen[0]
+        self.assertGreater(last, first)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.locked_at), ('done', None))
+
+
+class RecoverStaleTests(TestCase):
+    def running(self, locked_for):
+        return Job.objects.create(
+            name='test', status='running', locked_by='gone:1:0',
+            locked_at=timezone.now() - timedelta(seconds=locked_for),
+        )
+
+    @override_settings(JOBS_LOCK_TIMEOUT=120)
+    def test_only_jobs_without_a_recent_heartbeat_are_requeued(self):
+        stale, alive = self.running(121), self.running(30)
+        self.assertEqual(jobs.recover_stale(), 1)
+        stale.refresh_from_db()
+        alive.refresh_from_db()
+        self.assertEqual((stale.status, stale.locked_by, stale.locked_at), ('queued', '', None))
+        self.assertEqual(alive.status, 'running')
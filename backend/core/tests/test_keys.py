@@ -0,0 +1,192 @@
+import base64
+import os
+from unittest import mock
+
+from cryptography.fernet import Fernet
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from core import keys
+from core.blobstore import BLOB_PREFIX, get_blob_store
+from core.keys import (
+    DataKeyCache, is_wrapped, key_version, reload_master_keys, rewrap_key, unwrap_key, wrap_key,
+)
+from core.models import EncryptedFile, UploadSession
+from core.tests.helpers import StorageMixin, make_file, make_user
+from core.uploads import create_upload_session
+from core.utils import get_decrypted_file, reencrypt_file
+
+
+def master_key():
+    return base64.urlsafe_b64encode(os.urandom(32)).decode()
+
+
+class MasterKeysMixin:
+    """Configure master keys for a test, dropping the loaded ones around it."""
+
+    def use_master_keys(self, master_keys):
+        overrides = override_settings(MASTER_KEYS=master_keys, MASTER_KEY_FILE=None,
+                                      MASTER_KEY_VERSION=None)
+        overrides.enable()
+        self.addCleanup(reload_master_keys)
+        self.addCleanup(overrides.disable)
+        reload_master_keys()
+
+
+class WrapKeyTests(MasterKeysMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.use_master_keys({1: master_key(), 2: master_key()})
+        self.data_key = Fernet.generate_key()
+
+    def test_wrap_round_trip_with_the_active_version(self):
+        wrapped = wrap_key(self.data_key)
+        self.assertTrue(is_wrapped(wrapped))
+        self.assertEqual(key_version(wrapped), 2)
+        self.assertNotIn(self.data_key, wrapped)
+        self.assertEqual(unwrap_key(wrapped), self.data_key)
+
+    def test_rewrap_changes_the_version_not_the_key(self):
+        wrapped = rewrap_key(wrap_key(self.data_key, 1), 2)
+        self.assertEqual(key_version(wrapped), 2)
+        self.assertEqual(unwrap_key(wrapped), self.data_key)
+
+    def test_bare_legacy_key_is_accepted(self):
+        self.assertIsNone(key_version(self.data_key))
+        self.assertEqual(unwrap_key(self.data_key), self.data_key)
+        self.assertEqual(unwrap_key(rewrap_key(self.data_key, 1)), self.data_key)
+
+    def test_tampered_key_fails_to_unwrap(self):
+        wrapped = bytearray(wrap_key(self.data_key))
+        wrapped[-1] ^= 1
+        with self.assertRaises(ValueError):
+            unwrap_key(bytes(wrapped))
+
+    def test_unknown_version_fails_to_unwrap(self):
+        wrapped = wrap_key(self.data_key, 2)
+        self.use_master_keys({1: master_key()})
+        with self.assertRaisesRegex(ValueError, 'not configured'):
+            unwrap_key(wrapped)
+
+    def test_unwrapped_keys_are_cached(self):
+        wrapped = wrap_key(self.data_key)
+        with mock.patch('core.keys._unwrap', wraps=keys._unwrap) as unwrap:
+            unwrap_key(wrapped)
+            unwrap_key(wrapped)
+        unwrap.assert_called_once()
+
+
+class DataKeyCacheTests(SimpleTestCase):
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = DataKeyCache(max_entries=2)
+        cache.put(b'a', b'1')
+        cache.put(b'b', b'2')
+        cache.get(b'a')
+        cache.put(b'c', b'3')
+        self.assertEqual(cache.get(b'a'), b'1')
+        self.assertIsNone(cache.get(b'b'))
+        self.assertEqual(cache.get(b'c'), b'3')
+
+    def test_expired_entry_is_a_miss(self):
+        cache = DataKeyCache(ttl=-1)
+        cache.put(b'a', b'1')
+        self.assertIsNone(cache.get(b'a'))
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+    def test_clear(self):
+        cache = DataKeyCache()
+        cache.put(b'a', b'1')
+        cache.clear()
+        self.assertIsNone(cache.get(b'a'))
+
+
+class RotateMasterKeyTests(MasterKeysMixin, StorageMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.old, self.new = master_key(), master_key()
+        self.use_master_keys({1: self.old})
+        self.owner = make_user('owner')
+        self.files = [make_file(self.owner, f'f{i}.txt', f'content {i}'.encode()) for i in range(3)]
+        self.use_master_keys({1: self.old, 2: self.new})
+
+    def rotate(self, *args):
+        call_command('rotate_master_key', *args, stdout=open(os.devnull, 'w'),
+                     stderr=open(os.devnull, 'w'))
+
+    def test_rotation_rewraps_every_file_key(self):
+        self.rotate('--batch-size', '2')
+        for original in self.files:
+            encrypted_file = EncryptedFile.objects.get(pk=original.pk)
+            self.assertEqual(encrypted_file.key_version, 2)
+            self.assertEqual(key_version(encrypted_file.encryption_key), 2)
+            self.assertEqual(get_decrypted_file(encrypted_file), get_decrypted_file(original))
+        # The old master key is no longer needed
+        self.use_master_keys({2: self.new})
+        for original in self.files:
+            get_decrypted_file(EncryptedFile.objects.get(pk=original.pk))
+
+    def test_key_changed_during_rotation_is_retried(self):
+        real_rewrap = rewrap_key
+        calls = []
+
+        def rewrap(stored, version):
+            calls.append(bytes(stored))
+            if len(calls) == 1:
+                # Someone else rewraps the row between the read and the update
+                EncryptedFile.objects.filter(encryption_key=bytes(stored)).update(
+                    encryption_key=real_rewrap(stored, 1)
+                )
+            return real_rewrap(stored, version)
+
+        with mock.patch('core.management.commands.rotate_master_key.rewrap_key', side_effect=rewrap):
+            self.rotate()
+        self.assertEqual(len(calls), len(self.files) + 1)
+        for original in self.files:
+            encrypted_file = EncryptedFile.objects.get(pk=original.pk)
+            self.assertEqual(encrypted_file.key_version, 2)
+            self.assertEqual(get_decrypted_file(encrypted_file), get_decrypted_file(original))
+
+    def test_unreadable_keys_are_skipped(self):
+        broken = bytearray(wrap_key(Fernet.generate_key(), 1))
+        broken[-1] ^= 1
+        broken = bytes(broken)
+        EncryptedFile.objects.filter(pk=self.files[0].pk).update(encryption_key=broken)
+        session = create_upload_session(self.owner, 'big.txt', 10)
+        UploadSession.objects.filter(pk=session.pk).update(encryption_key=broken)
+        healthy = create_upload_session(self.owner, 'other.txt', 10)
+        UploadSession.objects.filter(pk=healthy.pk).update(
+            encryption_key=rewrap_key(healthy.encryption_key, 1)
+        )
+        self.rotate()
+        self.assertEqual(EncryptedFile.objects.filter(key_version=2).count(), 2)
+        self.assertEqual(bytes(UploadSession.objects.get(pk=session.pk).encryption_key), broken)
+        healthy = UploadSession.objects.get(pk=healthy.pk)
+        self.assertEqual(key_version(healthy.encryption_key), 2)
+        unwrap_key(healthy.encryption_key)
+
+
+class ReencryptFileTests(StorageMixin, TestCase):
+    def test_rewrites_the_blob_under_a_new_key(self):
+        encrypted_file = make_file(make_user('owner'), content=b'payload')
+        old_name = encrypted_file.file.name
+        reencrypt_file(encrypted_file, Fernet.generate_key())
+        stored = EncryptedFile.objects.get(pk=encrypted_file.pk)
+        self.assertNotEqual(stored.file.name, old_name)
+        self.assertEqual(get_decrypted_file(stored), b'payload')
+
+    def test_row_changed_meanwhile_is_left_alone(self):
+        encrypted_file = make_file(make_user('owner'), content=b'payload')
+        stale = EncryptedFile.objects.get(pk=encrypted_file.pk)
+        current = rewrap_key(stale.encryption_key)
+        EncryptedFile.objects.filter(pk=stale.pk).update(encryption_key=current)
+        store = get_blob_store()
+        before = {name for name, _, _ in store.list(BLOB_PREFIX)}
+
+        with self.assertRaisesRegex(ValueError, 'changed'):
+            reencrypt_file(stale, Fernet.generate_key())
+        stored = EncryptedFile.objects.get(pk=stale.pk)
+        self.assertEqual(bytes(stored.encryption_key), current)
+        self.assertEqual(stored.file.name, encrypted_file.file.name)
+        # The rewritten blob is dropped again
+        self.assertEqual({name for name, _, _ in store.list(BLOB_PREFIX)}, before)
+        self.assertEqual(get_decrypted_file(stored), b'payload')
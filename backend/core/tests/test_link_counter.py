@@ -0,0 +1,125 @@
+import threading
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+from django.db import connection
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from core.links import LinkAccessCounter, link_counter
+from core.models import ShareableLink
+from core.tests.helpers import StorageMixin, make_file, make_user
+
+THREADS = 8
+CLAIMS_PER_THREAD = 10
+MAX_ACCESS = 13
+
+
+class ConcurrentLinkClaimTests(StorageMixin, TransactionTestCase):
+    def setUp(self):
+        # Needs a test database the threads can share: PostgreSQL or a
+        # SQLite file (see DATABASES['default']['TEST'])
+        self.assertFalse(connection.vendor == 'sqlite' and connection.is_in_memory_db())
+        super().setUp()
+        owner = make_user('owner')
+        self.link = ShareableLink.objects.create(
+            file=make_file(owner), created_by=owner,
+            expires_at=datetime.now() + timedelta(days=1), max_access=MAX_ACCESS,
+        )
+        self.addCleanup(link_counter.flush)
+
+    def claim_concurrently(self):
+        barrier = threading.Barrier(THREADS)
+        results = []
+        errors = []
+
+        def worker():
+            try:
+                link = ShareableLink.objects.get(pk=self.link.pk)
+                barrier.wait()
+                for _ in range(CLAIMS_PER_THREAD):
+                    results.append(link_counter.claim(link))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), THREADS * CLAIMS_PER_THREAD)
+        return results
+
+    @override_settings(LINK_COUNTER_MODE='atomic')
+    def test_atomic_claims_stop_at_max_access(self):
+        results = self.claim_concurrently()
+        self.assertEqual(results.count(True), MAX_ACCESS)
+        self.link.refresh_from_db()
+        self.assertEqual(self.link.access_count, MAX_ACCESS)
+
+    @override_settings(LINK_COUNTER_MODE='buffered', LINK_COUNTER_HOT_THRESHOLD=2,
+                       LINK_COUNTER_LEASE_SIZE=4, LINK_COUNTER_FLUSH_INTERVAL=3600)
+    def test_buffered_claims_stop_at_max_access(self):
+        results = self.claim_concurrently()
+        self.assertEqual(results.count(True), MAX_ACCESS)
+        link_counter.flush()
+        self.link.refresh_from_db()
+        self.assertEqual(self.link.access_count, MAX_ACCESS)
+
+    @override_settings(LINK_COUNTER_MODE='buffered', LINK_COUNTER_HOT_THRESHOLD=2,
+                       LINK_COUNTER_LEASE_SIZE=4, LINK_COUNTER_FLUSH_INTERVAL=3600)
+    def test_buffered_flush_returns_unused_accesses(self):
+        link = ShareableLink.objects.get(pk=self.link.pk)
+        successes = sum(link_counter.claim(link) for _ in range(5))
+        self.assertEqual(successes, 5)
+        link_counter.flush()
+        self.link.refresh_from_db()
+        self.assertEqual(self.link.access_count, 5)
+
+
+@override_settings(LINK_COUNTER_MODE='buffered', LINK_COUNTER_HOT_THRESHOLD=0,
+                   LINK_COUNTER_LEASE_SIZE=4)
+class LeaseRefillTests(SimpleTestCase):
+    def setUp(self):
+        self.counter = LinkAccessCounter()
+        # No background flushing
+        self.counter._flusher = object()
+
+    def link(self, pk):
+        return SimpleNamespace(pk=pk, expires_at=datetime.now() + timedelta(days=1))
+
+    def test_slow_refill_does_not_block_other_links(self):
+        refilling = threading.Event()
+        release = threading.Event()
+
+        def claim_access(link_id, count=1):
+            if link_id == 'slow':
+                refilling.set()
+                release.wait(5)
+            return True
+
+        with mock.patch('core.links.claim_access', side_effect=claim_access):
+            slow = threading.Thread(target=self.counter.claim, args=(self.link('slow'),))
+            slow.start()
+            self.assertTrue(refilling.wait(5))
+            # Served while the other link's refill is stuck in the database
+            self.assertTrue(self.counter.claim(self.link('fast')))
+            self.assertTrue(slow.is_alive())
+            release.set()
+            slow.join()
+
+    def test_waiting_claims_use_the_refilled_lease(self):
+        calls = []
+
+        def claim_access(link_id, count=1):
+            calls.append(count)
+            return True
+
+        with mock.patch('core.links.claim_access', side_effect=claim_access):
+            link = self.link('hot')
+            self.assertTrue(all(self.counter.claim(link) for _ in range(4)))
+        # One lease of four served every claim
+        self.assertEqual(calls, [4])
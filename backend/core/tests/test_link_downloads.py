@@ -0,0 +1,98 @@
+from datetime import datetime, timedelta
+from unittest import mock
+
+from django.test import TestCase
+from rest_framework.exceptions import Throttled
+from rest_framework.test import APIClient
+
+from core.links import RANGE_TOKEN_COOKIE
+from core.models import ShareableLink
+from core.tests.helpers import StorageMixin, make_file, make_user
+
+
+class LinkDownloadTests(StorageMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        owner = make_user('owner')
+        self.link = ShareableLink.objects.create(
+            file=make_file(owner, content=b'shared content\n'), created_by=owner,
+            expires_at=datetime.now() + timedelta(days=1), max_access=1,
+        )
+        self.client = APIClient()
+        self.url = f'/api/links/{self.link.pk}/download/'
+
+    def test_download_counts_an_access_and_charges_its_size(self):
+        with mock.patch('core.views.throttle_bytes') as throttle_bytes:
+            response = self.client.get(self.url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b''.join(response.streaming_content), b'shared content\n')
+        throttle_bytes.assert_called_once_with(mock.ANY, 'download_bytes', len(b'shared content\n'))
+        self.link.refresh_from_db()
+        self.assertEqual(self.link.access_count, 1)
+
+    def test_exhausted_link_is_not_charged(self):
+        ShareableLink.objects.filter(pk=self.link.pk).update(access_count=1)
+        with mock.patch('core.views.throttle_bytes') as throttle_bytes:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 403)
+        throttle_bytes.assert_not_called()
+
+    def test_throttled_download_gives_the_access_back(self):
+        with mock.patch('core.views.throttle_bytes', side_effect=Throttled(60)):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 429)
+        self.link.refresh_from_db()
+        self.assertEqual(self.link.access_count, 0)
+        self.assertIsNone(self.link.exhausted_at)
+
+    def test_ranged_request_counts_an_access_and_sets_a_range_token(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-5')
+        self.assertEqual(response.status_code, 206)
+        self.assertIn(RANGE_TOKEN_COOKIE, response.cookies)
+        self.assertEqual(response.cookies[RANGE_TOKEN_COOKIE]['path'], self.url)
+        self.link.refresh_from_db()
+        self.assertEqual(self.link.access_count, 1)
+
+    def test_ranges_with_the_token_are_not_counted_again(self):
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=0-5').status_code, 206)
+        for header in ('bytes=6-', 'bytes=0-5', 'bytes=-3'):
+            response = self.client.get(self.url, HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 206)
+        self.link.refresh_from_db()
+        self.assertEqual(self.link.access_count, 1)
+
+    def test_range_without_a_token_is_counted(self):
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=6-').status_code, 206)
+        response = APIClient().get(self.url, HTTP_RANGE='bytes=6-')
+        self.assertEqual(response.status_code, 403)
+
+    def test_full_download_is_counted_even_with_a_token(self):
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=0-5').status_code, 206)
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    def test_expired_token_is_counted(self):
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=0-5').status_code, 206)
+        with self.settings(LINK_RANGE_TOKEN_TTL=-1):
+            response = self.client.get(self.url, HTTP_RANGE='bytes=6-')
+        self.assertEqual(response.status_code, 403)
+
+    def test_token_for_another_link_is_counted(self):
+        other = ShareableLink.objects.create(
+            file=self.link.file, created_by=self.link.created_by,
+            expires_at=datetime.now() + timedelta(days=1), max_access=1,
+        )
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=0-5').status_code, 206)
+        url = f'/api/links/{other.pk}/download/'
+        self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=6-').status_code, 206)
+        other.refresh_from_db()
+        self.assertEqual(other.access_count, 1)
+
+    def test_token_does_not_outlive_the_link(self):
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=0-5').status_code, 206)
+        ShareableLink.objects.filter(pk=self.link.pk).update(expires_at=datetime.now() - timedelta(seconds=1))
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=6-').status_code, 403)
+
+    def test_stale_if_range_with_a_token_is_counted(self):
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=0-5').status_code, 206)
+        response = self.client.get(self.url, HTTP_RANGE='bytes=6-', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 403)
@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from core.models import FileShare, ShareableLink
+from core.tests.helpers import StorageMixin, client_for, make_file, make_user
+
+
+class ListQueryCountTests(StorageMixin, TestCase):
+    """List endpoints cost a fixed number of queries, however many rows they return."""
+
+    def setUp(self):
+        super().setUp()
+        self.owner = make_user('owner')
+        self.recipient = make_user('recipient')
+        self.client = client_for(self.owner)
+
+    def add_rows(self, count):
+        for i in range(count):
+            file = make_file(self.owner, f'file{i}.txt')
+            FileShare.objects.create(file=file, shared_with=self.recipient)
+            ShareableLink.objects.create(
+                file=file, created_by=self.owner,
+                expires_at=datetime.now() + timedelta(days=1), max_access=5,
+            )
+
+    def assert_constant_queries(self, url):
+        self.add_rows(2)
+        with CaptureQueriesContext(connection) as few:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 2)
+
+        self.add_rows(6)
+        with self.assertNumQueries(len(few.captured_queries)):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 8)
+
+    def test_files_list(self):
+        self.assert_constant_queries('/api/files/')
+
+    def test_shares_list(self):
+        self.assert_constant_queries('/api/shares/')
+
+    def test_links_list(self):
+        self.assert_constant_queries('/api/links/')
+
+    def test_shared_files_list_for_recipient(self):
+        self.client = client_for(self.recipient)
+        self.assert_constant_queries('/api/files/')
@@ -0,0 +1,32 @@
+from unittest import mock
+
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from core.middleware import MetricsMiddleware
+
+
+@override_settings(METRICS_ENABLED=True, SERVER_TIMING=False)
+@mock.patch('core.middleware.registry')
+class MetricsMiddlewareTests(SimpleTestCase):
+    def call(self, response):
+        middleware = MetricsMiddleware(lambda request: response)
+        return middleware(RequestFactory().get('/api/files/'))
+
+    def test_plain_response_is_recorded_at_once(self, registry):
+        self.call(HttpResponse(b'ok'))
+        registry.record.assert_called_once()
+
+    def test_streamed_response_is_recorded_once_sent(self, registry):
+        response = self.call(StreamingHttpResponse(iter([b'a', b'b'])))
+        registry.record.assert_not_called()
+        self.assertEqual(b''.join(response.streaming_content), b'ab')
+        registry.record.assert_called_once()
+        response.close()
+        registry.record.assert_called_once()
+
+    def test_abandoned_stream_is_recorded_on_close(self, registry):
+        response = self.call(StreamingHttpResponse(iter([b'a', b'b'])))
+        next(iter(response.streaming_content))
+        response.close()
+        registry.record.assert_called_once()
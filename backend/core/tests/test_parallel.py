@@ -0,0 +1,182 @@
+import io
+import os
+import threading
+from contextlib import ExitStack
+from unittest import mock
+
+from cryptography.fernet import Fernet
+from django.test import SimpleTestCase
+
+from core import crypto
+from core.compression import FLAG_ZLIB, FLAG_ZSTD
+from core.crypto import SegmentEncryptor, decrypt_stream, encrypt_stream
+from core.parallel import SegmentEngine
+from core.utils import generate_encryption_key
+
+SEGMENT_SIZE = 1024
+
+
+def pieces(data, sizes=(1, 700, 1024, 3000, 5)):
+    """``data`` cut into uneven pieces, as uploads arrive off the wire."""
+    position = 0
+    index = 0
+    while position < len(data):
+        size = sizes[index % len(sizes)]
+        yield data[position:position + size]
+        position += size
+        index += 1
+
+
+def fixed_salt():
+    """Give every new header the same salt so blobs can be compared byte for byte."""
+    salt = os.urandom(crypto.SALT_SIZE)
+    real_new_header = crypto.new_header
+
+    def new_header(segment_size=None, flags=0):
+        return real_new_header(segment_size, flags)._replace(salt=salt)
+
+    stack = ExitStack()
+    for target in ('core.crypto.new_header', 'core.parallel.new_header'):
+        stack.enter_context(mock.patch(target, side_effect=new_header))
+    return stack
+
+
+def push(encryptor, data):
+    blob = [encryptor.header_bytes]
+    for piece in pieces(data):
+        blob += encryptor.update(piece)
+    blob += encryptor.finalize()
+    return b''.join(blob)
+
+
+class ParallelSegmentEncryptorTests(SimpleTestCase):
+    def setUp(self):
+        self.key = generate_encryption_key()
+        self.engines = [SegmentEngine(workers=1), SegmentEngine(workers=4, window=3)]
+        for engine in self.engines:
+            self.addCleanup(engine.shutdown)
+
+    def decrypt(self, blob):
+        return b''.join(decrypt_stream(io.BytesIO(blob), self.key))
+
+    def test_round_trip(self):
+        for engine in self.engines:
+            for size in (0, 1, SEGMENT_SIZE - 1, SEGMENT_SIZE, SEGMENT_SIZE + 1, 20 * SEGMENT_SIZE + 7):
+                with self.subTest(workers=engine.workers, size=size):
+                    data = os.urandom(size)
+                    encryptor = engine.encryptor(self.key, segment_size=SEGMENT_SIZE)
+                    self.assertEqual(self.decrypt(push(encryptor, data)), data)
+
+    def test_compressed_round_trip(self):
+        data = b'compressible text\n' * 5000
+        for engine in self.engines:
+            with self.subTest(workers=engine.workers):
+                encryptor = engine.encryptor(self.key, segment_size=SEGMENT_SIZE, flags=FLAG_ZLIB)
+                self.assertEqual(self.decrypt(push(encryptor, data)), data)
+
+    def test_same_layout_as_the_sequential_encryptor(self):
+        data = os.urandom(10 * SEGMENT_SIZE + 3)
+        sequential = SegmentEncryptor(self.key, segment_size=SEGMENT_SIZE)
+        parallel = self.engines[1].encryptor(self.key, segment_size=SEGMENT_SIZE)
+        self.assertEqual(len(push(parallel, data)), len(push(sequential, data)))
+
+    def test_in_flight_segments_are_bounded_by_the_window(self):
+        engine = self.engines[1]
+        encryptor = engine.encryptor(self.key, segment_size=SEGMENT_SIZE)
+        for piece in pieces(os.urandom(50 * SEGMENT_SIZE)):
+            encryptor.update(piece)
+            self.assertLessEqual(len(encryptor._pending), engine.window)
+        encryptor.abort()
+        self.assertEqual(len(encryptor._pending), 0)
+
+
+class SegmentEngineTests(SimpleTestCase):
+    def setUp(self):
+        self.key = generate_encryption_key()
+        self.engines = [SegmentEngine(workers=1), SegmentEngine(workers=4, window=3)]
+        for engine in self.engines:
+            self.addCleanup(engine.shutdown)
+
+    def test_encrypt_matches_encrypt_stream(self):
+        for flags in (0, FLAG_ZLIB, FLAG_ZSTD):
+            for size in (0, 1, SEGMENT_SIZE, 20 * SEGMENT_SIZE + 7):
+                data = os.urandom(size // 2) + b'a' * (size - size // 2)
+                with fixed_salt():
+                    expected = b''.join(encrypt_stream(pieces(data), self.key, SEGMENT_SIZE, flags))
+                    for engine in self.engines:
+                        with self.subTest(flags=flags, size=size, workers=engine.workers):
+                            blob = b''.join(engine.encrypt(pieces(data), self.key, SEGMENT_SIZE, flags))
+                            self.assertEqual(blob, expected)
+
+    def test_decrypt_matches_decrypt_stream(self):
+        data = b'compressible text\n' * 3000 + os.urandom(5000)
+        blobs = [
+            b''.join(encrypt_stream(pieces(data), self.key, SEGMENT_SIZE, flags))
+            for flags in (0, FLAG_ZLIB, FLAG_ZSTD)
+        ]
+        blobs += [b''.join(encrypt_stream([], self.key, SEGMENT_SIZE))]
+        for blob in blobs:
+            expected = list(decrypt_stream(io.BytesIO(blob), self.key))
+            for engine in self.engines:
+                with self.subTest(length=len(blob), workers=engine.workers):
+                    self.assertEqual(list(engine.decrypt(io.BytesIO(blob), self.key)), expected)
+
+    def test_decrypt_reads_legacy_fernet_blobs(self):
+        key = Fernet.generate_key()
+        blob = Fernet(key).encrypt(b'legacy payload')
+        for engine in self.engines:
+            with self.subTest(workers=engine.workers):
+                self.assertEqual(b''.join(engine.decrypt(io.BytesIO(blob), key)), b'legacy payload')
+
+    def test_decrypt_rejects_what_decrypt_stream_rejects(self):
+        blob = bytearray(b''.join(encrypt_stream([os.urandom(5 * SEGMENT_SIZE)], self.key,
+                                                 SEGMENT_SIZE)))
+        blob[-1] ^= 1
+        for engine in self.engines:
+            with self.subTest(workers=engine.workers):
+                with self.assertRaises(ValueError):
+                    b''.join(engine.decrypt(io.BytesIO(bytes(blob)), self.key))
+                with self.assertRaises(ValueError):
+                    b''.join(engine.decrypt(io.BytesIO(bytes(blob[:-100])), self.key))
+
+
+class MapOrderedTests(SimpleTestCase):
+    def setUp(self):
+        self.engine = SegmentEngine(workers=2, window=4)
+        self.addCleanup(self.engine.shutdown)
+
+    def test_results_come_in_submission_order(self):
+        def slow_first(index):
+            if index == 0:
+                threading.Event().wait(0.05)
+            return index
+
+        results = self.engine.map_ordered(slow_first, ((i,) for i in range(20)))
+        self.assertEqual(list(results), list(range(20)))
+
+    def test_stopping_early_cancels_pending_jobs(self):
+        release = threading.Event()
+        started = []
+        submitted = []
+
+        def job(index):
+            started.append(index)
+            if index:
+                release.wait(5)
+            return index
+
+        def jobs():
+            for index in range(10):
+                submitted.append(index)
+                yield (index,)
+
+        results = self.engine.map_ordered(job, jobs())
+        self.assertEqual(next(results), 0)
+        # Only a window's worth of jobs was taken from the iterator
+        self.assertEqual(submitted, [0, 1, 2, 3])
+        results.close()
+        release.set()
+        self.engine.shutdown()
+        # At most two jobs were running; the last one was still queued and never ran
+        self.assertIn(1, started)
+        self.assertNotIn(3, started)
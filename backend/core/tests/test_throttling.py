@@ -0,0 +1,107 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from core import throttling
+from core.throttling import MemoryRateLimitStore, SQLiteRateLimitStore, consume, parse_rate
+
+
+class ParseRateTests(SimpleTestCase):
+    def test_rates(self):
+        self.assertEqual(parse_rate('100/day'), (100, 86400))
+        self.assertEqual(parse_rate('10/5m'), (10, 300))
+        self.assertEqual(parse_rate('5G/day'), (5 * 1024 ** 3, 86400))
+        self.assertEqual(parse_rate('512KB/s'), (512 * 1024, 1))
+        self.assertIsNone(parse_rate(None))
+        with self.assertRaises(ValueError):
+            parse_rate('lots')
+
+
+class SQLiteStoreTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.path = os.path.join(directory, 'ratelimit.sqlite3')
+        self.store = SQLiteRateLimitStore(self.path, timeout=0.05)
+        self.now = 1000.0
+        clock = mock.patch('core.throttling.time.time', lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def test_burst_up_to_capacity(self):
+        results = [self.store.consume('user:1', 1, 5, 60)[0] for _ in range(6)]
+        self.assertEqual(results, [True] * 5 + [False])
+
+    def test_refill_over_time(self):
+        for _ in range(5):
+            self.store.consume('user:1', 1, 5, 60)
+        allowed, wait = self.store.consume('user:1', 1, 5, 60)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(wait, 12.0)
+        self.now += 12
+        self.assertTrue(self.store.consume('user:1', 1, 5, 60)[0])
+        self.assertFalse(self.store.consume('user:1', 1, 5, 60)[0])
+        # Never refills past the capacity
+        self.now += 3600
+        results = [self.store.consume('user:1', 1, 5, 60)[0] for _ in range(6)]
+        self.assertEqual(results, [True] * 5 + [False])
+
+    def test_oversized_cost_waits_for_a_full_bucket_and_leaves_debt(self):
+        self.assertTrue(self.store.consume('bytes:1', 250, 100, 100)[0])
+        allowed, wait = self.store.consume('bytes:1', 1, 100, 100)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(wait, 151.0)
+
+    def test_keys_are_isolated(self):
+        for _ in range(2):
+            self.store.consume('upload:user:1', 1, 2, 60)
+        self.assertFalse(self.store.consume('upload:user:1', 1, 2, 60)[0])
+        self.assertTrue(self.store.consume('upload:user:2', 1, 2, 60)[0])
+        self.assertTrue(self.store.consume('download:user:1', 1, 2, 60)[0])
+
+    def test_state_is_shared_between_connections(self):
+        other = SQLiteRateLimitStore(self.path)
+        self.store.consume('user:1', 1, 2, 60)
+        self.assertTrue(other.consume('user:1', 1, 2, 60)[0])
+        self.assertFalse(self.store.consume('user:1', 1, 2, 60)[0])
+
+    def test_locked_database_raises_after_the_timeout(self):
+        self.store.consume('user:1', 1, 2, 60)
+        holder = sqlite3.connect(self.path, isolation_level=None)
+        self.addCleanup(holder.close)
+        holder.execute('BEGIN IMMEDIATE')
+        with self.assertRaises(sqlite3.OperationalError):
+            self.store.consume('user:1', 1, 2, 60)
+        holder.execute('ROLLBACK')
+        # The failed check left no transaction open
+        self.assertTrue(self.store.consume('user:1', 1, 2, 60)[0])
+
+
+@override_settings(RATE_LIMIT_ENABLED=True)
+class ConsumeTests(SimpleTestCase):
+    def setUp(self):
+        rates = {'upload': (2, 60), 'download': (2, 60)}
+        for target, value in (('core.throttling.get_rate', rates.get),
+                              ('core.throttling._store', MemoryRateLimitStore())):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_scopes_are_isolated(self):
+        self.assertEqual([consume('upload', 'user:1')[0] for _ in range(3)], [True, True, False])
+        self.assertTrue(consume('download', 'user:1')[0])
+        self.assertTrue(consume('upload', 'user:2')[0])
+
+    def test_scope_without_rate_is_not_limited(self):
+        self.assertTrue(all(consume('other', 'user:1')[0] for _ in range(10)))
+
+    def test_failing_store_lets_requests_through(self):
+        store = SQLiteRateLimitStore('/nonexistent', timeout=0.05)
+        with mock.patch.object(store, 'consume', side_effect=sqlite3.OperationalError('locked')), \
+                mock.patch.object(throttling, '_store', store), \
+                self.assertLogs('core.throttling', 'ERROR'):
+            self.assertEqual(consume('upload', 'user:1'), (True, 0.0))
@@ -0,0 +1,131 @@
+import hashlib
+import io
+from unittest import mock
+
+from django.core.files.storage import default_storage
+from django.test import TestCase, override_settings
+
+from core import uploads
+from core.blobstore import get_blob_store
+from core.models import EncryptedFile, UploadChunk
+from core.tests.helpers import StorageMixin, make_user
+from core.uploads import (
+    ChunkConflict, UploadError, complete_upload_session, create_upload_session, write_chunk,
+)
+from core.crypto import HEADER_SIZE
+from core.utils import iter_decrypted_file
+
+CONTENT = b''.join(b'line %05d of a resumable upload\n' % i for i in range(200))
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+@override_settings(ENCRYPTION_SEGMENT_SIZE=1024, UPLOAD_CHUNK_SIZE=2048)
+class UploadSessionTests(StorageMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = make_user('owner')
+        self.session = create_upload_session(self.owner, 'notes.txt', len(CONTENT))
+
+    def chunk(self, index):
+        size = self.session.chunk_size
+        return CONTENT[index * size:(index + 1) * size]
+
+    def put(self, index, data=None):
+        data = self.chunk(index) if data is None else data
+        return write_chunk(self.session, index, io.BytesIO(data), sha256(data))
+
+    def test_chunks_in_any_order_complete_to_the_content(self):
+        for index in reversed(range(self.session.total_chunks)):
+            self.put(index)
+        encrypted_file = complete_upload_session(self.session)
+        self.assertEqual(b''.join(iter_decrypted_file(encrypted_file)), CONTENT)
+        self.assertEqual(encrypted_file.content_type, 'text/plain')
+
+    def test_repeated_chunk_is_accepted_once(self):
+        first = self.put(1)
+        with mock.patch.object(uploads, '_write_segments') as write:
+            self.assertEqual(self.put(1), first)
+        write.assert_not_called()
+        self.assertEqual(UploadChunk.objects.filter(session=self.session).count(), 1)
+
+    def test_different_content_for_a_chunk_is_refused(self):
+        self.put(1)
+        other = bytes(reversed(self.chunk(1)))
+        with self.assertRaises(ChunkConflict):
+            self.put(1, other)
+
+    def test_chunk_written_before_it_is_recorded(self):
+        recorded = []
+
+        def write(fd, offset, segments):
+            recorded.append(UploadChunk.objects.filter(session=self.session).exists())
+
+        with mock.patch.object(uploads, '_write_segments', side_effect=write):
+            self.put(0)
+        self.assertEqual(recorded, [False])
+
+    def test_failed_write_records_nothing(self):
+        with mock.patch.object(uploads, '_write_segments', side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                self.put(0)
+        self.assertFalse(UploadChunk.objects.filter(session=self.session).exists())
+        self.put(0)
+
+    def put_all(self):
+        for index in range(self.session.total_chunks):
+            self.put(index)
+
+    def test_completed_file_has_the_plaintext_digest(self):
+        self.put_all()
+        encrypted_file = complete_upload_session(self.session)
+        self.assertEqual(encrypted_file.sha256, sha256(CONTENT))
+
+    def test_failed_row_insert_removes_the_stored_blob(self):
+        self.put_all()
+        saved = []
+        store = get_blob_store()
+        save_file = store.save_file
+
+        def record_save(name, path):
+            saved.append(name)
+            save_file(name, path)
+
+        with mock.patch.object(store, 'save_file', side_effect=record_save), \
+                mock.patch.object(EncryptedFile.objects, 'create', side_effect=RuntimeError("db down")):
+            with self.assertRaises(RuntimeError):
+                complete_upload_session(self.session)
+        self.assertEqual(len(saved), 1)
+        self.assertFalse(store.exists(saved[0]))
+
+
+@override_settings(UPLOAD_SESSION_MAX_SIZE=1000, UPLOAD_SESSION_QUOTA=1500,
+                   UPLOAD_SESSIONS_MAX_OPEN=3)
+class UploadSessionLimitTests(StorageMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = make_user('owner')
+
+    def test_blob_is_not_preallocated(self):
+        session = create_upload_session(self.owner, 'big.txt', 1000)
+        self.assertEqual(default_storage.size(session.blob_path), HEADER_SIZE)
+
+    def test_size_above_the_maximum_is_refused(self):
+        with self.assertRaises(UploadError):
+            create_upload_session(self.owner, 'big.txt', 1001)
+
+    def test_open_sessions_count_against_the_quota(self):
+        create_upload_session(self.owner, 'a.txt', 1000)
+        with self.assertRaises(UploadError):
+            create_upload_session(self.owner, 'b.txt', 600)
+        create_upload_session(self.owner, 'b.txt', 500)
+        # Other users have their own quota
+        create_upload_session(make_user('other'), 'c.txt', 1000)
+
+    def test_number_of_open_sessions_is_limited(self):
+        for i in range(3):
+            create_upload_session(self.owner, f'{i}.txt', 10)
+        with self.assertRaises(UploadError):
+            create_upload_session(self.owner, 'one-more.txt', 10)
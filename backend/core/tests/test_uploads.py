@@ -0,0 +1,50 @@
+from unittest import mock
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+
+from core.models import EncryptedFile
+from core.parallel import SegmentEngine
+from core.tests.helpers import StorageMixin, client_for, make_user
+from core.utils import iter_decrypted_file
+
+
+class FileUploadTests(StorageMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = make_user('owner')
+        self.client = client_for(self.owner)
+
+    def upload(self, name, content):
+        return self.client.post(
+            '/api/files/', {'file': SimpleUploadedFile(name, content), 'name': name},
+            format='multipart'
+        )
+
+    def test_disallowed_extension_is_reported(self):
+        response = self.upload('payload.exe', b'MZ' + b'\0' * 1024)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], "File extension .exe is not allowed")
+        self.assertFalse(EncryptedFile.objects.exists())
+
+    def test_empty_file_with_disallowed_extension_reports_the_extension(self):
+        response = self.upload('payload.exe', b'')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], "File extension .exe is not allowed")
+
+    def test_allowed_file_is_stored(self):
+        response = self.upload('note.txt', b'hello world\n')
+        self.assertEqual(response.status_code, 201)
+        file = EncryptedFile.objects.get()
+        self.assertEqual(file.size, len(b'hello world\n'))
+
+    @override_settings(ENCRYPTION_SEGMENT_SIZE=1024, UPLOAD_SNIFF_BYTES=1024)
+    def test_upload_is_encrypted_on_the_engine(self):
+        content = b''.join(b'row %06d\n' % i for i in range(5000))
+        with mock.patch.object(SegmentEngine, 'encryptor', autospec=True,
+                               side_effect=SegmentEngine.encryptor) as encryptor:
+            response = self.upload('rows.txt', content)
+        self.assertEqual(response.status_code, 201)
+        encryptor.assert_called_once()
+        file = EncryptedFile.objects.get()
+        self.assertEqual(b''.join(iter_decrypted_file(file)), content)
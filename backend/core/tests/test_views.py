@@ -0,0 +1,23 @@
+from django.test import TestCase
+from rest_framework.test import APIClient
+
+from core.tests.helpers import StorageMixin, client_for, make_file, make_user
+
+
+class FileViewSetAuthTests(StorageMixin, TestCase):
+    def test_anonymous_request_is_401(self):
+        response = APIClient().get('/api/files/')
+        self.assertEqual(response.status_code, 401)
+
+    def test_invalid_token_is_401(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Bearer not-a-token')
+        response = client.get('/api/files/')
+        self.assertEqual(response.status_code, 401)
+
+    def test_authenticated_request_is_200(self):
+        owner = make_user('owner')
+        make_file(owner)
+        response = client_for(owner).get('/api/files/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 1)
@@ -0,0 +1,278 @@
+"""
+Rate limiting shared by every worker process on a host.
+
+Limits are token buckets: a rate of ``N/period`` is a bucket of ``N``
+tokens refilled at ``N`` per period, so bursts up to the full allowance
+are allowed and the average rate is held. A request costs one token, or
+its size in bytes for the bandwidth scopes. A request that costs more
+than the whole bucket is let through once the bucket is full and leaves it
+in debt, so large files are delayed rather than refused forever.
+
+The buckets live in ``RATE_LIMIT_STORE``:
+
+``sqlite``
+    A SQLite database at ``RATE_LIMIT_DB`` (WAL mode), shared by all the
+    worker processes on a host. Each check is one short write transaction.
+``memory``
+    A dict in the process; for development and single-process servers.
+
+Both keep only buckets that aren't full, so their size is bounded by the
+number of recently active clients. If the store fails, requests are let
+through: a broken limiter must not take the API down.
+
+Rates come from ``REST_FRAMEWORK['DEFAULT_THROTTLE_RATES']`` by scope, as
+with DRF's throttles; byte rates may use K/M/G suffixes (``'5G/day'``).
+A scope without a rate is not limited.
+"""
+import logging
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+from rest_framework.exceptions import Throttled
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+logger = logging.getLogger(__name__)
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+RATE_RE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([kmg]?)b?\s*/\s*(\d*)\s*([smhd])', re.IGNORECASE)
+
+# One in this many checks also deletes the buckets that have refilled
+PRUNE_EVERY = 1000
+
+
+def parse_rate(rate):
+    """``'100/day'`` or ``'5G/hour'`` as ``(capacity, period in seconds)``; None for no limit."""
+    if not rate:
+        return None
+    match = RATE_RE.match(rate)
+    if not match:
+        raise ValueError(f"Invalid rate {rate!r}")
+    amount, unit, multiplier, period = match.groups()
+    capacity = float(amount) * UNITS[unit.lower()]
+    return capacity, int(multiplier or 1) * PERIODS[period.lower()]
+
+
+def take(tokens, updated, now, cost, capacity, period):
+    """
+    Token bucket step: refill a bucket last seen at ``updated``, then try to
+    take ``cost`` tokens.
+
+    Returns ``(allowed, wait, tokens)``; ``wait`` is the seconds until the
+    request would be allowed, ``tokens`` the bucket's new level.
+    """
+    rate = capacity / period
+    if tokens is None:
+        tokens = capacity
+    else:
+        tokens = min(capacity, tokens + (now - updated) * rate)
+    needed = min(cost, capacity)
+    if tokens < needed:
+        return False, (needed - tokens) / rate, tokens
+    return True, 0.0, tokens - cost
+
+
+def _full_at(tokens, now, capacity, period):
+    """When a bucket at ``tokens`` will be full again, and can be forgotten."""
+    return now + (capacity - tokens) * period / capacity
+
+
+class MemoryRateLimitStore:
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._checks = 0
+
+    def consume(self, key, cost, capacity, period):
+        now = time.time()
+        with self._lock:
+            tokens, updated, _ = self._buckets.get(key, (None, None, None))
+            allowed, wait, tokens = take(tokens, updated, now, cost, capacity, period)
+            if allowed:
+                self._buckets[key] = (tokens, now, _full_at(tokens, now, capacity, period))
+            self._checks += 1
+            if self._checks % PRUNE_EVERY == 0:
+                self._buckets = {k: v for k, v in self._buckets.items() if v[2] > now}
+        return allowed, wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteRateLimitStore:
+    """Buckets in a SQLite file that all processes on the host open."""
+
+    def __init__(self, path, timeout=5):
+        self.path = str(path)
+        # Seconds to wait for another process's write lock before failing
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        # One connection per thread, and none inherited across a fork
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # Losing the last few updates in a power cut is fine for rate limits
+            connection.execute('PRAGMA synchronous=OFF')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS buckets ('
+                'key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, '
+                'full_at REAL NOT NULL)'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS buckets_full_at ON buckets (full_at)')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def consume(self, key, cost, capacity, period):
+        connection = self._connection()
+        now = time.time()
+        # IMMEDIATE takes the write lock up front, so read-modify-write is atomic
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT tokens, updated FROM buckets WHERE key = ?', (key,)
+            ).fetchone()
+            allowed, wait, tokens = take(*(row or (None, None)), now, cost, capacity, period)
+            if allowed:
+                connection.execute(
+                    'INSERT INTO buckets (key, tokens, updated, full_at) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, '
+                    'updated = excluded.updated, full_at = excluded.full_at',
+                    (key, tokens, now, _full_at(tokens, now, capacity, period))
+                )
+            if random.randrange(PRUNE_EVERY) == 0:
+                connection.execute('DELETE FROM buckets WHERE full_at < ?', (now,))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return allowed, wait
+
+    def clear(self):
+        self._connection().execute('DELETE FROM buckets')
+
+
+def create_store(backend=None):
+    backend = backend or getattr(settings, 'RATE_LIMIT_STORE', 'sqlite')
+    if backend == 'memory':
+        return MemoryRateLimitStore()
+    if backend == 'sqlite':
+        return SQLiteRateLimitStore(
+            getattr(settings, 'RATE_LIMIT_DB', None) or os.path.join(settings.BASE_DIR, 'ratelimit.sqlite3'),
+            timeout=getattr(settings, 'RATE_LIMIT_DB_TIMEOUT', 5),
+        )
+    raise ValueError(f"Unknown rate limit store {backend!r}")
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Process-wide rate limit store configured from settings."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = create_store()
+    return _store
+
+
+def get_rate(scope):
+    return parse_rate(api_settings.DEFAULT_THROTTLE_RATES.get(scope))
+
+
+def consume(scope, ident, cost=1):
+    """Charge ``cost`` to ``ident`` in ``scope``; returns ``(allowed, wait)``."""
+    rate = get_rate(scope)
+    if rate is None or cost <= 0 or not getattr(settings, 'RATE_LIMIT_ENABLED', True):
+        return True, 0.0
+    try:
+        return get_store().consume(f'{scope}:{ident}', cost, *rate)
+    except Exception:
+        logger.exception("Rate limit store failed; letting the request through")
+        return True, 0.0
+
+
+def client_ident(request):
+    """The user for authenticated requests, the client address otherwise."""
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f'user:{user.pk}'
+    return f'ip:{BaseThrottle().get_ident(request)}'
+
+
+def throttle_bytes(request, scope, nbytes):
+    """Charge ``nbytes`` of bandwidth in ``scope``; raises Throttled when over the limit."""
+    allowed, wait = consume(scope, client_ident(request), nbytes)
+    if not allowed:
+        raise Throttled(wait)
+
+
+class BucketThrottle(BaseThrottle):
+    """DRF throttle charging requests to ``scope``'s token bucket."""
+    scope = None
+
+    def __init__(self):
+        self._wait = None
+
+    def get_cost(self, request):
+        return 1
+
+    def applies_to(self, request):
+        return True
+
+    def allow_request(self, request, view):
+        if not self.applies_to(request):
+            return True
+        allowed, wait = consume(self.scope, client_ident(request), self.get_cost(request))
+        self._wait = wait
+        return allowed
+
+    def wait(self):
+        return self._wait
+
+
+class AnonThrottle(BucketThrottle):
+    scope = 'anon'
+
+    def applies_to(self, request):
+        return not request.user.is_authenticated
+
+
+class UserThrottle(BucketThrottle):
+    scope = 'user'
+
+
+class UploadThrottle(BucketThrottle):
+    scope = 'file_upload'
+
+
+class ChunkUploadThrottle(BucketThrottle):
+    scope = 'chunk_upload'
+
+
+class LinkDownloadThrottle(BucketThrottle):
+    scope = 'link_download'
+
+
+class UploadBytesThrottle(BucketThrottle):
+    """Charges the request body to ``upload_bytes`` before it is read."""
+    scope = 'upload_bytes'
+
+    def get_cost(self, request):
+        try:
+            return int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return 0
@@ -0,0 +1,188 @@
+"""
+Upload handler that encrypts multipart file uploads as they arrive.
+
+Django's default handlers keep an upload in memory or spool it to a
+temporary file, which the upload view then read again to sniff its type
+and a third time to encrypt it. ``EncryptingUploadHandler`` takes every
+chunk off the wire exactly once: the leading bytes are sniffed with
+libmagic (which also settles whether to compress, see
+``core.compression``), all of it goes through SHA-256, and complete
+segments are encrypted on the segment engine's pool (``core.parallel``) and
+appended in order to a partial blob under ``uploads/``. Memory is bounded
+by the engine's window of segments plus the sniff buffer whatever the size
+of the file, and plaintext never touches disk.
+
+The handler produces an :class:`EncryptedUpload` instead of an
+``UploadedFile`` with content; ``utils.save_encrypted_upload`` moves its
+blob into the blob store.
+"""
+import hashlib
+import os
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+
+from .compression import choose_compression
+from .metrics import count, timed
+from .parallel import get_engine
+from .utils import generate_encryption_key, validate_file_extension, validate_file_type
+
+DEFAULT_SNIFF_BYTES = 64 * 1024
+
+
+def get_sniff_size():
+    """Leading bytes of an upload handed to libmagic."""
+    return getattr(settings, 'UPLOAD_SNIFF_BYTES', DEFAULT_SNIFF_BYTES)
+
+
+class EncryptedUpload(UploadedFile):
+    """
+    An upload already encrypted to a partial blob.
+
+    The plaintext is gone by the time the view sees this, so it can't be
+    read; ``error`` holds the reason the upload was rejected, if it was.
+    """
+
+    def __init__(self, name, size, content_type, file_id, key, blob_path, sha256, error=None):
+        super().__init__(None, name, content_type, size)
+        self.file_id = file_id
+        self.key = key
+        self.blob_path = blob_path
+        self.sha256 = sha256
+        self.error = error
+
+    def open(self, mode=None):
+        raise ValueError("The plaintext of an encrypted upload can't be read back")
+
+    def discard(self):
+        """Delete the partial blob unless it was already moved into the blob store."""
+        if default_storage.exists(self.blob_path):
+            default_storage.delete(self.blob_path)
+
+
+class EncryptingUploadHandler(FileUploadHandler):
+    """Sniff, hash and encrypt uploaded files in a single pass."""
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        # Completed uploads, so the caller can discard any it doesn't keep
+        self.uploads = []
+
+    def new_file(self, field_name, file_name, *args, **kwargs):
+        super().new_file(field_name, file_name, *args, **kwargs)
+        self.file_id = uuid.uuid4()
+        self.key = generate_encryption_key()
+        # Created once the sniffed type has settled on compression
+        self.encryptor = None
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.sniff_buffer = bytearray()
+        self.detected_type = None
+        self.error = None
+        self.blob_path = f'uploads/{self.request.user.pk}/{self.file_id}.part'
+        try:
+            validate_file_extension(file_name)
+        except ValueError as e:
+            self.error = str(e)
+
+        path = default_storage.path(self.blob_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.blob = open(path, 'wb')
+        # No other handler gets to buffer a copy of the plaintext
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        # Counted even for rejected uploads, which mustn't look empty
+        self.size += len(raw_data)
+        if self.error:
+            # Rejected uploads are drained without doing any more work
+            return None
+        self.digest.update(raw_data)
+        if self.encryptor is None:
+            self.sniff_buffer += raw_data
+            if len(self.sniff_buffer) >= get_sniff_size():
+                self._sniff()
+            return None
+        with timed('crypto'):
+            segments = self.encryptor.update(raw_data)
+        self._write(segments)
+        return None
+
+    def file_complete(self, file_size):
+        if self.encryptor is None and not self.error:
+            self._sniff()
+        if not self.error:
+            with timed('crypto'):
+                segments = self.encryptor.finalize()
+            self._write(segments)
+            with timed('storage'):
+                self.blob.flush()
+                os.fsync(self.blob.fileno())
+        self.blob.close()
+        upload = EncryptedUpload(
+            name=self.file_name,
+            size=self.size,
+            content_type=self.detected_type or self.content_type,
+            file_id=self.file_id,
+            key=self.key,
+            blob_path=self.blob_path,
+            sha256=self.digest.hexdigest(),
+            error=self.error,
+        )
+        self.uploads.append(upload)
+        return upload
+
+    def upload_interrupted(self):
+        encryptor = getattr(self, 'encryptor', None)
+        if encryptor is not None:
+            encryptor.abort()
+        blob = getattr(self, 'blob', None)
+        if blob is not None:
+            blob.close()
+            if default_storage.exists(self.blob_path):
+                default_storage.delete(self.blob_path)
+
+    def _sniff(self):
+        sample = bytes(self.sniff_buffer[:get_sniff_size()])
+        try:
+            self.detected_type = validate_file_type(sample)
+        except ValueError as e:
+            self.error = str(e)
+            return
+        # Whole segments are sealed on the engine's pool as they complete
+        self.encryptor = get_engine().encryptor(
+            self.key, flags=choose_compression(self.detected_type, sample)
+        )
+        with timed('crypto'):
+            segments = self.encryptor.update(bytes(self.sniff_buffer))
+        self._write([self.encryptor.header_bytes] + segments)
+        self.sniff_buffer = bytearray()
+
+    def _write(self, segments):
+        for segment in segments:
+            with timed('storage'):
+                self.blob.write(segment)
+            count('storage_bytes', len(segment))
+
+
+@contextmanager
+def encrypting_uploads(request):
+    """
+    Have ``request``'s files parsed by an ``EncryptingUploadHandler``.
+
+    Must be entered before the body is parsed. Partial blobs that weren't
+    moved into the blob store by the time the block exits are deleted.
+    """
+    # Views get a DRF request; the handlers live on the Django one
+    request = getattr(request, '_request', request)
+    handler = EncryptingUploadHandler(request)
+    request.upload_handlers = [handler]
+    try:
+        yield handler
+    finally:
+        for upload in handler.uploads:
+            upload.discard()
@@ -0,0 +1,272 @@
+"""
+Resumable upload sessions.
+
+Creating a session fixes the plaintext size and the chunk size (a whole
+number of encryption segments), so every chunk maps to a known range of
+segments at a known offset in the final blob. The partial blob starts
+as just its header and grows as chunks land; each chunk is verified against its
+checksum and encrypted outside any lock or transaction, then written
+straight to its offset under a lock on the partial blob and recorded in a
+short insert. Chunks may arrive concurrently and in any order (only their
+writes to one blob take turns), plaintext never touches disk, and
+completing the upload is just a move into the blob store (a rename
+when it is local).
+"""
+import fcntl
+import hashlib
+import os
+import uuid
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Sum
+
+from .blobstore import blob_name, get_blob_store
+from .crypto import (
+    encrypt_segments, get_segment_size, new_header, pack_header,
+    parse_header, segment_offset,
+)
+from .keys import key_version, wrap_key
+from .metrics import TimedReader, count, timed, timed_iter
+from .models import EncryptedFile, UploadChunk, UploadSession, User
+from .parallel import get_engine
+from .utils import generate_encryption_key, validate_file_extension, validate_file_type
+
+DEFAULT_UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+DEFAULT_UPLOAD_SESSION_MAX_SIZE = 2 * 1024 ** 3
+DEFAULT_UPLOAD_SESSION_QUOTA = 4 * 1024 ** 3
+DEFAULT_UPLOAD_SESSIONS_MAX_OPEN = 10
+
+
+class UploadError(ValueError):
+    """A chunk or session request that can't be honoured."""
+
+
+class ChunkConflict(UploadError):
+    """A chunk was already accepted with different content."""
+
+
+def get_chunk_size():
+    """Configured chunk size, rounded down to a whole number of segments."""
+    segment_size = get_segment_size()
+    chunk_size = getattr(settings, 'UPLOAD_CHUNK_SIZE', DEFAULT_UPLOAD_CHUNK_SIZE)
+    return max(segment_size, chunk_size - chunk_size % segment_size)
+
+
+def get_max_session_size():
+    return getattr(settings, 'UPLOAD_SESSION_MAX_SIZE', DEFAULT_UPLOAD_SESSION_MAX_SIZE)
+
+
+def check_upload_session(owner, name, size):
+    """Reject a session that can't be created, before anything is stored or charged."""
+    validate_file_extension(name)
+    if size < 0:
+        raise UploadError("File size cannot be negative")
+    if size > get_max_session_size():
+        raise UploadError(f"File size cannot exceed {get_max_session_size()} bytes")
+    # Open sessions count against the owner until they complete or expire
+    open_sessions = UploadSession.objects.filter(owner=owner).aggregate(
+        count=Count('pk'), size=Sum('size')
+    )
+    if open_sessions['count'] >= getattr(settings, 'UPLOAD_SESSIONS_MAX_OPEN',
+                                         DEFAULT_UPLOAD_SESSIONS_MAX_OPEN):
+        raise UploadError("Too many uploads in progress; complete or cancel some first")
+    quota = getattr(settings, 'UPLOAD_SESSION_QUOTA', DEFAULT_UPLOAD_SESSION_QUOTA)
+    if (open_sessions['size'] or 0) + size > quota:
+        raise UploadError(f"Uploads in progress cannot exceed {quota} bytes in total")
+
+
+def create_upload_session(owner, name, size):
+    """Start a session and write the header of its encrypted blob."""
+    header = new_header()
+    with transaction.atomic():
+        # Concurrent creations by one user are checked one at a time
+        User.objects.select_for_update().filter(pk=owner.pk).first()
+        check_upload_session(owner, name, size)
+        session = UploadSession.objects.create(
+            owner=owner,
+            name=name,
+            size=size,
+            chunk_size=get_chunk_size(),
+            encryption_key=wrap_key(generate_encryption_key()),
+            header=pack_header(header),
+        )
+
+    # Chunks extend the file as they are written, so nothing is reserved
+    # for data that may never arrive
+    path = default_storage.path(session.blob_path)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(bytes(session.header))
+    except BaseException:
+        # Don't leave a session without its blob (or half a blob) behind
+        if os.path.exists(path):
+            os.remove(path)
+        session.delete()
+        raise
+    return session
+
+
+def _read_body(stream, length):
+    """Read exactly ``length`` bytes of a request body."""
+    buffer = bytearray()
+    while len(buffer) < length:
+        data = stream.read(min(length - len(buffer), 64 * 1024))
+        if not data:
+            break
+        buffer += data
+    if stream.read(1):
+        raise UploadError(f"Chunk is larger than {length} bytes")
+    if len(buffer) != length:
+        raise UploadError(f"Expected {length} bytes, got {len(buffer)}")
+    return bytes(buffer)
+
+
+def write_chunk(session, index, stream, checksum):
+    """Verify, encrypt and store chunk ``index`` read from ``stream``."""
+    if not 0 <= index < session.total_chunks:
+        raise UploadError(f"Chunk index must be between 0 and {session.total_chunks - 1}")
+    checksum = (checksum or '').lower()
+    if not checksum:
+        raise UploadError("A SHA-256 checksum is required for every chunk")
+
+    existing = session.chunks.filter(index=index).first()
+    if existing:
+        # Re-encrypting different data under the same segment nonces would
+        # leak plaintext, so a chunk can only ever be repeated verbatim.
+        if existing.checksum != checksum:
+            raise ChunkConflict(f"Chunk {index} was already received with a different checksum")
+        return existing
+
+    # The chunk is verified before anything is encrypted or written
+    data = _read_body(stream, session.chunk_length(index))
+    if hashlib.sha256(data).hexdigest() != checksum:
+        raise UploadError(f"Checksum mismatch for chunk {index}")
+    content_type = validate_file_type(data) if index == 0 else None
+    offset, segments = _encrypt_chunk(session, index, data)
+
+    fd = os.open(default_storage.path(session.blob_path), os.O_WRONLY)
+    try:
+        # Only chunks of the same session wait for each other here, and
+        # only for the write; no transaction is open while it's held
+        with timed('storage'):
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        # Re-encrypting different data under the same segment nonces would
+        # leak plaintext, so a chunk can only ever be written once
+        existing = session.chunks.filter(index=index).first()
+        if existing:
+            if existing.checksum != checksum:
+                raise ChunkConflict(f"Chunk {index} was already received with a different checksum")
+            return existing
+        _write_segments(fd, offset, segments)
+        try:
+            with transaction.atomic():
+                chunk = UploadChunk.objects.create(session=session, index=index, checksum=checksum)
+                if content_type is not None:
+                    session.content_type = content_type
+                    UploadSession.objects.filter(pk=session.pk).update(content_type=content_type)
+        except IntegrityError:
+            # Recorded by another host writing the same blob
+            existing = session.chunks.get(index=index)
+            if existing.checksum != checksum:
+                raise ChunkConflict(f"Chunk {index} was already received with a different checksum")
+            return existing
+        return chunk
+    finally:
+        os.close(fd)
+
+
+def _encrypt_chunk(session, index, data):
+    """Chunk ``index``'s offset in the blob and its encrypted segments."""
+    segment_size = parse_header(bytes(session.header)).segment_size
+    first_segment = index * (session.chunk_size // segment_size)
+    final_segment = max(0, -(-session.size // segment_size) - 1)
+    segments = encrypt_segments(session.data_key, bytes(session.header),
+                                first_segment, data, final_segment)
+    return segment_offset(first_segment, segment_size), list(timed_iter('crypto', segments))
+
+
+def _write_segments(fd, offset, segments):
+    """Write an encrypted chunk at ``offset`` in the partial blob and sync it."""
+    for segment in segments:
+        with timed('storage'):
+            os.pwrite(fd, segment, offset)
+        count('storage_bytes', len(segment))
+        offset += len(segment)
+    with timed('storage'):
+        os.fsync(fd)
+
+
+def upload_status(session):
+    """Bitmap of received chunks, the missing indices and the resumable offset."""
+    received = set(session.chunks.values_list('index', flat=True))
+    bitmap = ''.join('1' if i in received else '0' for i in range(session.total_chunks))
+    contiguous = len(bitmap) - len(bitmap.lstrip('1'))
+    return {
+        'received': bitmap,
+        'missing': [i for i, bit in enumerate(bitmap) if bit == '0'],
+        'offset': min(contiguous * session.chunk_size, session.size),
+    }
+
+
+def complete_upload_session(session):
+    """Turn a fully received session into an EncryptedFile without touching its data."""
+    if session.chunks.count() != session.total_chunks:
+        raise UploadError("Upload is incomplete")
+    if not session.content_type:
+        raise UploadError("File type could not be determined")
+
+    file_id = uuid.uuid4()
+    name = blob_name(file_id)
+    source = default_storage.path(session.blob_path)
+    claimed = f'{source}.{file_id}'
+    try:
+        # Only one concurrent completion can claim the partial blob
+        os.rename(source, claimed)
+    except FileNotFoundError:
+        raise UploadError("Upload was already completed or aborted")
+    try:
+        # Chunks arrive out of order, so the digest of the plaintext can only
+        # be taken now; reading it back also authenticates every segment
+        sha256 = _plaintext_digest(claimed, session.data_key)
+        get_blob_store().save_file(name, claimed)
+    except Exception:
+        os.rename(claimed, source)
+        raise
+
+    try:
+        with transaction.atomic():
+            encrypted_file = EncryptedFile.objects.create(
+                id=file_id,
+                owner=session.owner,
+                name=session.name,
+                file=name,
+                encryption_key=session.encryption_key,
+                key_version=key_version(session.encryption_key),
+                content_type=session.content_type,
+                size=session.size,
+                sha256=sha256,
+            )
+            session.delete()
+    except Exception:
+        # Don't leave an orphaned blob behind
+        get_blob_store().delete(name)
+        raise
+    return encrypted_file
+
+
+def _plaintext_digest(path, key):
+    digest = hashlib.sha256()
+    with TimedReader(open(path, 'rb')) as f:
+        for data in timed_iter('crypto', get_engine().decrypt(f, key)):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def abort_upload_session(session):
+    """Discard a session and its partial blob."""
+    if default_storage.exists(session.blob_path):
+        default_storage.delete(session.blob_path)
+    session.delete()
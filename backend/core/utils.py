@@ -1,11 +1,18 @@
+import hashlib
 import os
+import secrets
+import uuid
 from cryptography.fernet import Fernet
 from django.conf import settings
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
 import base64
 import magic
 from io import BytesIO
+from .crypto import MAGIC, encrypt_stream, decrypt_stream, decrypt_range, is_segmented
+from .parallel import get_engine
+from .keys import wrap_key, key_version
+from .blobstore import blob_name, get_blob_store
+from .compression import probe_chunks
+from .metrics import TimedReader, count, timed, timed_iter
 
 ALLOWED_EXTENSIONS = {
     'pdf', 'doc', 'docx', 'txt',
@@ -20,17 +27,29 @@ def encrypt_file(file_data, key):
     """Encrypt file data using the provided key."""
     if not isinstance(file_data, bytes):
         file_data = file_data.encode()
-    f = Fernet(key)
-    encrypted_data = f.encrypt(file_data)
-    return encrypted_data
+    return b''.join(encrypt_stream([file_data], key))
 
 def decrypt_file(encrypted_data, key):
-    """Decrypt file data using the provided key."""
+    """Decrypt file data (segmented or legacy Fernet) using the provided key."""
     if not isinstance(encrypted_data, bytes):
         encrypted_data = encrypted_data.encode()
-    f = Fernet(key)
-    decrypted_data = f.decrypt(encrypted_data)
-    return decrypted_data
+    return b''.join(decrypt_stream(BytesIO(encrypted_data), key))
+
+class _CountingChunks:
+    """Iterate over an uploaded file's chunks while counting and hashing plaintext bytes."""
+
+    def __init__(self, file):
+        self.file = file
+        self.size = 0
+        self.digest = hashlib.sha256()
+
+    def __iter__(self):
+        for chunk in self.file.chunks():
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode()
+            self.size += len(chunk)
+            self.digest.update(chunk)
+            yield chunk
 
 def validate_file_extension(filename):
     """Validate file extension."""
@@ -46,54 +65,135 @@ def save_encrypted_file(file, owner, content_type=None):
     # Validate file extension
     validate_file_extension(file.name)
     
-    # Read file content as bytes
-    file_content = file.read()
-    if not isinstance(file_content, bytes):
-        file_content = file_content.encode()
-    
     # Generate encryption key
     key = generate_encryption_key()
     
-    # Encrypt file content
-    encrypted_content = encrypt_file(file_content, key)
-    
-    # Create a temporary file path
-    file_path = f'encrypted_files/{owner.id}/{file.name}'
-    
-    # Save encrypted content
-    saved_path = default_storage.save(
-        file_path,
-        ContentFile(encrypted_content)
-    )
+    # Encrypt segments in parallel while streaming to the blob store.
+    # Blobs are keyed by the file id, so the name never collides.
+    store = get_blob_store()
+    file_id = uuid.uuid4()
+    saved_path = blob_name(file_id)
+    plaintext = _CountingChunks(file)
+    # Compressible content is compressed before it is encrypted
+    flags, chunks = probe_chunks(plaintext, content_type or file.content_type)
+    encrypted = get_engine().encrypt(chunks, key, flags=flags)
+    with timed('storage'):
+        written = store.save(saved_path, timed_iter('crypto', encrypted))
+    count('storage_bytes', written)
     
-    # Create EncryptedFile instance
-    encrypted_file = EncryptedFile.objects.create(
+    # Only the wrapped key is stored
+    wrapped_key = wrap_key(key)
+    try:
+        return EncryptedFile.objects.create(
+            id=file_id,
+            owner=owner,
+            name=file.name,
+            file=saved_path,
+            encryption_key=wrapped_key,
+            key_version=key_version(wrapped_key),
+            content_type=content_type or file.content_type,
+            size=plaintext.size,
+            sha256=plaintext.digest.hexdigest()
+        )
+    except Exception:
+        # Don't leave an orphaned blob behind
+        store.delete(saved_path)
+        raise
+
+def stage_encrypted_upload(upload, owner):
+    """Move an upload's blob into the blob store and return its unsaved EncryptedFile."""
+    from django.core.files.storage import default_storage
+    from .models import EncryptedFile
+
+    if upload.error:
+        raise ValueError(upload.error)
+
+    # The handler already sniffed, hashed and encrypted the upload
+    saved_path = blob_name(upload.file_id)
+    with timed('storage'):
+        get_blob_store().save_file(saved_path, default_storage.path(upload.blob_path))
+
+    wrapped_key = wrap_key(upload.key)
+    return EncryptedFile(
+        id=upload.file_id,
         owner=owner,
-        name=file.name,
+        name=upload.name,
         file=saved_path,
-        encryption_key=key,
-        content_type=content_type or file.content_type,
-        size=len(file_content)  # Use actual content length
+        encryption_key=wrapped_key,
+        key_version=key_version(wrapped_key),
+        content_type=upload.content_type,
+        size=upload.size,
+        sha256=upload.sha256
     )
-    
+
+def save_encrypted_upload(upload, owner):
+    """Store a blob written by ``EncryptingUploadHandler`` and return its EncryptedFile."""
+    encrypted_file = stage_encrypted_upload(upload, owner)
+    try:
+        encrypted_file.save(force_insert=True)
+    except Exception:
+        # Don't leave an orphaned blob behind
+        get_blob_store().delete(encrypted_file.file.name)
+        raise
+    return encrypted_file
+
+def iter_decrypted_file(encrypted_file):
+    """Yield the decrypted content of an encrypted file segment by segment."""
+    with TimedReader(get_blob_store().open(encrypted_file.file.name)) as f:
+        yield from timed_iter('crypto', get_engine().decrypt(f, encrypted_file.data_key))
+
+def iter_decrypted_range(encrypted_file, start, stop):
+    """Yield decrypted bytes [start, stop) of an encrypted file."""
+    with TimedReader(get_blob_store().open(encrypted_file.file.name)) as f:
+        yield from timed_iter('crypto', decrypt_range(f, encrypted_file.data_key, start, stop))
+
+def is_legacy_blob(encrypted_file):
+    """Return True if a stored blob is a whole-file Fernet token."""
+    with get_blob_store().open(encrypted_file.file.name) as f:
+        return not is_segmented(f.read(len(MAGIC)))
+
+def reencrypt_file(encrypted_file, key=None):
+    """Rewrite a stored blob in the current format, optionally under a new key."""
+    from .etags import bump_files
+    from .models import EncryptedFile
+
+    engine = get_engine()
+    store = get_blob_store()
+    old_path = encrypted_file.file.name
+    new_key = key or encrypted_file.data_key
+    # Write next to the old blob so it stays readable until the row is updated
+    saved_path = blob_name(encrypted_file.pk, revision=secrets.token_hex(4))
+    with store.open(old_path) as f:
+        plaintext = engine.decrypt(f, encrypted_file.data_key)
+        flags, plaintext = probe_chunks(plaintext, encrypted_file.content_type)
+        store.save(saved_path, engine.encrypt(plaintext, new_key, flags=flags))
+
+    wrapped_key = wrap_key(new_key)
     try:
-        return encrypted_file
-    except Exception as e:
-        # Clean up any temporary files in case of error
-        if 'saved_path' in locals():
-            default_storage.delete(saved_path)
-        raise e
+        # Skip rows that changed (e.g. were moved or rotated) while rewriting
+        updated = EncryptedFile.objects.filter(
+            pk=encrypted_file.pk, file=old_path, encryption_key=bytes(encrypted_file.encryption_key)
+        ).update(
+            file=saved_path,
+            encryption_key=wrapped_key,
+            key_version=key_version(wrapped_key)
+        )
+        if not updated:
+            raise ValueError("File changed during re-encryption")
+    except Exception:
+        store.delete(saved_path)
+        raise
+    # The blob name is part of the file's representation
+    bump_files([encrypted_file.pk])
+    store.delete(old_path)
+    encrypted_file.file.name = saved_path
+    encrypted_file.encryption_key = wrapped_key
+    encrypted_file.key_version = key_version(wrapped_key)
+    return encrypted_file
 
 def get_decrypted_file(encrypted_file):
     """Get the decrypted content of an encrypted file."""
-    # Read encrypted content
-    with default_storage.open(encrypted_file.file.name, 'rb') as f:
-        encrypted_content = f.read()
-    
-    # Decrypt content
-    decrypted_content = decrypt_file(encrypted_content, encrypted_file.encryption_key)
-    
-    return decrypted_content
+    return b''.join(iter_decrypted_file(encrypted_file))
 
 def validate_file_type(file_content):
     """Validate file type using magic numbers"""
@@ -106,8 +206,9 @@ def validate_file_type(file_content):
         'text/plain',
     ]
     
-    mime = magic.Magic(mime=True)
-    file_type = mime.from_buffer(file_content)
+    with timed('sniff'):
+        mime = magic.Magic(mime=True)
+        file_type = mime.from_buffer(file_content)
     
     if file_type not in allowed_types:
         raise ValueError(f"File type {file_type} is not allowed")
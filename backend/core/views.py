@@ -1,26 +1,53 @@
-from rest_framework import viewsets, status, permissions
+from rest_framework import viewsets, mixins, status, permissions, serializers
 from rest_framework.decorators import action
+from rest_framework.exceptions import AuthenticationFailed, NotAuthenticated, Throttled
 from rest_framework.response import Response
-from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import authenticate
 from django.db import models
-from django.http import FileResponse, HttpResponse
+from django.conf import settings
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils.crypto import constant_time_compare
 from django.shortcuts import get_object_or_404
-from .models import User, EncryptedFile, FileShare, ShareableLink
+from .authentication import VersionedRefreshToken
+from .models import User, EncryptedFile, FileShare, ShareableLink, UploadSession
 from .serializers import (
     UserSerializer, EncryptedFileSerializer,
-    FileShareSerializer, ShareableLinkSerializer
+    FileShareSerializer, ShareableLinkSerializer, UploadSessionSerializer
 )
 from .permissions import IsOwnerOrAdmin, HasFileAccess, GuestPermission
-from .utils import save_encrypted_file, get_decrypted_file, validate_file_type
+from .access import get_access_resolver, OWNER
+from .links import has_range_token, link_counter, release_access, set_range_token
+from .metrics import registry as metrics_registry
+from .pagination import FileCursorPagination, ShareCursorPagination, LinkCursorPagination
+from .utils import save_encrypted_upload, iter_decrypted_file
+from .upload_handlers import encrypting_uploads
+from .etags import (
+    ConditionalListMixin, content_etag, etag_matches, not_modified, set_etag,
+)
+from .throttling import (
+    ChunkUploadThrottle, LinkDownloadThrottle, UploadBytesThrottle, UploadThrottle,
+    throttle_bytes,
+)
+from .audit import record_events
+from . import batch
+from .downloads import build_download_response
+from .archives import build_archive_response
+from .streams import stream_body
+from .previews import (
+    MAX_PREVIEW_WIDTH, get_preview, is_previewable, needs_render, schedule_prerender
+)
+from .uploads import (
+    UploadError, ChunkConflict, check_upload_session, create_upload_session, write_chunk,
+    upload_status, complete_upload_session, abort_upload_session
+)
 import pyotp
+import uuid
+from operator import attrgetter
 from datetime import datetime, timedelta
 import os
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
 import logging
-from django.core.files import File
 from io import BytesIO
-import urllib.parse
 
 logger = logging.getLogger(__name__)
 
@@ -53,7 +80,7 @@ class UserViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_401_UNAUTHORIZED
             )
         
-        refresh = RefreshToken.for_user(user)
+        refresh = VersionedRefreshToken.for_user(user)
         token = str(refresh.access_token)
         
         # Store token in response and set cookie
@@ -69,7 +96,7 @@ class UserViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid():
             user = serializer.save()
-            refresh = RefreshToken.for_user(user)
+            refresh = VersionedRefreshToken.for_user(user)
             return Response({
                 'message': 'Registration successful',
                 'user': UserSerializer(user).data,
@@ -136,129 +163,184 @@ class UserViewSet(viewsets.ModelViewSet):
             content_type='image/png'
         )
 
-class EncryptedFileViewSet(viewsets.ModelViewSet):
+class EncryptedFileViewSet(ConditionalListMixin, viewsets.ModelViewSet):
     serializer_class = EncryptedFileSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = FileCursorPagination
+    list_scope = 'files'
     
     def get_permissions(self):
-        if self.action == 'create':
+        if self.action in ['create', 'batch_upload', 'bulk_delete', 'archive']:
             return [permissions.IsAuthenticated()]
         elif self.action == 'destroy':
             return [permissions.IsAuthenticated(), IsOwnerOrAdmin()]
         return [permissions.IsAuthenticated(), HasFileAccess(), GuestPermission()]
+
+    def get_throttles(self):
+        throttles = super().get_throttles()
+        if self.action in ['create', 'batch_upload']:
+            # Checked before the body is read
+            throttles += [UploadThrottle(), UploadBytesThrottle()]
+        return throttles
+
+    def get_list_etag(self, request):
+        if request.user.role == 'admin':
+            # Admins see every file; nothing is versioned per user for that
+            return None
+        return super().get_list_etag(request)
     
     def get_queryset(self):
         user = self.request.user
+        queryset = EncryptedFile.objects.select_related('owner')
         if user.role == 'admin':
-            return EncryptedFile.objects.all()
-        return EncryptedFile.objects.filter(
+            return queryset
+        # A subquery instead of a join on shares, so no DISTINCT is needed
+        return queryset.filter(
             models.Q(owner=user) |
-            models.Q(shares__shared_with=user)
-        ).distinct()
+            models.Q(id__in=FileShare.objects.filter(shared_with=user).values('file_id'))
+        )
     
+    def create(self, request, *args, **kwargs):
+        # Files are sniffed, hashed and encrypted as they stream in
+        with encrypting_uploads(request):
+            upload = request.FILES.get('file')
+            # Report why the handler rejected it before the serializer looks at it
+            if getattr(upload, 'error', None):
+                return Response({'error': upload.error}, status=status.HTTP_400_BAD_REQUEST)
+            return super().create(request, *args, **kwargs)
+
     def perform_create(self, serializer):
         file = self.request.FILES.get('file')
         if not file:
             raise serializers.ValidationError({'file': 'No file was submitted'})
         
-        # Read file content for validation
-        file_content = file.read()
-        file.seek(0)  # Reset file pointer
-        
         try:
-            # Validate file type
-            content_type = validate_file_type(file_content)
             # Save encrypted file
-            encrypted_file = save_encrypted_file(file, self.request.user, content_type)
+            encrypted_file = save_encrypted_upload(file, self.request.user)
             # Update serializer instance
             serializer.instance = encrypted_file
+            schedule_prerender(encrypted_file)
         except ValueError as e:
             raise serializers.ValidationError({'file': str(e)})
     
+    @action(detail=False, methods=['post'], url_path='batch')
+    def batch_upload(self, request):
+        """Upload every file sent in the multipart ``files`` field."""
+        with encrypting_uploads(request):
+            try:
+                results = batch.batch_upload(request.FILES.getlist('files'), request.user)
+            except batch.BatchError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        record_events(request, [
+            {
+                'action': 'upload',
+                'file_id': result['file'].pk if 'file' in result else None,
+                'details': {'name': result['name'], 'item_status': result['status']},
+            }
+            for result in results
+        ])
+        for result in results:
+            if 'file' in result:
+                schedule_prerender(result['file'])
+                result['file'] = self.get_serializer(result['file']).data
+        return batch_response(results, status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['post'], url_path='bulk-delete')
+    def bulk_delete(self, request):
+        """Delete the files listed in ``ids``."""
+        file_ids = request.data.get('ids')
+        if not isinstance(file_ids, list):
+            return Response({'error': 'ids must be a list'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            results = batch.bulk_delete(self.get_queryset(), request.user, file_ids)
+        except batch.BatchError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        record_events(request, [
+            {
+                'action': 'delete',
+                'file_id': result['file_id'] if result['status'] == 204 else None,
+                'details': {'file': result['file_id'], 'item_status': result['status']},
+            }
+            for result in results
+        ])
+        return batch_response(results)
+
+    @action(detail=False, methods=['get', 'post'])
+    def archive(self, request):
+        """
+        Download several files as one ZIP archive streamed on the fly.
+
+        Takes ``ids`` (a list, or comma-separated in the query string) or
+        ``scope=shared`` for every file shared with the user for download.
+        """
+        params = request.data if request.method == 'POST' else request.query_params
+        access = get_access_resolver(request)
+        max_files = getattr(settings, 'ARCHIVE_MAX_FILES', 1000)
+
+        if params.get('scope') == 'shared':
+            shared = [pk for pk, permission in access.shares.items() if permission == 'download']
+            files = list(
+                EncryptedFile.objects.select_related('owner')
+                .filter(pk__in=shared).order_by('owner__username', 'name')[:max_files + 1]
+            )
+            # Shared files are grouped by their owner
+            folder = attrgetter('owner.username')
+            filename = 'shared-files.zip'
+        else:
+            if request.method == 'POST':
+                ids = params.get('ids')
+            else:
+                ids = [i for value in params.getlist('ids') for i in value.split(',') if i]
+            if not isinstance(ids, list) or not ids:
+                return Response({'error': 'ids must be a non-empty list'},
+                                status=status.HTTP_400_BAD_REQUEST)
+            try:
+                ids = list(dict.fromkeys(uuid.UUID(str(i)) for i in ids))
+            except ValueError:
+                return Response({'error': 'Invalid file id'}, status=status.HTTP_400_BAD_REQUEST)
+            if len(ids) > max_files:
+                return Response({'error': f'An archive can hold at most {max_files} files'},
+                                status=status.HTTP_400_BAD_REQUEST)
+            # One query for the lot; all the permission checks are in memory
+            found = self.get_queryset().in_bulk(ids)
+            missing = [str(pk) for pk in ids if pk not in found]
+            if missing:
+                return Response({'error': 'Files not found', 'ids': missing},
+                                status=status.HTTP_404_NOT_FOUND)
+            files = [found[pk] for pk in ids]
+            folder = None
+            filename = 'files.zip'
+
+        if len(files) > max_files:
+            return Response({'error': f'An archive can hold at most {max_files} files'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        denied = [str(file.pk) for file in files if not access.can_download(file)]
+        if denied:
+            return Response({'error': 'Download not permitted', 'ids': denied},
+                            status=status.HTTP_403_FORBIDDEN)
+
+        throttle_bytes(request, 'download_bytes', sum(file.size for file in files))
+        record_events(request, [
+            {'action': 'download', 'file_id': file.pk, 'details': {'archive': filename}}
+            for file in files
+        ])
+        return build_archive_response(request, files, filename, folder)
+
     @action(detail=True, methods=['get'])
     def download(self, request, pk=None):
         file = self.get_object()
         
         # Check if user has download permission
-        if request.user != file.owner:
-            share = file.shares.filter(shared_with=request.user).first()
-            if not share or share.permission != 'download':
-                return Response(
-                    {'error': 'Download not permitted'},
-                    status=status.HTTP_403_FORBIDDEN
-                )
-        
-        decrypted_content = get_decrypted_file(file)
-        
-        response = FileResponse(
-            decrypted_content,
-            content_type=file.content_type,
-            as_attachment=True,
-            filename=file.name
-        )
-        return response
-
-    @action(detail=False, methods=['post'])
-    def chunk_upload(self, request):
-        """Handle chunked file upload."""
-        chunk = request.FILES.get('chunk')
-        chunk_number = int(request.POST.get('chunk_number'))
-        total_chunks = int(request.POST.get('total_chunks'))
-        file_id = request.POST.get('file_id')
-        filename = request.POST.get('filename')
-        
-        if not chunk:
+        access = get_access_resolver(request)
+        if access.permission(file) != OWNER and access.share_permission(file) != 'download':
             return Response(
-                {'error': 'No chunk provided'},
-                status=status.HTTP_400_BAD_REQUEST
+                {'error': 'Download not permitted'},
+                status=status.HTTP_403_FORBIDDEN
             )
         
-        # Create upload session or get existing one
-        upload_path = f'tmp/uploads/{request.user.id}/{file_id}/'
-        os.makedirs(upload_path, exist_ok=True)
-        
-        # Save chunk
-        with open(f'{upload_path}{chunk_number}', 'wb') as f:
-            for chunk_data in chunk.chunks():
-                f.write(chunk_data)
-        
-        # Check if all chunks are uploaded
-        if chunk_number == total_chunks - 1:
-            # Combine chunks
-            with open(f'{upload_path}{filename}', 'wb') as outfile:
-                for i in range(total_chunks):
-                    chunk_path = f'{upload_path}{i}'
-                    with open(chunk_path, 'rb') as infile:
-                        outfile.write(infile.read())
-                    os.remove(chunk_path)  # Clean up chunk
-            
-            # Create file object
-            with open(f'{upload_path}{filename}', 'rb') as f:
-                file_obj = File(f)
-                file_obj.name = filename
-                
-                # Process the complete file
-                try:
-                    file_content = file_obj.read()
-                    file_obj.seek(0)
-                    content_type = validate_file_type(file_content)
-                    encrypted_file = save_encrypted_file(file_obj, request.user, content_type)
-                    
-                    # Clean up
-                    os.remove(f'{upload_path}{filename}')
-                    os.rmdir(upload_path)
-                    
-                    return Response(
-                        EncryptedFileSerializer(encrypted_file).data,
-                        status=status.HTTP_201_CREATED
-                    )
-                except Exception as e:
-                    return Response(
-                        {'error': str(e)},
-                        status=status.HTTP_400_BAD_REQUEST
-                    )
-        
-        return Response({'message': 'Chunk uploaded successfully'})
+        return charge_download(request, build_download_response(request, file))
 
     @action(detail=True, methods=['get'])
     def preview(self, request, pk=None):
@@ -266,50 +348,48 @@ class EncryptedFileViewSet(viewsets.ModelViewSet):
         file = self.get_object()
         
         # Check if preview is supported
-        if not file.content_type.startswith(('image/', 'application/pdf')):
+        if not is_previewable(file.content_type):
             return Response(
                 {'error': 'Preview not supported for this file type'},
                 status=status.HTTP_400_BAD_REQUEST
             )
         
         try:
-            decrypted_content = get_decrypted_file(file)
-            
-            # For images, return the image data
-            if file.content_type.startswith('image/'):
-                return HttpResponse(
-                    decrypted_content,
-                    content_type=file.content_type
-                )
-            
-            # For PDFs, return first page as image
-            if file.content_type == 'application/pdf':
-                import fitz  # PyMuPDF
-                from PIL import Image
-                import io
-                
-                # Convert PDF to image
-                pdf = fitz.open(stream=decrypted_content, filetype="pdf")
-                pix = pdf[0].get_pixmap()
-                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                
-                # Save image to buffer
-                img_buffer = io.BytesIO()
-                img.save(img_buffer, format='PNG')
-                img_buffer.seek(0)
-                
-                return HttpResponse(
-                    img_buffer.getvalue(),
-                    content_type='image/png'
-                )
-                
+            # Render parameters: PDF page and optional maximum width
+            page = int(request.query_params.get('page', 0))
+            width = request.query_params.get('width')
+            width = min(int(width), MAX_PREVIEW_WIDTH) if width else None
+            if page < 0 or (width is not None and width <= 0):
+                raise ValueError("Invalid preview parameters")
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        # Images that don't need resizing are streamed as they are
+        render = needs_render(file.content_type, width)
+        # Previews are a function of the content and the parameters
+        etag = content_etag(file, 'preview', page, width) if render else content_etag(file)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        if not render:
+            return set_etag(StreamingHttpResponse(
+                stream_body(request, iter_decrypted_file(file)),
+                content_type=file.content_type
+            ), etag)
+        
+        try:
+            content, content_type = get_preview(file, page, width)
         except Exception as e:
             return Response(
                 {'error': f'Error generating preview: {str(e)}'},
                 status=status.HTTP_400_BAD_REQUEST
             )
+        return set_etag(HttpResponse(content, content_type=content_type), etag)
 
     def handle_exception(self, exc):
+        # DRF answers these with 401 or 429 and the right headers
+        if isinstance(exc, (AuthenticationFailed, NotAuthenticated, Throttled)):
+            return super().handle_exception(exc)
+
         if isinstance(exc, (ValidationError, PermissionError)):
             return Response(
                 {'error': str(exc)},
@@ -329,33 +409,76 @@ class EncryptedFileViewSet(viewsets.ModelViewSet):
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
 
-class FileShareViewSet(viewsets.ModelViewSet):
+class FileShareViewSet(ConditionalListMixin, viewsets.ModelViewSet):
     serializer_class = FileShareSerializer
     permission_classes = [permissions.IsAuthenticated, IsOwnerOrAdmin]
+    list_scope = 'shares'
+    pagination_class = ShareCursorPagination
     
     def get_queryset(self):
-        return FileShare.objects.filter(
+        return FileShare.objects.select_related(
+            'file', 'file__owner', 'shared_with'
+        ).filter(
             models.Q(file__owner=self.request.user) |
             models.Q(shared_with=self.request.user)
         )
 
-class ShareableLinkViewSet(viewsets.ModelViewSet):
+    @action(detail=False, methods=['post'], url_path='bulk')
+    def bulk_share(self, request):
+        """Share every file in ``file_ids`` with every user in ``usernames``."""
+        file_ids = request.data.get('file_ids')
+        usernames = request.data.get('usernames')
+        if not isinstance(file_ids, list) or not isinstance(usernames, list):
+            return Response(
+                {'error': 'file_ids and usernames must be lists'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            results = batch.bulk_share(
+                request.user, file_ids, usernames, request.data.get('permission', 'view')
+            )
+        except batch.BatchError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        created = [result for result in results if result.get('share')]
+        record_events(request, [
+            {
+                'action': 'share',
+                'file_id': result['share'].file_id,
+                'details': {'shared_with': result['username']},
+            }
+            for result in created
+        ])
+        for result in created:
+            result['share'] = self.get_serializer(result['share']).data
+        return batch_response(results, status.HTTP_201_CREATED)
+
+class ShareableLinkViewSet(ConditionalListMixin, viewsets.ModelViewSet):
     serializer_class = ShareableLinkSerializer
     permission_classes = [permissions.IsAuthenticated, IsOwnerOrAdmin]
+    pagination_class = LinkCursorPagination
+    list_scope = 'links'
     
     def get_permissions(self):
         if self.action in ['retrieve', 'download']:
             return []  # No permissions required for public access
         return [permissions.IsAuthenticated(), IsOwnerOrAdmin()]
 
+    def get_throttles(self):
+        throttles = super().get_throttles()
+        if self.action == 'download':
+            throttles.append(LinkDownloadThrottle())
+        return throttles
+
     def get_queryset(self):
+        queryset = ShareableLink.objects.select_related('file', 'file__owner', 'created_by')
         if self.action in ['retrieve', 'download']:
-            return ShareableLink.objects.all()
-        return ShareableLink.objects.filter(
+            return queryset
+        return queryset.filter(
             models.Q(file__owner=self.request.user) |
             models.Q(created_by=self.request.user)
         )
-    
+
     def perform_create(self, serializer):
         expires_at = datetime.now() + timedelta(days=7)  # Default 7 days
         if 'expires_at' in self.request.data:
@@ -368,37 +491,41 @@ class ShareableLinkViewSet(viewsets.ModelViewSet):
 
     @action(detail=True, methods=['get'])
     def download(self, request, pk=None):
-        link = get_object_or_404(ShareableLink, id=pk)
-        
-        if not link.is_valid:
+        link = get_object_or_404(ShareableLink.objects.select_related('file'), id=pk)
+        # Nothing is read until the body is iterated
+        response = build_download_response(request, link.file)
+        if response.status_code == status.HTTP_304_NOT_MODIFIED:
+            # Revalidating a copy the client has doesn't count as an access
+            if link.is_valid:
+                return response
+            return Response({'error': 'Link has expired'}, status=status.HTTP_403_FORBIDDEN)
+        
+        # Further ranges of a download already counted aren't counted again;
+        # a full body (no Range, or a stale If-Range) is a new download
+        ranged = response.status_code in (
+            status.HTTP_206_PARTIAL_CONTENT, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+        )
+        resumed = ranged and has_range_token(request, link)
+        if resumed:
+            if link.expires_at <= datetime.now():
+                return Response({'error': 'Link has expired'}, status=status.HTTP_403_FORBIDDEN)
+        # Expiry, max_access and the increment are checked in one statement
+        elif not link_counter.claim(link):
             return Response(
                 {'error': 'Link has expired'},
                 status=status.HTTP_403_FORBIDDEN
             )
-        
-        link.access_count += 1
-        link.save()
-        
-        file = link.file
-        decrypted_content = get_decrypted_file(file)
-        
-        # Create a BytesIO object from the decrypted content
-        file_content = BytesIO(decrypted_content)
-        
-        # Create response with proper filename
-        response = FileResponse(
-            file_content,
-            content_type=file.content_type,
-            as_attachment=True  # This ensures the file is downloaded
-        )
-        
-        # URL encode the filename to handle special characters
-        encoded_filename = urllib.parse.quote(file.name)
-        
-        # Set Content-Disposition with both filename and filename* parameters
-        response['Content-Disposition'] = f'attachment; filename="{encoded_filename}"; filename*=UTF-8\'\'{encoded_filename}'
-        response['Content-Length'] = len(decrypted_content)
-        
+        # Only downloads that will be served are charged bandwidth
+        try:
+            charge_download(request, response)
+        except Throttled:
+            if not resumed:
+                # The access wasn't used
+                release_access(link.pk, 1)
+            raise
+        
+        if ranged and not resumed:
+            set_range_token(response, request, link)
         return response
 
     def retrieve(self, request, *args, **kwargs):
@@ -408,4 +535,108 @@ class ShareableLinkViewSet(viewsets.ModelViewSet):
                 {'error': 'Link has expired'},
                 status=status.HTTP_403_FORBIDDEN
             )
-        return super().retrieve(request, *args, **kwargs) 
\ No newline at end of file
+        return super().retrieve(request, *args, **kwargs)
+
+class UploadSessionViewSet(mixins.CreateModelMixin,
+                           mixins.RetrieveModelMixin,
+                           mixins.ListModelMixin,
+                           mixins.DestroyModelMixin,
+                           viewsets.GenericViewSet):
+    """
+    Resumable chunked uploads.
+
+    POST   /api/uploads/                    start a session (name, size)
+    GET    /api/uploads/{id}/               received-chunk bitmap and offset
+    PUT    /api/uploads/{id}/chunks/{n}/    raw chunk body, X-Chunk-SHA256 header
+    POST   /api/uploads/{id}/complete/      turn the session into a file
+    DELETE /api/uploads/{id}/               abort
+    """
+    serializer_class = UploadSessionSerializer
+    permission_classes = [permissions.IsAuthenticated, IsOwnerOrAdmin]
+
+    def get_throttles(self):
+        throttles = super().get_throttles()
+        if self.action == 'chunk':
+            throttles.append(ChunkUploadThrottle())
+        return throttles
+
+    def get_queryset(self):
+        return UploadSession.objects.filter(owner=self.request.user)
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        name = serializer.validated_data['name']
+        size = serializer.validated_data['size']
+        try:
+            check_upload_session(request.user, name, size)
+            # The whole declared size is charged up front; chunks only count as requests
+            throttle_bytes(request, 'upload_bytes', size)
+            session = create_upload_session(request.user, name, size)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(self._status_data(session), status=status.HTTP_201_CREATED)
+
+    def retrieve(self, request, *args, **kwargs):
+        return Response(self._status_data(self.get_object()))
+
+    @action(detail=True, methods=['put'], url_path=r'chunks/(?P<index>\d+)')
+    def chunk(self, request, pk=None, index=None):
+        session = self.get_object()
+        stream = request.stream or BytesIO()
+        try:
+            write_chunk(session, int(index), stream, request.headers.get('X-Chunk-SHA256'))
+        except ChunkConflict as e:
+            return Response({'error': str(e)}, status=status.HTTP_409_CONFLICT)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(self._status_data(session))
+
+    @action(detail=True, methods=['post'])
+    def complete(self, request, pk=None):
+        session = self.get_object()
+        try:
+            encrypted_file = complete_upload_session(session)
+        except UploadError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        schedule_prerender(encrypted_file)
+        return Response(
+            EncryptedFileSerializer(encrypted_file, context={'request': request}).data,
+            status=status.HTTP_201_CREATED
+        )
+
+    def perform_destroy(self, instance):
+        abort_upload_session(instance)
+
+    def _status_data(self, session):
+        data = self.get_serializer(session).data
+        data.update(upload_status(session))
+        return data
+
+def charge_download(request, response):
+    """Charge a download's body to the ``download_bytes`` limit before it is streamed."""
+    throttle_bytes(request, 'download_bytes', int(response.get('Content-Length') or 0))
+    return response
+
+def batch_response(results, success_status=status.HTTP_200_OK):
+    """Per-item batch results; 207 Multi-Status when any item failed."""
+    if any(result['status'] >= 400 for result in results):
+        return Response({'results': results}, status=status.HTTP_207_MULTI_STATUS)
+    return Response({'results': results}, status=success_status)
+
+def metrics_view(request):
+    """Prometheus text exposition of the request metrics (see core.metrics)."""
+    if not getattr(settings, 'METRICS_ENABLED', True):
+        raise Http404
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token:
+        authorized = constant_time_compare(
+            request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}'
+        )
+    else:
+        authorized = request.META.get('REMOTE_ADDR') in getattr(
+            settings, 'METRICS_ALLOWED_IPS', ('127.0.0.1', '::1')
+        )
+    if not authorized:
+        return HttpResponse(status=403)
+    return HttpResponse(metrics_registry.expose(), content_type='text/plain; version=0.0.4')